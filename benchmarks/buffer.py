@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the throughput of downloading one large file from a local HTTP
+server: the former loop of 16 KiB read() chunks through check_digest(),
+and both download engines with several buffer sizes.
+
+The server runs in a separate process and sends the file from memory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import BaseHTTPServer
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.digest import check_digest
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.eventloop import EventLoopDownloadManager
+from dnstable_manager.fileset import File, FilesetContext
+from dnstable_manager.util import iterfileobj
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.digest:
+            self.send_header('Digest', 'SHA-256={}'.format(self.server.digest))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(server):
+    server.serve_forever()
+
+def legacy(f, args):
+    fp = urllib2.urlopen(f.uri)
+    algorithm, digest = None, None
+    if 'Digest' in fp.headers:
+        algorithm,_,digest = fp.headers['Digest'].partition('=')
+    with open(f.partial(), 'wb') as out:
+        for chunk in check_digest(iterfileobj(fp), algorithm, digest):
+            out.write(chunk)
+
+def threads(f, args):
+    m = DownloadManager(buffer_size=args.buffer_size)
+    m._download(f)
+    if f in m._failed_downloads:
+        raise Exception('Download failed')
+
+def eventloop(f, args):
+    done = threading.Event()
+    errors = []
+    m = EventLoopDownloadManager(buffer_size=args.buffer_size)
+    m.add_callback(lambda f, error: (errors.append(error), done.set()))
+    m.start()
+    m.enqueue(f)
+    done.wait()
+    m.stop(blocking=True)
+    if errors[0]:
+        raise errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+            help='Size of the file in MiB.')
+    parser.add_argument('--buffer-sizes', type=int, nargs='*', default=[16 * 1024, 256 * 1024, 1024 * 1024])
+    parser.add_argument('--no-digest', action='store_true',
+            help='Do not send a Digest header.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.getLogger('dnstable_manager').addHandler(logging.NullHandler())
+    logging.getLogger('dnstable_manager').propagate = False
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.body = os.urandom(1 << 20) * args.size
+    server.digest = None if args.no_digest else base64.b64encode(hashlib.sha256(server.body).digest())
+    process = multiprocessing.Process(target=serve, args=(server,))
+    process.daemon = True
+    process.start()
+    port = server.server_address[1]
+    server.server_close()
+    del server
+
+    runs = [('legacy 16K read()', legacy, None)]
+    for buffer_size in args.buffer_sizes:
+        runs.append(('threads {}K'.format(buffer_size // 1024), threads, buffer_size))
+    for buffer_size in args.buffer_sizes:
+        runs.append(('eventloop {}K'.format(buffer_size // 1024), eventloop, buffer_size))
+
+    td = tempfile.mkdtemp(prefix='dnstable-manager-buffer.')
+    try:
+        print('{:<20} {:>10}'.format('loop', 'MiB/s'))
+        for name, func, buffer_size in runs:
+            args.buffer_size = buffer_size
+            best = None
+            for i in range(args.repeat):
+                f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, digest_required=False))
+                f.uri = 'http://127.0.0.1:{}/{}'.format(port, f.name)
+                t0 = time.time()
+                func(f, args)
+                elapsed = time.time() - t0
+                best = elapsed if best is None else min(best, elapsed)
+                for name_ in os.listdir(td):
+                    os.unlink(os.path.join(td, name_))
+            print('{:<20} {:>10.0f}'.format(name, args.size / best))
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+        process.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Simulate downloads from a throttled local HTTP server with fixed download
+concurrency and with the adaptive ConcurrencyController.
+
+The server limits each connection to --connection-rate and all connections
+together to --link-rate bytes per second, and answers 503 once more than
+--overload connections are open, so the best concurrency is around
+link-rate / connection-rate.
+"""
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.fileset import File, FilesetContext
+from dnstable_manager.util import TokenBucket
+
+CHUNK = 16 * 1024
+
+class ThrottledHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            overloaded = server.active > server.overload
+        try:
+            if overloaded:
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(server.size))
+            self.end_headers()
+            remaining = server.size
+            while remaining > 0:
+                chunk = min(CHUNK, remaining)
+                server.link.consume(chunk)
+                time.sleep(float(chunk) / server.connection_rate)
+                self.wfile.write('x' * chunk)
+                remaining -= chunk
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def run(server, args, **kwargs):
+    td = tempfile.mkdtemp(prefix='dnstable-manager-concurrency.')
+    try:
+        context = FilesetContext(uri='http://127.0.0.1:{}/dns.fileset'.format(server.server_address[1]),
+                dname=td, digest_required=False)
+        files = [File('dns.20150101.{:02d}{:02d}.m.mtbl'.format(i // 60, i % 60), context=context)
+                for i in range(args.files)]
+
+        m = DownloadManager(retry_timeout=args.retry_timeout, **kwargs)
+        slots = []
+        m.start()
+        t0 = time.time()
+        try:
+            while True:
+                remaining = [f for f in files if not os.path.exists(f.target())]
+                if not remaining:
+                    break
+                for f in remaining:
+                    if f not in m:
+                        m.enqueue(f)
+                slots.append(m.slots)
+                time.sleep(0.1)
+            elapsed = time.time() - t0
+        finally:
+            m.stop(blocking=True)
+        failures = sum(stats['failures'] for stats in m.host_stats().values())
+        return elapsed, failures, sum(slots) / float(len(slots))
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=48)
+    parser.add_argument('--size', type=int, default=256 * 1024,
+            help='Bytes per file.')
+    parser.add_argument('--connection-rate', type=int, default=256 * 1024)
+    parser.add_argument('--link-rate', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--overload', type=int, default=10)
+    parser.add_argument('--max-downloads', type=int, default=16)
+    parser.add_argument('--control-interval', type=float, default=0.5)
+    parser.add_argument('--retry-timeout', type=float, default=0.5)
+    parser.add_argument('--fixed', type=int, nargs='*', default=[2, 8, 16],
+            help='Fixed concurrency levels to compare against.')
+    args = parser.parse_args()
+
+    logging.getLogger('dnstable_manager').addHandler(logging.NullHandler())
+    logging.getLogger('dnstable_manager').propagate = False
+
+    server = Server(('127.0.0.1', 0), ThrottledHandler)
+    server.lock = threading.Lock()
+    server.active = 0
+    server.size = args.size
+    server.connection_rate = args.connection_rate
+    server.link = TokenBucket(args.link_rate, CHUNK)
+    server.overload = args.overload
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    print('{:<24} {:>8} {:>9} {:>10}'.format('concurrency', 'seconds', 'failures', 'avg slots'))
+    for slots in args.fixed:
+        elapsed, failures, avg = run(server, args, max_downloads=slots)
+        print('{:<24} {:>8.2f} {:>9} {:>10.1f}'.format('fixed {}'.format(slots), elapsed, failures, avg))
+    elapsed, failures, avg = run(server, args, max_downloads=args.max_downloads, min_downloads=1,
+            control_interval=args.control_interval)
+    print('{:<24} {:>8.2f} {:>9} {:>10.1f}'.format('adaptive 1-{}'.format(args.max_downloads), elapsed, failures, avg))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
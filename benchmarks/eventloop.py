@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Download many files concurrently from a slow local HTTP server with the
+threaded and the event loop DownloadManager, and compare the time taken and
+the number of threads used.
+
+The server runs in a separate process and waits --latency seconds before
+sending each file, so that all downloads are in progress at the same time.
+"""
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import logging
+import multiprocessing
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.eventloop import EventLoopDownloadManager
+from dnstable_manager.fileset import File, FilesetContext
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(server):
+    server.serve_forever()
+
+def run(manager_class, port, args):
+    td = tempfile.mkdtemp(prefix='dnstable-manager-eventloop.')
+    try:
+        context = FilesetContext(dname=td, digest_required=False)
+        files = []
+        for i in range(args.files):
+            f = File('dns.20150101.{:02d}{:02d}.m.mtbl'.format(i // 60, i % 60), context=context)
+            f.uri = 'http://127.0.0.1:{}/{}'.format(port, f.name)
+            files.append(f)
+
+        done = threading.Semaphore(0)
+        m = manager_class(max_downloads=args.files, retry_timeout=3600)
+        m.add_callback(lambda f, error: done.release())
+        threads = [threading.active_count()]
+        sampling = threading.Event()
+        def sample():
+            while not sampling.is_set():
+                threads.append(threading.active_count())
+                time.sleep(0.05)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+
+        t0 = time.time()
+        m.start()
+        for f in files:
+            m.enqueue(f)
+        for f in files:
+            done.acquire()
+        elapsed = time.time() - t0
+
+        sampling.set()
+        sampler.join()
+        m.stop(blocking=True)
+        complete = sum(1 for f in files if os.path.exists(f.target()))
+        # Not counting the main and the sampling thread.
+        return elapsed, max(threads) - 2, complete
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64 * 1024,
+            help='Bytes per file.')
+    parser.add_argument('--latency', type=float, default=1.0,
+            help='Seconds the server waits before each response.')
+    args = parser.parse_args()
+
+    logging.getLogger('dnstable_manager').addHandler(logging.NullHandler())
+    logging.getLogger('dnstable_manager').propagate = False
+
+    server = Server(('127.0.0.1', 0), SlowHandler)
+    server.body = 'x' * args.size
+    server.latency = args.latency
+    process = multiprocessing.Process(target=serve, args=(server,))
+    process.daemon = True
+    process.start()
+    port = server.server_address[1]
+    server.server_close()
+
+    try:
+        print('{:<12} {:>8} {:>8} {:>9}'.format('engine', 'seconds', 'threads', 'complete'))
+        for name, manager_class in (('threads', DownloadManager), ('eventloop', EventLoopDownloadManager)):
+            elapsed, threads, complete = run(manager_class, port, args)
+            print('{:<12} {:>8.2f} {:>8} {:>9}'.format(name, elapsed, threads, complete))
+    finally:
+        process.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the per-object footprint of fileset.File and the cost of the set
+differences and sorts the manager performs on every pass.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.fileset import File, FilesetContext
+
+from overlap import synthetic_fileset
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=180,
+            help='Days of synthetic history.')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Best of this many runs is reported.')
+    args = parser.parse_args()
+
+    names = sorted(synthetic_fileset(args.days))
+    context = FilesetContext(uri='http://example.com/dns.fileset', dname='/srv/dnstable/mtbl')
+
+    construct = timed(lambda: [File(name, context=context) for name in names], args.repeat)
+    files = [File(name, context=context) for name in names]
+    local = set(files)
+    remote = set(File(name, context=context) for name in names[:-len(names) // 10])
+
+    f = files[0]
+    size = sys.getsizeof(f) + (sys.getsizeof(f.__dict__) if hasattr(f, '__dict__') else 0)
+
+    print('files:              {}'.format(len(files)))
+    print('bytes/File:         {}'.format(size))
+    print('construct:          {:.3f}s'.format(construct))
+    print('sorted():           {:.3f}s'.format(timed(lambda: sorted(files, reverse=True), args.repeat)))
+    print('set difference:     {:.3f}s'.format(timed(lambda: local.difference(remote), args.repeat)))
+    print('set union:          {:.3f}s'.format(timed(lambda: local.union(remote), args.repeat)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time fetching one file from a file:// uri: through urlopen() as before,
+by hardlink, and by copy when hardlinking fails as it does across file
+systems.  Checking the digest file next to the source, which urlopen()
+never did, is timed on its own.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.audit import hash_file
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.fileset import File
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def fetch(m, f, method):
+    partial = f.partial()
+    if method == 'urlopen':
+        m._download_stream(f, partial, None, 0)
+    else:
+        m._download_local(f, partial)
+    os.unlink(partial)
+
+def no_link(src, dst):
+    raise OSError('hardlinks disabled')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+            help='Size of the file in MiB.')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Best of this many runs is reported.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('dnstable_manager')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    td = tempfile.mkdtemp(prefix='dnstable-manager-local.')
+    try:
+        source = os.path.join(td, 'source')
+        os.mkdir(source)
+        f = File('dns.2015.Y.mtbl', dname=os.path.join(td, 'dest'), digest_required=False)
+        os.mkdir(f.dname)
+        fname = os.path.join(source, f.name)
+        f.uri = 'file://{}'.format(fname)
+
+        block = os.urandom(1 << 20)
+        with open(fname, 'wb') as fp:
+            for _ in range(args.size):
+                fp.write(block)
+
+        m = DownloadManager()
+        print('size: {} MiB'.format(args.size))
+        link = os.link
+        for method in ('urlopen', 'hardlink', 'copy'):
+            if method == 'copy':
+                os.link = no_link
+            try:
+                best = timed(lambda: fetch(m, f, method), args.repeat)
+            finally:
+                os.link = link
+            print('{:<10} {:>8.3f}s {:>8.1f} MiB/s'.format(method, best, args.size / best))
+        best = timed(lambda: hash_file(fname, 'sha256'), args.repeat)
+        print('{:<10} {:>8.3f}s {:>8.1f} MiB/s'.format('sha256', best, args.size / best))
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
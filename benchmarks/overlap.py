@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time compute_overlap() on synthetic filesets with increasing amounts of
+Y/Q/M/W/D/H/X/m history and report the cost per file, which should stay
+flat as the fileset grows.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.fileset import File, compute_overlap
+
+def synthetic_fileset(days, base='dns', extension='mtbl'):
+    """
+    Return the names of a full (non-minimal) fileset covering 'days' days
+    ending on 2016-01-01, with every granularity present so that most of
+    the files are overlapped by a coarser one.
+    """
+    end = datetime.datetime(2016, 1, 1)
+    start = end - datetime.timedelta(days=days)
+    names = set()
+
+    def add(dt, fmt, tl):
+        names.add('{}.{}.{}.{}'.format(base, dt.strftime(fmt), tl, extension))
+
+    dt = start
+    while dt < end:
+        add(dt, '%Y', 'Y')
+        add(dt.replace(day=1, month=int((dt.month-1) / 3) * 3 + 1), '%Y%m', 'Q')
+        add(dt, '%Y%m', 'M')
+        add(dt.replace(day=int((dt.day-1) / 7) * 7 + 1), '%Y%m%d', 'W')
+        add(dt, '%Y%m%d', 'D')
+        for hour in range(24):
+            h = dt.replace(hour=hour)
+            add(h, '%Y%m%d.%H%M', 'H')
+            for minute in range(0, 60, 10):
+                add(h.replace(minute=minute), '%Y%m%d.%H%M', 'X')
+        dt += datetime.timedelta(days=1)
+
+    # A day's worth of minute files at the end of the history.
+    dt = end - datetime.timedelta(days=1)
+    while dt < end:
+        add(dt, '%Y%m%d.%H%M', 'm')
+        dt += datetime.timedelta(minutes=1)
+
+    return names
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 90, 180, 365, 730],
+            help='Days of history to generate for each run.')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Best of this many runs is reported.')
+    args = parser.parse_args()
+
+    print('{:>6} {:>8} {:>10} {:>10} {:>12}'.format('days', 'files', 'overlap', 'seconds', 'usec/file'))
+    for days in args.days:
+        files = set(File(name) for name in synthetic_fileset(days))
+
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.time()
+            overlap = set(compute_overlap(files))
+            elapsed = time.time() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+
+        print('{:>6} {:>8} {:>10} {:>10.3f} {:>12.2f}'.format(
+            days, len(files), len(overlap), best, best / len(files) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmarks for fileset filename parsing: the previous strptime based
+parser against parse_datetime(), memoized parse_filename() and full File
+construction.
+"""
+
+from __future__ import print_function
+
+import argparse
+import calendar
+import datetime
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.fileset import File, ParseError, parse_datetime, parse_filename
+
+NAMES = (
+    'dns.2014.Y.mtbl',
+    'dns.201501.M.mtbl',
+    'dns.20150201.W.mtbl',
+    'dns.20150208.D.mtbl',
+    'dns.20150209.0000.H.mtbl',
+    'dns.20150209.0100.X.mtbl',
+    'dns.20150209.0110.m.mtbl',
+)
+
+def strptime_parse_datetime(s):
+    """The parse_datetime() implementation this module replaced."""
+    fmt_times = ((13, '%Y%m%d.%H%M'), (8, '%Y%m%d'), (6, '%Y%m'), (4, '%Y'))
+    for len_fmt, fmt in fmt_times:
+        try:
+            if len(s) == len_fmt:
+                return datetime.datetime.utcfromtimestamp(calendar.timegm(time.strptime(s, fmt)))
+        except ValueError:
+            pass
+    raise ParseError("Time data '{}' does not match any of the time formats".format(s))
+
+def strptime_parse_filename(name):
+    """The File._init_tl()/_init_datetime() path this module replaced."""
+    tl = name.split('.')[-2]
+    if not tl in File._valid_tl:
+        raise ParseError('Time letter {} not in valid set {}'.format(tl, File._valid_tl))
+    return tl, strptime_parse_datetime('.'.join(os.path.basename(name).split('.')[1:-2]))
+
+def bench(label, func, number):
+    best = min(timeit.repeat(lambda: [func(n) for n in NAMES], number=number, repeat=3))
+    usec = best / (number * len(NAMES)) * 1e6
+    print('{:<32} {:>10.3f} usec/name'.format(label, usec))
+    return usec
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000,
+            help='Passes over the sample names per timing.')
+    args = parser.parse_args()
+
+    datetime_strings = dict((n, '.'.join(n.split('.')[1:-2])) for n in NAMES)
+
+    legacy = bench('strptime parse_datetime', lambda n: strptime_parse_datetime(datetime_strings[n]), args.number)
+    fast = bench('parse_datetime', lambda n: parse_datetime(datetime_strings[n]), args.number)
+    legacy_name = bench('strptime filename parse', strptime_parse_filename, args.number)
+    bench('parse_filename (uncached)', parse_filename.__wrapped__, args.number)
+    cached = bench('parse_filename (memoized)', parse_filename, args.number)
+    bench('File()', File, args.number)
+
+    print()
+    print('parse_datetime speedup: x{:.1f}'.format(legacy / fast))
+    print('memoized parse_filename speedup: x{:.1f}'.format(legacy_name / cached))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the throughput of one large download with a Digest header, with
+reading, hashing and writing on one thread and with hashing and writing
+pipelined onto a second thread (pipeline_depth).
+
+The file is served from memory by a local HTTP server in a separate
+process, or read from a file:// URI.
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import BaseHTTPServer
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.fileset import File, FilesetContext
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.send_header('Digest', self.server.digest)
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(server):
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+            help='Size of the file in MiB.')
+    parser.add_argument('--algorithm', choices=('sha256', 'sha512'), default='sha256')
+    parser.add_argument('--source', choices=('http', 'file'), default='http')
+    parser.add_argument('--depths', type=int, nargs='*', default=[0, 2, 4, 8])
+    parser.add_argument('--buffer-size', type=int, default=256 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.getLogger('dnstable_manager').addHandler(logging.NullHandler())
+    logging.getLogger('dnstable_manager').propagate = False
+
+    body = os.urandom(1 << 20) * args.size
+    digest = '{}={}'.format(args.algorithm.upper().replace('SHA', 'SHA-'),
+            base64.b64encode(hashlib.new(args.algorithm, body).digest()))
+
+    td = tempfile.mkdtemp(prefix='dnstable-manager-pipeline.')
+    process = None
+    try:
+        if args.source == 'http':
+            server = Server(('127.0.0.1', 0), Handler)
+            server.body = body
+            server.digest = digest
+            process = multiprocessing.Process(target=serve, args=(server,))
+            process.daemon = True
+            process.start()
+            uri = 'http://127.0.0.1:{}/dns.2015.Y.mtbl'.format(server.server_address[1])
+            server.server_close()
+        else:
+            # file:// responses carry no Digest header, the digest comes
+            # from the partial metadata instead.
+            source = os.path.join(td, 'source')
+            with open(source, 'wb') as fp:
+                fp.write(body)
+            uri = 'file://{}'.format(source)
+        del body
+
+        dname = os.path.join(td, 'dest')
+        os.mkdir(dname)
+        print('{:<16} {:>10}'.format('pipeline_depth', 'MiB/s'))
+        for depth in args.depths:
+            best = None
+            for i in range(args.repeat):
+                f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=dname, digest_required=False))
+                f.uri = uri
+                m = DownloadManager(buffer_size=args.buffer_size, pipeline_depth=depth)
+                if args.source == 'file':
+                    m._get_digest = lambda f, headers, meta=None: tuple(digest.split('=', 1))
+                t0 = time.time()
+                m._download(f)
+                elapsed = time.time() - t0
+                if f in m._failed_downloads:
+                    raise Exception('Download failed')
+                best = elapsed if best is None else min(best, elapsed)
+                for name in os.listdir(dname):
+                    os.unlink(os.path.join(dname, name))
+            print('{:<16} {:>10.0f}'.format(depth, args.size / best))
+    finally:
+        if process is not None:
+            process.terminate()
+        shutil.rmtree(td, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the cost of draining a large download queue with the indexed heap
+used by DownloadManager against rescanning a set with heapq.nlargest()
+after every completion.
+"""
+
+from __future__ import print_function
+
+import argparse
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager.fileset import File, FilesetContext
+from dnstable_manager.util import IndexedHeap
+
+def synthetic_files(count):
+    context = FilesetContext(uri='http://example.com/dns.fileset', dname='/srv/dnstable/mtbl')
+    start = time.mktime((2010, 1, 1, 0, 0, 0, 0, 0, 0))
+    files = [File(time.strftime('dns.%Y%m%d.%H%M.m.mtbl', time.gmtime(start + 60 * i)), context=context)
+            for i in range(count)]
+    random.Random(count).shuffle(files)
+    return files
+
+def drain_nlargest(files, slots, limit):
+    pending = set(files)
+    for i in range(limit):
+        for f in heapq.nlargest(slots, pending):
+            pending.remove(f)
+            break
+
+def drain_indexed(files, cancelled):
+    pending = IndexedHeap()
+    for f in files:
+        pending.push(f)
+    for f in cancelled:
+        pending.remove(f)
+    while pending:
+        pending.pop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=50000,
+            help='Number of files to enqueue.')
+    parser.add_argument('--slots', type=int, default=4,
+            help='max_downloads used for the heapq.nlargest() scan.')
+    parser.add_argument('--nlargest-pops', type=int, default=1000,
+            help='Completions to simulate with heapq.nlargest(); the total is extrapolated.')
+    args = parser.parse_args()
+
+    files = synthetic_files(args.files)
+
+    t0 = time.time()
+    drain_indexed(files, files[::10])
+    indexed = time.time() - t0
+
+    limit = min(args.nlargest_pops, len(files))
+    t0 = time.time()
+    drain_nlargest(files, args.slots, limit)
+    nlargest = (time.time() - t0) / limit
+
+    print('files:                       {}'.format(len(files)))
+    print('IndexedHeap push+cancel+pop: {:.3f}s'.format(indexed))
+    print('nlargest per completion:     {:.3f}ms'.format(nlargest * 1000))
+    print('nlargest full drain (est):   {:.1f}s'.format(nlargest * len(files) / 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time a restart of a DNSTableManager over a synthetic destination
+directory: constructing it and running its first step(), without a state
+store, with an empty one, and with the state saved by a previous run.
+The remote fileset is read from a file:// uri, so the time a real server
+takes to answer is not included.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dnstable_manager import DNSTableManager
+from dnstable_manager.download import DownloadManager
+import dnstable_manager.fileset
+from dnstable_manager.state import StateStore
+
+from overlap import synthetic_fileset
+
+def restart(uri, dname, state_file):
+    state = StateStore(state_file) if state_file else None
+    t0 = time.time()
+    m = DNSTableManager(uri, dname, minimal=False, download_manager=DownloadManager(), state=state)
+    t1 = time.time()
+    m.step()
+    t2 = time.time()
+    m.fileset._watcher.close()
+    if state:
+        state.close()
+    return t1 - t0, t2 - t1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=180,
+            help='Days of synthetic history.')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Best of this many runs is reported.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('dnstable_manager')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    dnstable_manager.fileset.disable_unlink = True
+
+    td = tempfile.mkdtemp(prefix='dnstable-manager-startup.')
+    try:
+        dname = os.path.join(td, 'mtbl')
+        os.mkdir(dname)
+        names = sorted(synthetic_fileset(args.days))
+        for name in names:
+            open(os.path.join(dname, name), 'w').close()
+        with open(os.path.join(td, 'dns.fileset'), 'w') as fp:
+            fp.write(''.join('{}\n'.format(name) for name in names))
+        uri = 'file://{}'.format(os.path.join(td, 'dns.fileset'))
+        state_file = os.path.join(td, 'state.db')
+
+        # Let the saved local index age out of the racy window.
+        restart(uri, dname, state_file)
+        time.sleep(1.1)
+        restart(uri, dname, state_file)
+
+        print('files: {}'.format(len(names)))
+        print('{:<12} {:>10} {:>10} {:>10}'.format('state', 'init', 'step', 'total'))
+        for label, state in (('none', None), ('empty', 'empty'), ('saved', state_file)):
+            best = None
+            for _ in range(args.repeat):
+                if state == 'empty':
+                    empty = os.path.join(td, 'empty.db')
+                    if os.path.exists(empty):
+                        os.unlink(empty)
+                    result = restart(uri, dname, empty)
+                else:
+                    result = restart(uri, dname, state)
+                if best is None or sum(result) < sum(best):
+                    best = result
+            print('{:<12} {:>9.3f}s {:>9.3f}s {:>9.3f}s'.format(label, best[0], best[1], sum(best)))
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare TLS connection setup against a local stand-in server with
+ssl.wrap_socket() per connection, as https.HTTPSConnection used to do, and
+with the cached SSLContext from https.get_context().  Requires the openssl
+command to create a self-signed server certificate.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dnstable_manager.https
+
+def make_certificate(dname):
+    keyfile = os.path.join(dname, 'server.key')
+    certfile = os.path.join(dname, 'server.crt')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', keyfile, '-out', certfile, '-days', '1', '-subj', '/CN=localhost'],
+            stdout=devnull, stderr=devnull)
+    return keyfile, certfile
+
+def make_ca_file(dname, certfile, bundle):
+    """Append the server certificate to a system CA bundle, if there is one."""
+    ca_file = os.path.join(dname, 'ca.crt')
+    with open(ca_file, 'w') as out:
+        if bundle and os.path.exists(bundle):
+            out.write(open(bundle).read())
+        out.write(open(certfile).read())
+    return ca_file
+
+def serve(listener, context):
+    while True:
+        try:
+            sock, addr = listener.accept()
+        except socket.error:
+            return
+        try:
+            conn = context.wrap_socket(sock, server_side=True)
+            conn.recv(1)
+            conn.close()
+        except (ssl.SSLError, socket.error):
+            sock.close()
+
+def connect_wrap_socket(address, ca_file):
+    sock = socket.create_connection(address)
+    conn = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_SSLv23,
+            ca_certs=ca_file, cert_reqs=ssl.CERT_REQUIRED)
+    conn.close()
+
+def connect_context(address, ca_file):
+    sock = socket.create_connection(address)
+    conn = dnstable_manager.https.get_context().wrap_socket(sock, server_hostname='localhost')
+    conn.close()
+
+def timed(func, count, *args):
+    t0 = time.time()
+    for i in range(count):
+        func(*args)
+    return (time.time() - t0) / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--connections', type=int, default=200,
+            help='Connections per method.')
+    parser.add_argument('--ca-bundle', default=dnstable_manager.https.ca_file,
+            help='System CA bundle loaded along with the test certificate.')
+    args = parser.parse_args()
+
+    td = tempfile.mkdtemp(prefix='dnstable-manager-tls.')
+    try:
+        keyfile, certfile = make_certificate(td)
+        ca_file = make_ca_file(td, certfile, args.ca_bundle)
+
+        server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        server_context.load_cert_chain(certfile, keyfile)
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(64)
+        thread = threading.Thread(target=serve, args=(listener, server_context))
+        thread.setDaemon(True)
+        thread.start()
+        address = listener.getsockname()
+
+        dnstable_manager.https.ca_file = ca_file
+        dnstable_manager.https.certfile = None
+        dnstable_manager.https.keyfile = None
+
+        t0 = time.time()
+        dnstable_manager.https.get_context()
+        context_setup = time.time() - t0
+
+        print('connections:              {}'.format(args.connections))
+        print('SSLContext creation:      {:.2f}ms (once)'.format(context_setup * 1000))
+        print('wrap_socket per conn:     {:.2f}ms'.format(timed(connect_wrap_socket, args.connections, address, ca_file) * 1000))
+        print('cached SSLContext:        {:.2f}ms'.format(timed(connect_context, args.connections, address, ca_file) * 1000))
+        listener.close()
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -14,11 +14,13 @@
 
 from __future__ import print_function
 
+import collections
 import errno
 import httplib
 import logging
 import os
 import socket
+import sqlite3
 import threading
 import time
 import traceback
@@ -26,7 +28,7 @@ import urllib2
 import urlparse
 
 from dnstable_manager.download import DownloadManager
-from dnstable_manager.fileset import Fileset, FilesetError
+from dnstable_manager.fileset import File, Fileset, FilesetError, SEGMENT_SIZE
 import jsonschema
 import option_merge
 import pkg_resources
@@ -62,6 +64,11 @@ def get_config(filename=None, stream=None, validate=True):
             if not os.path.isdir(fileset_config['destination']):
                 raise ConfigException('{} is not a directory'.format(fileset_config['destination']))
 
+        downloader = config['downloader']
+        if downloader.get('min_downloads', 1) > downloader['max_downloads']:
+            raise ConfigException('min_downloads {} is greater than max_downloads {}'.format(
+                downloader['min_downloads'], downloader['max_downloads']))
+
         for attr in ('ssl_ca_file', 'ssl_keyfile', 'ssl_certfile'):
             if attr in config['downloader']:
                 try:
@@ -73,7 +80,7 @@ def get_config(filename=None, stream=None, validate=True):
     return config
 
 class DNSTableManager:
-    def __init__(self, fileset_uri, destination, base=None, extension='mtbl', frequency=1800, download_timeout=None, retry_timeout=60, apikey=None, validator=None, digest_required=True, minimal=True, download_manager=None):
+    def __init__(self, fileset_uri, destination, base=None, extension='mtbl', frequency=1800, download_timeout=None, retry_timeout=60, apikey=None, validator=None, digest_required=True, minimal=True, rescan_interval=300, segments=1, segment_size=SEGMENT_SIZE, download_manager=None, state=None, validator_stdin=False):
         self.fileset_uri = fileset_uri
 
         if not os.path.isdir(destination):
@@ -98,17 +105,40 @@ class DNSTableManager:
                 extension=self.extension,
                 apikey=apikey,
                 validator=validator,
+                validator_stdin=validator_stdin,
                 timeout=download_timeout,
-                digest_required=digest_required)
+                digest_required=digest_required,
+                rescan_interval=rescan_interval,
+                segments=segments,
+                segment_size=segment_size,
+                state=state)
 
         if download_manager:
             self.download_manager = download_manager
         else:
             self.download_manager = DownloadManager(download_timeout=download_timeout, retry_timeout=retry_timeout)
             self.download_manager.start()
-
+        self.download_manager.add_callback(self._download_finished)
+
+        # A remote fileset restored from the state store is not retrieved
+        # again before it is due, and failed downloads are not retried
+        # before their retry timeout runs out.
+        self.state = state
+        self.next_remote_load = 0
+        if self.fileset.remote_load_time is not None:
+            self.next_remote_load = self.fileset.remote_load_time + self.frequency
+        if state is not None:
+            for name, expiry in state.failures(self.fileset.state_key).items():
+                self.download_manager.add_failed(File(name, context=self.fileset.context), expiry)
+        self.queued = set()
+        self.scheduler = None
         self.thread = None
 
+        # Under a scheduler, the remote fileset is fetched on one of its
+        # workers and the outcome is taken over by the next step().
+        self._fetching = False
+        self._fetched = collections.deque()
+
     def start(self):
         if self.thread:
             raise Exception
@@ -125,42 +155,133 @@ class DNSTableManager:
         self.thread = None
 
     def run(self):
-        next_remote_load = 0
         while True:
-            now = time.time()
-            self.fileset.load_local_fileset()
+            self.step()
+            time.sleep(1)
 
-            try:
-                if now >= next_remote_load:
+    def step(self):
+        """
+        Run one pass: load the local and (when due) remote filesets, queue
+        missing files and publish the fileset files.
+
+        Returns the number of seconds after which the next pass is needed
+        if nothing else happens in the meantime.
+        """
+        now = time.time()
+
+        while self._fetched:
+            started, fetched, failed = self._fetched.popleft()
+            self._fetching = False
+            if failed:
+                self.next_remote_load = started + self.retry_timeout
+                # The retry is due even if the rest of this step fails and
+                # its delay is never returned.
+                if self.scheduler:
+                    self.scheduler.schedule(self, self.next_remote_load - now)
+            else:
+                self.fileset.apply_remote_fileset(fetched)
+                self.next_remote_load = started + self.frequency
+
+        self.fileset.load_local_fileset()
+
+        if now >= self.next_remote_load and not self._fetching:
+            if self.scheduler:
+                self._fetching = True
+                self.scheduler.submit(self._fetch_remote_fileset, now)
+            else:
+                try:
                     self.fileset.load_remote_fileset()
-                    next_remote_load = now + self.frequency
-            except (FilesetError, urllib2.URLError, urllib2.HTTPError, httplib.HTTPException, socket.error) as e:
-                logger.error('Failed to load remote fileset {}: {}'.format(self.fileset_uri, str(e)))
-                logger.debug(traceback.format_exc())
-                next_remote_load = now + self.retry_timeout
-
-            for f in sorted(self.fileset.missing_files(), reverse=True):
-                if f not in self.download_manager:
-                    self.download_manager.enqueue(f)
-
-            self.fileset.prune_obsolete_files(minimal=self.minimal)
-            self.fileset.prune_redundant_files(minimal=self.minimal)
+                    self.next_remote_load = now + self.frequency
+                except (FilesetError, urllib2.URLError, urllib2.HTTPError, httplib.HTTPException, socket.error) as e:
+                    logger.error('Failed to load remote fileset {}: {}'.format(self.fileset_uri, str(e)))
+                    logger.debug(traceback.format_exc())
+                    self.next_remote_load = now + self.retry_timeout
+
+        if self.fileset.reconcile(minimal=self.minimal):
+            # Files queued earlier may have been superseded or removed from
+            # the remote fileset since.
+            for f in self.queued.difference(self.fileset.missing):
+                self.download_manager.cancel(f)
+            self.queued.intersection_update(self.fileset.missing)
 
             try:
-                self.fileset.write_local_fileset()
-                if not self.minimal:
-                    self.fileset.write_local_fileset(minimal=False)
-            except (IOError, OSError) as e:
-                logger.error('Failed to write fileset {}: {}'.format(self.fileset.get_fileset_name(), str(e)))
+                self.fileset.prune_partial_files()
+            except OSError as e:
+                logger.error('Failed to prune partial downloads in {}: {}'.format(self.destination, str(e)))
                 logger.debug(traceback.format_exc())
 
+        for f in sorted(self.fileset.missing, reverse=True):
+            if f not in self.download_manager:
+                self.download_manager.enqueue(f)
+                self.queued.add(f)
+
+        try:
+            self.fileset.write_local_fileset()
+            if not self.minimal:
+                self.fileset.write_local_fileset(minimal=False)
+        except (IOError, OSError) as e:
+            logger.error('Failed to write fileset {}: {}'.format(self.fileset.get_fileset_name(), str(e)))
+            logger.debug(traceback.format_exc())
+
+        try:
+            self.fileset.purge_deleted_files()
+        except OSError as e:
+            logger.error('Failed to purge deleted files in {}: {}'.format(self.destination, str(e)))
+            logger.debug(traceback.format_exc())
+
+        try:
+            self.fileset.save_state()
+        except sqlite3.Error as e:
+            logger.error('Failed to save the state of {}: {}'.format(self.fileset_uri, str(e)))
+            logger.debug(traceback.format_exc())
+
+        next_step = self.fileset.next_local_load()
+        if not self._fetching:
+            next_step = min(next_step, self.next_remote_load)
+        if self.fileset.missing:
+            # Failed downloads are dropped by the download manager after
+            # retry_timeout and have to be queued again.
+            next_step = min(next_step, now + self.download_manager.retry_timeout)
+        return max(0, next_step - time.time())
+
+    def _fetch_remote_fileset(self, started):
+        """
+        Fetch the remote fileset on a scheduler worker, so that a slow or
+        hung remote does not hold up the steps of the other filesets, and
+        wake this manager to take over the result.
+        """
+        fetched = None
+        failed = False
+        try:
+            fetched = self.fileset.fetch_remote_fileset()
+        except Exception as e:
+            logger.error('Failed to load remote fileset {}: {}'.format(self.fileset_uri, str(e)))
+            logger.debug(traceback.format_exc())
+            failed = True
+
+        self._fetched.append((started, fetched, failed))
+        scheduler = self.scheduler
+        if scheduler:
+            scheduler.wake(self)
+
+    def _download_finished(self, f, error):
+        if f.context is not self.fileset.context:
+            return
+
+        if self.state is not None:
             try:
-                self.fileset.purge_deleted_files()
-            except OSError as e:
-                logger.error('Failed to purge deleted files in {}: {}'.format(self.destination, str(e)))
+                if error is None:
+                    self.state.clear_failure(self.fileset.state_key, f.name)
+                else:
+                    self.state.set_failure(self.fileset.state_key, f.name, time.time() + self.download_manager.retry_timeout)
+            except sqlite3.Error as e:
+                logger.error('Failed to save the state of {}: {}'.format(f.name, str(e)))
                 logger.debug(traceback.format_exc())
 
-            time.sleep(1)
+        if error is None:
+            self.fileset.add_local_file(f)
+            if self.scheduler:
+                self.scheduler.wake(self)
 
     def clean_tempfiles(self):
         open_files = set()
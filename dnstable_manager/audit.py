@@ -0,0 +1,244 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background audit of local files against their digest files.
+
+Files are rehashed in a pool of worker processes, each reading at no more
+than its share of the configured rate.  The (inode, size, mtime) of every
+file that passed is kept in .<base>.audit in the destination directory,
+so that unchanged files are not read again on every pass.  A file that
+fails is renamed out of the fileset, together with its digest file, to
+.<name>.quarantine, and the fileset's manager is woken to download it
+again.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import traceback
+
+from . import posix
+from .digest import DIGEST_EXTENSIONS, read_digest_file
+from .download import BUFFER_SIZE
+from .fileset import QUARANTINE_SUFFIX
+from .util import TokenBucket, readinto_chunks
+
+logger = logging.getLogger(__name__)
+
+AUDIT_INTERVAL = 86400
+CACHE_SUFFIX = '.audit'
+
+def file_key(fname):
+    """
+    Return the (inode, size, mtime) a cached audit result is valid for.
+    """
+    st = os.stat(fname)
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+def load_cache(fname):
+    try:
+        with open(fname) as fp:
+            return json.load(fp)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning('Could not read audit cache {}: {}'.format(fname, str(e)))
+    except ValueError as e:
+        logger.warning('Ignoring corrupt audit cache {}: {}'.format(fname, str(e)))
+    return dict()
+
+def write_cache(fname, cache):
+    with tempfile.NamedTemporaryFile(prefix='{}.'.format(os.path.basename(fname)), dir=os.path.dirname(fname), delete=False) as fp:
+        json.dump(cache, fp)
+    os.rename(fp.name, fname)
+
+_rate_limiter = None
+
+def _init_worker(rate_limit):
+    global _rate_limiter
+    _rate_limiter = TokenBucket(rate_limit)
+
+def hash_file(fname, algorithm, buffer_size=BUFFER_SIZE):
+    """
+    Return the hex digest of fname.  A file that was not in the page cache
+    before is dropped from it again afterwards.
+    """
+    digest_obj = hashlib.new(algorithm)
+    buf = bytearray(buffer_size)
+    with open(fname, 'rb') as fp:
+        resident = posix.resident_pages(fp.fileno())
+        for chunk in readinto_chunks(fp, buf):
+            if _rate_limiter is not None:
+                _rate_limiter.consume(len(chunk))
+            digest_obj.update(chunk)
+        if resident is not None and resident[0] == 0:
+            posix.fadvise(fp.fileno(), 0, 0, posix.POSIX_FADV_DONTNEED)
+    return digest_obj.hexdigest()
+
+def _audit_file(args):
+    # Runs in a worker process; exceptions are returned as text since
+    # not all of them can be pickled.
+    fname, key, algorithm, digest = args
+    try:
+        return fname, key, hash_file(fname, algorithm) == digest, None
+    except Exception as e:
+        return fname, key, None, str(e)
+
+class Auditor(object):
+    """
+    Periodically verify the local files of any number of DNSTableManagers
+    against their digest files.
+
+    'processes' is the number of worker processes, and 'rate_limit' the
+    combined rate in bytes per second they read at, if any.  The pool is
+    created by start(), which should be called before any other threads
+    are started so that the workers are not forked from a process holding
+    locks.
+    """
+
+    def __init__(self, interval=AUDIT_INTERVAL, processes=1, rate_limit=None):
+        self.interval = interval
+        self.processes = processes
+        self.rate_limit = rate_limit
+        self._managers = []
+        self._pool = None
+        self._thread = None
+        self._terminate = threading.Event()
+
+    def add(self, manager):
+        self._managers.append(manager)
+
+    def start(self):
+        if self._thread:
+            raise Exception('already running')
+
+        self._get_pool()
+        self._terminate.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, blocking=False, timeout=None):
+        self._terminate.set()
+        if blocking or timeout:
+            self.join(timeout=timeout)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            rate_limit = float(self.rate_limit) / self.processes if self.rate_limit else None
+            self._pool = multiprocessing.Pool(self.processes, _init_worker, (rate_limit,))
+        return self._pool
+
+    def close(self):
+        """
+        Terminate the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def run(self):
+        logger.debug('Running Auditor {}'.format(self))
+        while not self._terminate.is_set():
+            for manager in list(self._managers):
+                if self._terminate.is_set():
+                    break
+                try:
+                    self.audit(manager)
+                except Exception as e:
+                    logger.error('Audit of {} failed: {}'.format(manager.fileset.dname, str(e)))
+                    logger.debug(traceback.format_exc())
+            self._terminate.wait(self.interval)
+
+    def audit(self, manager):
+        """
+        Verify the local files of manager's fileset that changed since they
+        last passed, and quarantine those that fail.  Returns the number of
+        files checked, skipped as unchanged and failed.
+        """
+        fileset = manager.fileset
+        cache_file = os.path.join(fileset.dname, '.{}{}'.format(fileset.base, CACHE_SUFFIX))
+        cache = load_cache(cache_file)
+        passed = dict()
+        stats = dict(checked=0, skipped=0, failed=0)
+
+        tasks = []
+        for fname in sorted(fileset.list_local_files()):
+            name = os.path.basename(fname)
+            try:
+                key = file_key(fname)
+                digest = read_digest_file(fname)
+            except (IOError, OSError) as e:
+                # Removed since it was listed.
+                logger.debug('Not auditing {}: {}'.format(fname, str(e)))
+                continue
+            if cache.get(name) == key:
+                passed[name] = key
+                stats['skipped'] += 1
+            elif digest is not None:
+                tasks.append((fname, key) + digest)
+
+        for fname, key, ok, error in self._get_pool().imap_unordered(_audit_file, tasks):
+            if error is not None:
+                logger.warning('Could not audit {}: {}'.format(fname, error))
+            elif ok:
+                passed[os.path.basename(fname)] = key
+                stats['checked'] += 1
+            else:
+                stats['checked'] += 1
+                if self.quarantine(fname, key):
+                    stats['failed'] += 1
+            if self._terminate.is_set():
+                break
+
+        write_cache(cache_file, passed)
+        logger.info('Audited {}: {checked} checked, {skipped} unchanged, {failed} failed'.format(fileset.dname, **stats))
+        if stats['failed'] and manager.scheduler:
+            manager.scheduler.wake(manager)
+        return stats
+
+    def quarantine(self, fname, key):
+        """
+        Move fname and its digest files out of the fileset, unless it was
+        replaced since it was hashed.  Returns True if it was moved.
+        """
+        try:
+            if file_key(fname) != key:
+                logger.info('Not quarantining {}: Changed during audit.'.format(fname))
+                return False
+        except OSError as e:
+            logger.debug('Not quarantining {}: {}'.format(fname, str(e)))
+            return False
+
+        dname, name = os.path.split(fname)
+        os.rename(fname, os.path.join(dname, '.{}{}'.format(name, QUARANTINE_SUFFIX)))
+        for extension in DIGEST_EXTENSIONS:
+            try:
+                os.rename('{}.{}'.format(fname, extension),
+                        os.path.join(dname, '.{}.{}{}'.format(name, extension, QUARANTINE_SUFFIX)))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        logger.error('Quarantined {}: Digest mismatch.'.format(fname))
+        return True
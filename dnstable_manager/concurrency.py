@@ -0,0 +1,84 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ConcurrencyController(object):
+    """
+    Choose the number of concurrent downloads between min_slots and
+    max_slots from the goodput and error rate measured over successive
+    intervals (AIMD):
+
+    - If more than error_threshold of the downloads finished in an
+      interval failed, the slot count is multiplied by decrease.
+    - Otherwise, while every slot is busy, one slot is added as long as
+      the previous increase raised goodput by more than tolerance.
+    - An increase that did not pay off is taken back, and the count is
+      held there for hold intervals before probing upwards again.
+    """
+
+    def __init__(self, min_slots, max_slots, error_threshold=0.2, decrease=0.5, tolerance=0.05, hold=6):
+        if min_slots < 1 or max_slots < min_slots:
+            raise ValueError('Invalid slot range {}-{}'.format(min_slots, max_slots))
+
+        self.min_slots = min_slots
+        self.max_slots = max_slots
+        self.error_threshold = error_threshold
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.hold = hold
+
+        self.slots = min_slots
+        self._last_goodput = None
+        self._increased = False
+        self._held = 0
+
+    def update(self, goodput, completed, failed, saturated):
+        """
+        Feed the measurements of one interval and return the new slot
+        count.
+
+        'goodput' is the bytes per second transferred, 'completed' and
+        'failed' the number of downloads that finished and failed, and
+        'saturated' whether all slots were busy with more work waiting.
+        """
+        slots = self.slots
+        finished = completed + failed
+
+        if finished and float(failed) / finished > self.error_threshold:
+            slots = max(self.min_slots, int(slots * self.decrease))
+            self._held = self.hold
+            self._increased = False
+        elif self._increased and self._last_goodput is not None and goodput <= self._last_goodput * (1 + self.tolerance):
+            # The additional slot did not help.
+            slots = max(self.min_slots, slots - 1)
+            self._held = self.hold
+            self._increased = False
+        elif self._held:
+            self._held -= 1
+            self._increased = False
+        elif saturated and slots < self.max_slots:
+            slots += 1
+            self._increased = True
+        else:
+            self._increased = False
+
+        if slots != self.slots:
+            logger.info('Adjusting concurrent downloads from {} to {} (goodput {:.0f} bytes/s, {}/{} failed)'.format(
+                self.slots, slots, goodput, failed, finished))
+        self.slots = slots
+        self._last_goodput = goodput
+        return slots
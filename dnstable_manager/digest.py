@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import base64
+import errno
 import hashlib
 import logging
 
@@ -20,7 +21,27 @@ logger = logging.getLogger(__name__)
 
 class DigestError(Exception): pass
 
-def check_digest(iterator, algorithm, digest):
+def new_digest(algorithm):
+    """
+    Return a new hashlib object for an RFC 3230 Digest algorithm name, or
+    None if the algorithm is not supported.
+    """
+    if algorithm.lower() in ('sha-224', 'sha224'):
+        return hashlib.sha224()
+    elif algorithm.lower() in ('sha-256', 'sha256'):
+        return hashlib.sha256()
+    elif algorithm.lower() in ('sha-384', 'sha384'):
+        return hashlib.sha384()
+    elif algorithm.lower() in ('sha-512', 'sha512'):
+        return hashlib.sha512()
+    return None
+
+def check_digest(iterator, algorithm, digest, digest_obj=None):
+    """
+    Pass through the chunks of iterator and raise DigestError at the end
+    if their digest does not match.  digest_obj may be passed to continue
+    a digest that already covers preceding data.
+    """
     logger.debug('algorithm={}, checksum={}'.format(algorithm, digest))
 
     if algorithm is None:
@@ -28,15 +49,10 @@ def check_digest(iterator, algorithm, digest):
         for chunk in iterator:
             yield chunk
         return
-    elif algorithm.lower() in ('sha-224', 'sha224'):
-        digest_obj = hashlib.sha224()
-    elif algorithm.lower() in ('sha-256', 'sha256'):
-        digest_obj = hashlib.sha256()
-    elif algorithm.lower() in ('sha-384', 'sha384'):
-        digest_obj = hashlib.sha384()
-    elif algorithm.lower() in ('sha-512', 'sha512'):
-        digest_obj = hashlib.sha512()
-    else:
+
+    if digest_obj is None:
+        digest_obj = new_digest(algorithm)
+    if digest_obj is None:
         logger.debug('Unsupported algorithm: {}'.format(algorithm))
         for chunk in iterator:
             yield chunk
@@ -63,3 +79,20 @@ def digest_extension(algorithm):
         raise DigestError('Unknown algorithm: {}'.format(algorithm))
 
 DIGEST_EXTENSIONS = ('sha224', 'sha256', 'sha384', 'sha512')
+
+def read_digest_file(fname):
+    """
+    Return the (algorithm, hex digest) recorded in the first digest file
+    found for fname, or None if it has none.
+    """
+    for extension in DIGEST_EXTENSIONS:
+        try:
+            with open('{}.{}'.format(fname, extension)) as fp:
+                fields = fp.readline().split()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        if fields:
+            return extension, fields[0].lower()
+    return None
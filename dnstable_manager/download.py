@@ -14,32 +14,487 @@
 
 from __future__ import print_function
 
+import base64
+import collections
+from cStringIO import StringIO
+import email.utils
+import errno
 import heapq
+import httplib
+import json
 import logging
 import os
+import Queue
+import select
+import stat
+import sys
 import tempfile
 import time
 import threading
 import traceback
+import urllib
 import urllib2
+import urlparse
 
-from .digest import check_digest, digest_extension
-from .util import iterfileobj
+from . import posix
+from .concurrency import ConcurrencyController
+from .digest import DigestError, check_digest, digest_extension, new_digest, read_digest_file
+from .fileset import META_SUFFIX, ValidationFailed, discard_partial, discard_partial_meta
+from .util import IndexedHeap, TokenBucket, WakePipe, get_readinto, readinto_chunks
 import terminable_thread
 
 logger = logging.getLogger(__name__)
 
+# Default size of the buffer each download thread reads into.
+BUFFER_SIZE = 256 * 1024
+
 class DownloadError(Exception): pass
 
+def read_partial_meta(partial, uri):
+    """
+    Return the metadata saved alongside a partial download of uri, or None
+    if there is none or it cannot be used to resume.
+    """
+    try:
+        with open(partial + META_SUFFIX) as fp:
+            meta = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(meta, dict) or meta.get('uri') != uri:
+        return None
+    if not (meta.get('etag') or meta.get('last_modified')):
+        return None
+    return meta
+
+def write_partial_meta(partial, meta):
+    fname = partial + META_SUFFIX
+    with tempfile.NamedTemporaryFile(prefix='{}.'.format(os.path.basename(fname)), dir=os.path.dirname(fname), delete=False) as fp:
+        json.dump(meta, fp)
+    os.rename(fp.name, fname)
+
+def strong_etag(etag):
+    """Return etag if it may be used in If-Range, which rejects weak ETags."""
+    if etag and not etag.startswith('W/'):
+        return etag
+    return None
+
+def parse_content_range(value):
+    """
+    Return the (first, last, length) byte positions of a 'bytes
+    first-last/length' Content-Range header, or None if it cannot be
+    parsed.  length is None if the header gives it as '*'.
+
+    >>> parse_content_range('bytes 100-199/200')
+    (100, 199, 200)
+    """
+    if not value:
+        return None
+    unit,_,spec = value.strip().partition(' ')
+    if unit != 'bytes':
+        return None
+    positions,_,length = spec.partition('/')
+    first,_,last = positions.partition('-')
+    try:
+        return int(first), int(last), None if length == '*' else int(length)
+    except ValueError:
+        return None
+
+def split_ranges(length, segments, segment_size):
+    """
+    Split length bytes into at most segments inclusive (first, last) byte
+    ranges of at least segment_size bytes each.
+
+    >>> split_ranges(10, 3, 4)
+    [(0, 4), (5, 9)]
+    """
+    count = max(1, min(segments, length // max(1, segment_size)))
+    step = -(-length // count)
+    return [(first, min(first + step, length) - 1) for first in range(0, length, step)]
+
+def is_linked(partial):
+    """
+    Return whether partial shares its inode with another file, i.e. it was
+    hardlinked from a local source.
+    """
+    return os.stat(partial).st_nlink > 1
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+class InvalidPartial(DownloadError):
+    """
+    Raised when a partial download cannot be continued and has to be
+    discarded.
+    """
+    pass
+
+def download_host(f):
+    """
+    Return the host f is downloaded from, the unit for per-host limits and
+    statistics.
+    """
+    return urlparse.urlsplit(f.uri or '').netloc.lower()
+
+class PendingDownloads(object):
+    """
+    Pending downloads in one priority queue per host, so that the largest
+    file of any host with a free slot can be found without skipping over
+    files of hosts that are at their limit.
+    """
+
+    def __init__(self):
+        self._queues = dict()
+        self._hosts = dict()
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __nonzero__(self):
+        return bool(self._hosts)
+
+    def __contains__(self, f):
+        return f in self._hosts
+
+    def push(self, f):
+        if f in self._hosts:
+            return False
+        host = download_host(f)
+        self._hosts[f] = host
+        self._queues.setdefault(host, IndexedHeap()).push(f)
+        return True
+
+    def remove(self, f):
+        host = self._hosts.pop(f, None)
+        if host is None:
+            return False
+        queue = self._queues[host]
+        queue.remove(f)
+        if not queue:
+            del self._queues[host]
+        return True
+
+    def pop(self, available=None):
+        """
+        Remove and return the largest file whose host passes available(),
+        or None.
+        """
+        best = None
+        for host, queue in self._queues.items():
+            if available is not None and not available(host):
+                continue
+            if best is None or queue.peek() > best.peek():
+                best = queue
+        if best is None:
+            return None
+        f = best.peek()
+        self.remove(f)
+        return f
+
+class HostStats(object):
+    """
+    Transfer statistics of one host.  seconds is the wall-clock time
+    during which any download from the host was active, so that parallel
+    downloads are not counted more than once.
+    """
+
+    __slots__ = ('bytes', 'seconds', 'downloads', 'failures', 'active_since')
+
+    def __init__(self):
+        self.bytes = 0
+        self.seconds = 0.0
+        self.downloads = 0
+        self.failures = 0
+        self.active_since = None
+
+    def activate(self, now):
+        """Called when the first download from the host becomes active."""
+        self.active_since = now
+
+    def deactivate(self, now):
+        """Called when the last active download from the host ends."""
+        if self.active_since is not None:
+            self.seconds += now - self.active_since
+            self.active_since = None
+
+    def active_seconds(self, now=None):
+        if self.active_since is None:
+            return self.seconds
+        return self.seconds + (now if now is not None else time.time()) - self.active_since
+
+    @property
+    def throughput(self):
+        """Bytes per second while downloads from this host were active."""
+        seconds = self.active_seconds()
+        return self.bytes / seconds if seconds else 0.0
+
+    def as_dict(self):
+        seconds = self.active_seconds()
+        return dict(bytes=self.bytes, seconds=seconds, downloads=self.downloads,
+                failures=self.failures, throughput=self.bytes / seconds if seconds else 0.0)
+
+class PartialDownload(object):
+    """
+    The open partial file of a single-request download, checking the
+    length and digest of the body written to it and, with a
+    ValidatorProcess, validating it as it is written.
+    """
+
+    def __init__(self, fp, algorithm, digest, digest_obj=None, expected_len=None, write_behind=None, validator=None):
+        self.fp = fp
+        self.algorithm = algorithm
+        self.digest = digest
+        self.expected_len = expected_len
+        self.length = fp.tell()
+
+        logger.debug('algorithm={}, checksum={}'.format(algorithm, digest))
+        if algorithm and digest_obj is None:
+            digest_obj = new_digest(algorithm)
+            if digest_obj is None:
+                logger.debug('Unsupported algorithm: {}'.format(algorithm))
+        self._digest_obj = digest_obj
+        self._write_behind = write_behind
+        self.validator = validator
+
+    @property
+    def complete(self):
+        return self.expected_len is not None and self.length >= self.expected_len
+
+    def write(self, chunk):
+        if self._digest_obj is not None:
+            self._digest_obj.update(chunk)
+        self.fp.write(chunk)
+        self.length += len(chunk)
+        if self._write_behind is not None:
+            self._write_behind.update(self.length)
+        if self.validator is not None:
+            self.validator.write(chunk)
+
+    def close(self):
+        """
+        Close the file after the whole body was written, ending the input
+        of the validator.  check() then waits for its result.
+        """
+        if self.fp.closed:
+            return
+        if self.validator is not None:
+            self.validator.close()
+        try:
+            if self._write_behind is not None:
+                self._write_behind.finish()
+        finally:
+            self.fp.close()
+
+    def abort(self):
+        """
+        Close the file after a failed transfer, killing the validator and
+        without waiting for the file to be written to disk.
+        """
+        if self.validator is not None:
+            self.validator.kill()
+            self.validator = None
+        self._write_behind = None
+        self.close()
+
+    def check(self):
+        """
+        Raise if the body is not complete, its digest does not match or it
+        failed validation.  A short body raises DownloadError, so that the
+        partial file is kept and resumed.
+        """
+        try:
+            if self.expected_len is not None and self.length != self.expected_len:
+                if self.length > self.expected_len:
+                    raise InvalidPartial('Content length mismatch: {} != {}'.format(self.length, self.expected_len))
+                raise DownloadError('Content length mismatch: {} != {}'.format(self.length, self.expected_len))
+
+            if self._digest_obj is not None:
+                real_digest = base64.b64encode(self._digest_obj.digest())
+                if real_digest != self.digest:
+                    raise DigestError('Digest mismatch: {} != {}'.format(real_digest, self.digest))
+        except Exception:
+            if self.validator is not None:
+                self.validator.kill()
+            raise
+
+        if self.validator is not None:
+            self.validator.wait()
+
+class PipelinedWriter(object):
+    """
+    Write what is read from a file-like object to a PartialDownload on a
+    thread of its own, so that reading the next chunk overlaps with
+    hashing and writing the previous one; hashlib and file writes release
+    the GIL.  Chunks are read into a ring of depth buffers that the two
+    threads hand back and forth through queues.
+    """
+
+    def __init__(self, out, buffer_size, depth):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.depth = depth
+        self._free = Queue.Queue()
+        self._full = Queue.Queue()
+        self._error = None
+
+    def _write(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            chunk, buf = item
+            try:
+                if self._error is None:
+                    self.out.write(chunk)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._free.put(buf)
+
+    def copy(self, fp, transferred=None):
+        """
+        Copy fp to the end, calling transferred(n) for every chunk of n
+        bytes read.
+        """
+        readinto = get_readinto(fp)
+        # Without readinto(), every read() returns a new string and the
+        # ring only limits how many are in flight.
+        for i in range(self.depth):
+            self._free.put(bytearray(self.buffer_size) if readinto is not None else None)
+
+        thread = threading.Thread(target=self._write)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            while self._error is None:
+                buf = self._free.get()
+                if buf is not None:
+                    n = readinto(buf)
+                    chunk = memoryview(buf)[:n]
+                else:
+                    chunk = fp.read(self.buffer_size)
+                    n = len(chunk)
+                if not n:
+                    break
+                if transferred is not None:
+                    transferred(n)
+                self._full.put((chunk, buf))
+        finally:
+            self._full.put(None)
+            thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+class WorkerPool(object):
+    """
+    Run queued calls on 'size' threads of their own, e.g. so that at most
+    that many validator processes run at a time, independently of the
+    download slots.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Let the threads exit once the calls queued so far are done.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+    def submit(self, func, *args):
+        self._queue.put((func, args))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error('Task {} failed: {}'.format(func, str(e)))
+                logger.debug(traceback.format_exc())
+
 class DownloadManager:
-    def __init__(self, max_downloads=4, download_timeout=None, retry_timeout=60):
-        self._pending_downloads = set()
+    def __init__(self, max_downloads=4, download_timeout=None, retry_timeout=60, max_downloads_per_host=None, rate_limit=None,
+            min_downloads=None, control_interval=10, buffer_size=BUFFER_SIZE, preallocate=True, drop_cache=True,
+            pipeline_depth=0, max_validations=None):
+        """
+        'max_downloads_per_host' caps the concurrent downloads from any one
+        host, in addition to the overall 'max_downloads'.  'rate_limit' is
+        the combined download rate in bytes per second, None for no limit;
+        it can be changed later with set_rate_limit().
+
+        If 'min_downloads' is given, the number of concurrent downloads is
+        adjusted between 'min_downloads' and 'max_downloads' every
+        'control_interval' seconds, see ConcurrencyController.
+
+        Every thread reads downloads into a reused buffer of 'buffer_size'
+        bytes.  With a 'pipeline_depth' of 2 or more, a second thread per
+        download hashes and writes what the first reads, through that
+        many buffers, see PipelinedWriter.
+
+        With 'preallocate', disk space is reserved for the announced
+        length of a download before it is written.  With 'drop_cache',
+        downloaded data is written to disk and dropped from the page cache
+        as it comes in, so that downloads do not push out the files being
+        queried.
+
+        With 'max_validations', downloaded files are validated by up to
+        that many validators at a time in a WorkerPool, and the
+        download slot is freed as soon as the transfer is complete.
+        Otherwise each file is validated in its download slot.
+        """
+        self._pending_downloads = PendingDownloads()
         self._active_downloads = dict()
 
+        # Downloads being validated in the validator pool, whose slots have
+        # been released.
+        self._validating = set()
+        self._validator_pool = None
+        if max_validations:
+            self._validator_pool = WorkerPool(max_validations)
+
+        # f -> time at which the failure expires and f may be retried.
+        # _retry_heap orders the same expiries; entries that no longer
+        # match _failed_downloads are stale and skipped.
         self._failed_downloads = dict()
+        self._retry_heap = []
+
+        self._callbacks = list()
 
         self._max_downloads = max_downloads
+        self._controller = None
+        self._slots = max_downloads
+        if min_downloads is not None:
+            self._controller = ConcurrencyController(min_downloads, max_downloads)
+            self._slots = self._controller.slots
+        self._control_interval = control_interval
+        self._transferred_bytes = 0
+        self._completed = 0
+        self._failed = 0
+        self._max_downloads_per_host = max_downloads_per_host
+        self._active_hosts = collections.Counter()
+        self._host_stats = collections.defaultdict(HostStats)
+        self._rate_limiter = TokenBucket(rate_limit)
         self._download_timeout = download_timeout
+        self._buffer_size = buffer_size
+        self._pipeline_depth = pipeline_depth
+        self._preallocate = preallocate
+        self._drop_cache = drop_cache
+        self._buffers = threading.local()
         self._retry_timeout = retry_timeout
         self._lock = threading.RLock()
         
@@ -47,6 +502,41 @@ class DownloadManager:
         self._action_required = threading.Condition()
         self._terminate = threading.Event() 
 
+        # The run loop sleeps in select() on this pipe: a timed wait on a
+        # Condition polls on Python 2.
+        self._wake = WakePipe()
+
+    def add_callback(self, callback):
+        """
+        Register callback(f, error) to be called from the downloading
+        thread after every download attempt.  error is None on success.
+        """
+        self._callbacks.append(callback)
+
+    @property
+    def retry_timeout(self):
+        return self._retry_timeout
+
+    @property
+    def rate_limit(self):
+        return self._rate_limiter.rate
+
+    def set_rate_limit(self, rate):
+        """
+        Change the combined download rate limit, in bytes per second, of
+        all downloads including those in progress.  None or 0 removes it.
+        """
+        logger.info('Setting download rate limit to {}'.format(rate or 'unlimited'))
+        self._rate_limiter.set_rate(rate)
+
+    def host_stats(self):
+        """
+        Return a dict of host -> dict of bytes and seconds transferred,
+        downloads, failures and throughput in bytes per second.
+        """
+        with self._lock:
+            return dict((host, stats.as_dict()) for host, stats in self._host_stats.items())
+
     def start(self):
         logger.debug('Starting DownloadManager {}'.format(self))
         if self._main_thread:
@@ -54,6 +544,8 @@ class DownloadManager:
 
         self._terminate.clear()
 
+        if self._validator_pool is not None:
+            self._validator_pool.start()
         self._main_thread = threading.Thread(target=self._run)
         self._main_thread.setDaemon(True)
         self._main_thread.start()
@@ -61,9 +553,9 @@ class DownloadManager:
     def stop(self, blocking=False, timeout=None):
         logger.debug('Stopping DownloadManager {}'.format(self))
         self._terminate.set()
-        with self._action_required:
-            logger.debug('Notifying all run loops')
-            self._action_required.notifyAll()
+        self._notify()
+        if self._validator_pool is not None:
+            self._validator_pool.stop()
         if blocking or timeout:
             return self.join(timeout=timeout)
 
@@ -73,153 +565,730 @@ class DownloadManager:
 
     def _run(self):
         logger.debug('Running DownloadManager {}'.format(self))
+
+        workers = list()
+        for i in range(self._max_downloads):
+            worker = terminable_thread.Thread(target=self._worker)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        # Expire failed downloads and adjust the concurrency.  Waiting on
+        # the wake pipe with a timeout both sleeps until the earliest expiry
+        # and picks up newly failed downloads, which may expire sooner.
+        next_control = time.time() + self._control_interval
+        last_totals = (0, 0, 0)
         while not self._terminate.is_set():
-            with self._lock:
-                for f,thread in self._active_downloads.items():
-                    if not thread.isAlive():
-                        del self._active_downloads[f]
-                        logger.debug('Joining {}'.format(thread))
-                        thread.join()
-                for f,thread in self._failed_downloads.items():
-                    if not thread.isAlive():
-                        del self._failed_downloads[f]
-                        logger.debug('Joining {}'.format(thread))
-                        thread.join()
+            now = time.time()
+            timeout = self._expire_failed_downloads(now)
+            if self._controller:
+                if now >= next_control:
+                    last_totals = self._control(now - next_control + self._control_interval, last_totals)
+                    next_control = now + self._control_interval
+                timeout = min(timeout, next_control - now) if timeout is not None else next_control - now
+            logger.debug('Waiting DownloadManager {}'.format(self))
+            try:
+                readable = select.select([self._wake], [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                self._wake.drain()
+            logger.debug('Awoken DownloadManager {}'.format(self))
 
-            with self._lock:
-                for f in heapq.nlargest(self._max_downloads - len(self._active_downloads), self._pending_downloads):
-                    self._pending_downloads.remove(f)
+        logger.debug('Completing DownloadManager run {}'.format(self))
+        with self._lock:
+            for f,worker in self._active_downloads.items():
+                if worker.isAlive():
+                    worker.terminate()
+        for worker in workers:
+            worker.join()
+        with self._lock:
+            self._active_downloads.clear()
+            self._active_hosts.clear()
+            self._failed_downloads.clear()
+            del self._retry_heap[:]
 
-                    thread = terminable_thread.Thread(target=self._download, args=(f,))
-                    thread.setDaemon(True)
-                    thread.start()
+    def _notify(self):
+        """
+        Wake the run loop and idle workers to look at the queues again.
+        """
+        with self._action_required:
+            logger.debug('Notifying run loop')
+            self._action_required.notifyAll()
+        self._wake.notify()
 
-                    self._active_downloads[f] = thread
+    def _take_download(self, owner):
+        """
+        Return the next pending download, marked active for owner, or None
+        if there is none or no slot is free.
+        """
+        with self._lock:
+            if len(self._active_downloads) >= self._slots:
+                return None
+            f = self._pending_downloads.pop(self._host_available)
+            if f is not None:
+                self._active_downloads[f] = owner
+                self._add_host_slots(download_host(f), 1)
+            return f
 
+    def _worker(self):
+        while True:
             with self._action_required:
-                logger.debug('Waiting DownloadManager {}'.format(self))
-                self._action_required.wait()
-                logger.debug('Awoken DownloadManager {}'.format(self))
+                while True:
+                    if self._terminate.is_set():
+                        return
+                    f = self._take_download(threading.current_thread())
+                    if f is not None:
+                        break
+                    self._action_required.wait()
+            self._download(f)
 
-        logger.debug('Completing DownloadManager run {}'.format(self))
+    def _control(self, elapsed, last_totals):
+        """
+        Feed the controller with what happened since last_totals and apply
+        its decision.  Returns the current totals.
+        """
         with self._lock:
-            for f,thread in self._active_downloads.items():
-                if thread.isAlive():
-                    thread.terminate()
-                thread.join()
-                del self._active_downloads[f]
-            for f,thread in self._failed_downloads.items():
-                if thread.isAlive():
-                    thread.terminate()
-                thread.join()
-                del self._failed_downloads[f]
-        
+            totals = (self._transferred_bytes, self._completed, self._failed)
+            saturated = len(self._active_downloads) >= self._slots and bool(self._pending_downloads)
+        transferred, completed, failed = (now - last for now, last in zip(totals, last_totals))
+        slots = self._controller.update(transferred / max(elapsed, 1e-3), completed, failed, saturated)
+        with self._lock:
+            self._slots = slots
+        # Idle workers may now take up the new slots.
+        self._notify()
+        return totals
+
+    @property
+    def slots(self):
+        """The current limit on concurrent downloads."""
+        return self._slots
+
+    def _buffer(self):
+        """
+        Return the read buffer of the current thread.
+        """
+        buf = getattr(self._buffers, 'buf', None)
+        if buf is None:
+            buf = self._buffers.buf = bytearray(self._buffer_size)
+        return buf
+
+    def _host_available(self, host):
+        return self._max_downloads_per_host is None or self._active_hosts[host] < self._max_downloads_per_host
+
+    def _transferred(self, f, amount):
+        """
+        Account for amount bytes of f read from the network, waiting as
+        long as the rate limit requires.
+        """
+        self._rate_limiter.consume(amount)
+        self._account(f, amount)
+
+    def _account(self, f, amount):
+        with self._lock:
+            self._host_stats[download_host(f)].bytes += amount
+            self._transferred_bytes += amount
+
+    def _expire_failed_downloads(self, now):
+        """
+        Forget failed downloads whose retry timeout has passed and return the
+        number of seconds until the next one expires, or None.
+        """
+        with self._lock:
+            while self._retry_heap:
+                expiry, f = self._retry_heap[0]
+                if self._failed_downloads.get(f) != expiry:
+                    heapq.heappop(self._retry_heap)
+                elif expiry <= now:
+                    heapq.heappop(self._retry_heap)
+                    del self._failed_downloads[f]
+                    logger.info('Failure timeout for {uri} complete'.format(uri=f.uri))
+                else:
+                    return expiry - now
+        return None
+
     def _download(self, f):
         logger.debug('Downloading {}'.format(f))
+        error = None
+        partial = None
+        handed_off = False
         try:
-            target = f.target()
+            logger.info('Downloading {} to {}'.format(f.uri, f.target()))
 
-            logger.info('Downloading {} to {}'.format(f.uri, target))
+            partial = f.partial()
+            scheme = urlparse.urlsplit(f.uri).scheme
 
-            req = urllib2.Request(f.uri)
-            if f.apikey:
-                req.add_header('X-API-Key', f.apikey)
+            result = None
+            if scheme == 'file':
+                result = self._download_local(f, partial)
+            else:
+                meta, offset = self._resume_point(f, partial)
+                if not offset and f.context.segments > 1 and scheme in ('http', 'https'):
+                    result = self._download_segmented(f, partial)
+            if result is None:
+                result = self._download_stream(f, partial, meta, offset)
+            handed_off = self._complete_download(f, partial, *result)
+        except (KeyboardInterrupt, SystemExit) as e:
+            logger.debug('Re-Raising {}'.format(str(e)))
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            self._download_failed(f, partial, e)
+        finally:
+            if not handed_off:
+                self._download_done(f, error)
+
+    def _resume_point(self, f, partial):
+        """
+        Return the partial metadata and the offset at which a previous
+        download of f into partial can be continued, or (None, 0).
+        """
+        meta = read_partial_meta(partial, f.uri)
+        if meta:
+            try:
+                return meta, os.path.getsize(partial)
+            except OSError:
+                pass
+        return None, 0
+
+    def _complete_download(self, f, partial, headers, algorithm, digest, validated=False):
+        """
+        Turn the completely fetched partial into the target of f: set its
+        mode and mtime, validate it unless it was 'validated' while it was
+        downloaded, and write its digest file.
+
+        With a validator pool, f is validated and installed there and
+        True is returned: its download slot has been released and the
+        pool finishes the download, see _validate().
+        """
+        # The file is complete, there is nothing left to resume.
+        discard_partial_meta(partial)
+
+        # A partial hardlinked from a local source already has the mode
+        # and mtime of the source, which must not be touched.
+        linked = is_linked(partial)
+        if not linked:
+            os.chmod(partial, 0o644)
+
+        mtime_tz = headers.getdate_tz('Last-Modified')
+        if mtime_tz and not linked:
+            mtime = time.mktime(mtime_tz[:-1]) + mtime_tz[-1]
+            logger.debug('Setting mtime of {} to {}'.format(partial, time.ctime(mtime)))
+            os.utime(partial, (mtime, mtime))
+
+        if validated:
+            self._install(f, partial, algorithm, digest)
+            return False
+
+        if self._validator_pool is not None and f.validator:
+            logger.debug('Handing {} over to the validator pool'.format(partial))
+            with self._lock:
+                self._validating.add(f)
+                self._release_slot(f)
+            self._notify()
+            self._validator_pool.submit(self._validate, f, partial, algorithm, digest)
+            return True
+
+        f.validate(partial)
+        self._install(f, partial, algorithm, digest)
+        return False
+
+    def _validate(self, f, partial, algorithm, digest):
+        """
+        Validate and install partial in the validator pool, and finish
+        the download of f.
+        """
+        error = None
+        try:
+            f.validate(partial)
+            self._install(f, partial, algorithm, digest)
+        except Exception as e:
+            error = e
+            self._download_failed(f, partial, e)
+        finally:
+            self._download_done(f, error)
+
+    def _install(self, f, partial, algorithm, digest):
+        """
+        Write the digest file of the validated partial and rename it to the
+        target of f.
+        """
+        target = f.target()
+
+        digest_file = None
+        if algorithm:
+            digest_file = '{}.{}'.format(target, digest_extension(algorithm))
+
+        self._settle(partial)
+
+        if digest_file:
+            logger.debug('Writing digest={} to {}'.format(digest, digest_file))
+            tmp_digest_file = tempfile.NamedTemporaryFile(prefix='.{}.'.format(os.path.basename(digest_file)), dir=f.dname, delete=True)
+            print ('{}  {}'.format(digest.decode('base64').encode('hex'), os.path.basename(target)), file=tmp_digest_file)
+            tmp_digest_file.file.close()
+            os.chmod(tmp_digest_file.name, 0o644)
+            os.rename(tmp_digest_file.name, digest_file)
+            tmp_digest_file.delete = False
+
+        try:
+            logger.debug('Renaming {} to {}'.format(partial, target))
+            os.rename(partial, target)
+        except:
+            try:
+                os.unlink(digest_file)
+            except OSError:
+                pass
+            raise
+
+        logger.info('Download of {} to {} complete'.format(f.uri, target))
+
+    def _settle(self, partial):
+        """
+        Drop the complete partial from the page cache, including what the
+        validator read back in, and log its fragmentation and caching.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if not (self._drop_cache or debug):
+            return
+        fd = os.open(partial, os.O_RDONLY)
+        try:
+            # The pages of a hardlinked partial are those of its source.
+            if self._drop_cache and not is_linked(partial):
+                posix.drop_cache(fd)
+            if debug:
+                extents = posix.extent_count(fd)
+                resident = posix.resident_pages(fd)
+                logger.debug('{} is stored in {} extents, {} of {} pages cached'.format(partial,
+                    'unknown' if extents is None else extents,
+                    *(('unknown', 'unknown') if resident is None else resident)))
+        finally:
+            os.close(fd)
+
+    def _download_failed(self, f, partial, error):
+        logger.error('Download of {} failed: {}'.format(f.uri, str(error)))
+        logger.debug(traceback.format_exc())
+
+        # Only an incomplete but otherwise intact file, with the
+        # metadata needed to resume it, is kept for the next attempt.
+        if partial and (isinstance(error, (InvalidPartial, DigestError, ValidationFailed)) or read_partial_meta(partial, f.uri) is None):
+            try:
+                discard_partial(partial)
+            except OSError as e:
+                logger.error('Could not remove partial download {}: {}'.format(partial, str(e)))
+
+        logger.debug('Waiting {timeout} to retry {uri}'.format(timeout=self._retry_timeout, uri=f.uri))
+        self.add_failed(f, time.time() + self._retry_timeout)
+
+    def add_failed(self, f, expiry):
+        """
+        Hold f back as failed until expiry, e.g. to carry a retry timeout
+        over from before a restart.
+        """
+        with self._lock:
+            self._failed_downloads[f] = expiry
+            heapq.heappush(self._retry_heap, (expiry, f))
+        self._notify()
+
+    def _release_slot(self, f):
+        # Called with self._lock held.
+        if self._active_downloads.pop(f, None) is not None:
+            self._remove_host_slots(download_host(f), 1)
+
+    def _add_host_slots(self, host, count):
+        # Called with self._lock held.
+        if not self._active_hosts[host]:
+            self._host_stats[host].activate(time.time())
+        self._active_hosts[host] += count
+
+    def _remove_host_slots(self, host, count):
+        # Called with self._lock held.
+        self._active_hosts[host] -= count
+        if not self._active_hosts[host]:
+            del self._active_hosts[host]
+            self._host_stats[host].deactivate(time.time())
+
+    def _take_host_slots(self, f, wanted):
+        """
+        Take up to wanted additional slots of the host of f, within
+        max_downloads_per_host, for further connections of an active
+        download.  Returns the number taken.
+        """
+        host = download_host(f)
+        with self._lock:
+            if self._max_downloads_per_host is not None:
+                wanted = min(wanted, self._max_downloads_per_host - self._active_hosts[host])
+            if wanted <= 0:
+                return 0
+            self._add_host_slots(host, wanted)
+            return wanted
+
+    def _release_host_slots(self, f, count):
+        with self._lock:
+            self._remove_host_slots(download_host(f), count)
+        # Other downloads from the host may now take the slots.
+        self._notify()
+
+    def _download_done(self, f, error):
+        """
+        Release the slot of f, unless it was handed over to the validator
+        pool, account for the attempt and run the callbacks.
+        """
+        with self._lock:
+            if f in self._validating:
+                self._validating.discard(f)
+            else:
+                self._release_slot(f)
+            stats = self._host_stats[download_host(f)]
+            if error is None:
+                stats.downloads += 1
+                self._completed += 1
+            else:
+                stats.failures += 1
+                self._failed += 1
+        self._notify()
+        self._run_callbacks(f, error)
+
+    def _request(self, f, request_class=urllib2.Request):
+        req = request_class(f.uri)
+        if f.apikey:
+            req.add_header('X-API-Key', f.apikey)
+        return req
+
+    def _get_digest(self, f, headers, meta=None):
+        """
+        Return the (algorithm, digest) announced for f, or (None, None).
+        """
+        if 'Digest' in headers:
+            algorithm,_,digest = headers['Digest'].partition('=')
+        elif meta and meta.get('digest'):
+            algorithm,_,digest = meta['digest'].partition('=')
+        elif f.digest_required:
+            raise DownloadError('Digest header missing and digest_required=True')
+        else:
+            return None, None
+        return algorithm, digest
+
+    def _download_stream(self, f, partial, meta, offset):
+        """
+        Fetch f into partial in a single request, continuing the first
+        offset bytes already there when the server allows it.  Returns the
+        response headers, the announced digest algorithm and value, and
+        whether the body was validated as it was written.
+        """
+        req = self._request(f)
+        if offset:
+            logger.debug('Resuming {} at offset {}'.format(f.uri, offset))
+            req.add_header('Range', 'bytes={}-'.format(offset))
+            req.add_header('If-Range', meta['etag'] or meta['last_modified'])
+        try:
             fp = urllib2.urlopen(req, timeout=self._download_timeout)
-            out = tempfile.NamedTemporaryFile(prefix='.{}.'.format(f.name), dir=f.dname, delete=True)
-
-            algorithm = None
-            digest = None
-            digest_file = None
-            if 'Digest' in fp.headers:
-                algorithm,_,digest = fp.headers['Digest'].partition('=')
-                digest_file = '{}.{}'.format(target, digest_extension(algorithm))
-            elif f.digest_required:
-                raise DownloadError('Digest header missing and digest_required=True')
-
-            logger.debug('Copying urlopen of {} to {}'.format(f.uri, out.name))
-            for chunk in check_digest(iterfileobj(fp), algorithm, digest):
-                out.write(chunk)
-
-            if 'Content-Length' in fp.headers:
+        except urllib2.HTTPError as e:
+            if e.code == 416:
+                raise InvalidPartial('Range not satisfiable, restarting')
+            raise
+
+        out = self._open_partial(f, partial, meta, offset, fp.getcode(), fp.headers)
+        try:
+            logger.debug('Copying urlopen of {} to {}'.format(f.uri, partial))
+            if self._pipeline_depth > 1:
+                PipelinedWriter(out, self._buffer_size, self._pipeline_depth).copy(fp, lambda n: self._transferred(f, n))
+            else:
+                for chunk in readinto_chunks(fp, self._buffer()):
+                    self._transferred(f, len(chunk))
+                    out.write(chunk)
+        except:
+            out.abort()
+            raise
+        out.close()
+        out.check()
+
+        return fp.info(), out.algorithm, out.digest, out.validator is not None
+
+    def _open_partial(self, f, partial, meta, offset, code, headers, write_behind_wait=True):
+        """
+        Return a PartialDownload for the body of a response with status
+        code and headers to a request for f from offset.  The partial file
+        is continued if the response is 206 and restarted otherwise.
+
+        Without write_behind_wait, writing to the PartialDownload never
+        waits for the disk, see WriteBehind; only closing it does.
+        """
+        if offset and code == 206:
+            content_range = parse_content_range(headers.get('Content-Range'))
+            if not content_range or content_range[0] != offset:
+                raise InvalidPartial('Unexpected Content-Range: {}'.format(headers.get('Content-Range')))
+        else:
+            # A full response, either because nothing was kept or because
+            # the remote file changed and If-Range did not match.
+            if offset:
+                logger.info('Restarting download of {}'.format(f.uri))
+            offset = 0
+            meta = None
+
+        algorithm, digest = self._get_digest(f, headers, meta)
+
+        digest_obj = None
+        validator = None
+        try:
+            if offset:
+                out = open(partial, 'r+b')
+                validator = f.start_validator(partial)
+                if algorithm:
+                    digest_obj = new_digest(algorithm)
+                if digest_obj is not None or validator is not None:
+                    # The digest is checked, and the validator run, over the
+                    # whole file, not only over the resumed part.
+                    for chunk in readinto_chunks(out, self._buffer()):
+                        if digest_obj is not None:
+                            digest_obj.update(chunk)
+                        if validator is not None:
+                            validator.write(chunk)
+                out.seek(offset)
+            else:
+                discard_partial(partial)
+                out = open(partial, 'wb')
+                validator = f.start_validator(partial)
+                meta = dict(
+                    uri=f.uri,
+                    etag=strong_etag(headers.get('ETag')),
+                    last_modified=headers.get('Last-Modified'),
+                    digest=headers.get('Digest'))
+                if meta['etag'] or meta['last_modified']:
+                    write_partial_meta(partial, meta)
+
+            expected_len = None
+            if 'Content-Length' in headers:
                 try:
-                    expected_len = int(fp.headers['Content-Length'])
-                    if out.tell() != expected_len:
-                        raise DownloadError('Content length mismatch: {} != {}'.format(out.tell(), expected_len))
+                    expected_len = offset + int(headers['Content-Length'])
                 except ValueError:
-                    logger.debug('Skipping content length check, invalid header: {}'.format(fp.headers['Content-Length']))
+                    logger.debug('Skipping content length check, invalid header: {}'.format(headers['Content-Length']))
             else:
                 logger.debug('Skipping content length check, header missing')
 
-            out.file.close()
-            os.chmod(out.name, 0o644)
+            if self._preallocate and expected_len is not None:
+                out.flush()
+                posix.fallocate(out.fileno(), offset, expected_len - offset)
+            write_behind = posix.WriteBehind(out, offset, wait=write_behind_wait) if self._drop_cache else None
+        except Exception:
+            if validator is not None:
+                validator.kill()
+            raise
+
+        return PartialDownload(out, algorithm, digest, digest_obj, expected_len, write_behind, validator)
 
-            mtime_tz = fp.info().getdate_tz('Last-Modified')
-            if mtime_tz:
-                mtime = time.mktime(mtime_tz[:-1]) + mtime_tz[-1]
-                logger.debug('Setting mtime of {} to {}'.format(out.name, time.ctime(mtime)))
-                os.utime(out.name, (mtime, mtime))
+    def _download_segmented(self, f, partial):
+        """
+        Fetch f into partial as up to f.context.segments byte ranges in
+        parallel, as many as max_downloads_per_host leaves connections
+        free.  Returns None, before anything is written, if the server
+        does not support ranges, the file is too small to split or no
+        further connection to the host is free.
+        """
+        try:
+            fp = urllib2.urlopen(self._request(f, HeadRequest), timeout=self._download_timeout)
+        except urllib2.HTTPError as e:
+            logger.debug('Not segmenting {}: HEAD failed: {}'.format(f.uri, str(e)))
+            return None
+        fp.close()
+        headers = fp.info()
+
+        try:
+            length = int(headers['Content-Length'])
+        except (KeyError, ValueError):
+            logger.debug('Not segmenting {}: no usable Content-Length'.format(f.uri))
+            return None
+        if headers.get('Accept-Ranges', '').strip().lower() != 'bytes':
+            logger.debug('Not segmenting {}: server does not accept byte ranges'.format(f.uri))
+            return None
+        ranges = split_ranges(length, f.context.segments, f.context.segment_size)
+        if len(ranges) < 2:
+            return None
 
-            f.validate(out.name)
+        # Every range must come from the same version of the file.
+        validator = strong_etag(headers.get('ETag')) or headers.get('Last-Modified')
+        if not validator:
+            logger.debug('Not segmenting {}: no ETag or Last-Modified'.format(f.uri))
+            return None
 
-            if digest_file:
-                logger.debug('Writing digest={} to {}'.format(digest, digest_file))
-                tmp_digest_file = tempfile.NamedTemporaryFile(prefix='.{}.'.format(os.path.basename(digest_file)), dir=f.dname, delete=True)
-                print ('{}  {}'.format(digest.decode('base64').encode('hex'), os.path.basename(target)), file=tmp_digest_file)
-                tmp_digest_file.file.close()
-                os.chmod(tmp_digest_file.name, 0o644)
-                os.rename(tmp_digest_file.name, digest_file)
-                tmp_digest_file.delete = False
+        # The download slot of f covers one connection, every further
+        # segment takes another slot of the host.
+        extra = self._take_host_slots(f, len(ranges) - 1)
+        if not extra:
+            logger.debug('Not segmenting {}: no free connections to its host'.format(f.uri))
+            return None
 
+        errors = []
+        try:
+            ranges = split_ranges(length, extra + 1, f.context.segment_size)
+            algorithm, digest = self._get_digest(f, headers)
+
+            logger.debug('Downloading {} in {} segments'.format(f.uri, len(ranges)))
+            discard_partial(partial)
+            with open(partial, 'wb') as out:
+                if self._preallocate:
+                    posix.fallocate(out.fileno(), 0, length)
+                out.truncate(length)
+
+            abort = threading.Event()
+            threads = []
             try:
-                logger.debug('Renaming {} to {}'.format(out.name, target))
-                os.rename(out.name, target)
-                out.delete = False
-            except:
+                for first, last in ranges:
+                    thread = threading.Thread(target=self._download_segment, args=(f, partial, first, last, validator, abort, errors))
+                    thread.setDaemon(True)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            finally:
+                # Stop the remaining segments if this download is terminated.
+                abort.set()
+        finally:
+            self._release_host_slots(f, extra)
+        if errors:
+            raise errors[0]
+
+        if algorithm:
+            with open(partial, 'rb') as fp:
+                for chunk in check_digest(readinto_chunks(fp, self._buffer()), algorithm, digest):
+                    pass
+
+        return headers, algorithm, digest, False
+
+    def _download_local(self, f, partial):
+        """
+        Fetch f from a file:// uri into partial without reading it through
+        Python: hardlink it if it is on the same file system, reflink it on
+        a copy-on-write file system, or else copy it in the kernel.  The
+        digest file next to the source takes the place of the Digest
+        header.
+        """
+        source = urllib.url2pathname(urlparse.urlsplit(f.uri).path)
+
+        recorded = read_digest_file(source)
+        if recorded:
+            algorithm = recorded[0]
+            digest = base64.b64encode(recorded[1].decode('hex'))
+        elif f.digest_required:
+            raise DownloadError('Digest file missing and digest_required=True')
+        else:
+            algorithm, digest = None, None
+
+        discard_partial(partial)
+        with open(source, 'rb') as src:
+            st = os.fstat(src.fileno())
+            method = None
+            # Only a source that already has the mode of an installed file
+            # is shared, since the partial is not changed once linked.
+            if stat.S_IMODE(st.st_mode) == 0o644:
                 try:
-                    os.unlink(digest_file)
-                except OSError:
+                    os.link(source, partial)
+                    method = 'hardlink'
+                except OSError as e:
+                    logger.debug('Not hardlinking {}: {}'.format(source, str(e)))
+            else:
+                logger.debug('Not hardlinking {}: Mode is {:o}'.format(source, stat.S_IMODE(st.st_mode)))
+            if method is None:
+                method = self._copy_local(src, partial, st.st_size)
+                self._account(f, st.st_size)
+        logger.debug('Fetched {} to {} by {}'.format(source, partial, method))
+
+        if algorithm:
+            with open(partial, 'rb') as fp:
+                for chunk in check_digest(readinto_chunks(fp, self._buffer()), algorithm, digest):
                     pass
-                raise
 
-            logger.info('Download of {} to {} complete'.format(f.uri, target))
-        except (KeyboardInterrupt, SystemExit) as e:
-            logger.debug('Re-Raising {}'.format(str(e)))
-            raise
+        headers = 'Last-Modified: {}'.format(email.utils.formatdate(st.st_mtime, usegmt=True))
+        return httplib.HTTPMessage(StringIO(headers)), algorithm, digest, False
+
+    def _copy_local(self, src, partial, length):
+        """
+        Copy length bytes of the open file src to a new partial, and return
+        how it was done.
+        """
+        with open(partial, 'wb') as out:
+            if posix.reflink(src.fileno(), out.fileno()):
+                return 'reflink'
+            copied = posix.copy_range(src.fileno(), out.fileno(), length)
+            method = 'in-kernel copy'
+            if copied is None:
+                copied = 0
+                method = 'read'
+                for chunk in readinto_chunks(src, self._buffer()):
+                    out.write(chunk)
+                    copied += len(chunk)
+        if copied != length:
+            raise DownloadError('Content length mismatch: {} != {}'.format(copied, length))
+        return method
+
+    def _download_segment(self, f, partial, first, last, validator, abort, errors):
+        try:
+            req = self._request(f)
+            req.add_header('Range', 'bytes={}-{}'.format(first, last))
+            req.add_header('If-Range', validator)
+            fp = urllib2.urlopen(req, timeout=self._download_timeout)
+
+            content_range = parse_content_range(fp.headers.get('Content-Range'))
+            if fp.getcode() != 206 or not content_range or content_range[:2] != (first, last):
+                raise DownloadError('Unexpected response for bytes {}-{} of {}: {} {}'.format(
+                    first, last, f.uri, fp.getcode(), fp.headers.get('Content-Range')))
+
+            # Python 2 has no os.pwrite(); each segment seeks in its own
+            # descriptor instead.
+            fd = os.open(partial, os.O_WRONLY)
+            try:
+                os.lseek(fd, first, os.SEEK_SET)
+                position = first
+                for chunk in readinto_chunks(fp, self._buffer()):
+                    if abort.is_set():
+                        return
+                    self._transferred(f, len(chunk))
+                    if position + len(chunk) > last + 1:
+                        raise DownloadError('Segment {}-{} of {} too long'.format(first, last, f.uri))
+                    while chunk:
+                        written = os.write(fd, chunk)
+                        chunk = chunk[written:]
+                        position += written
+            finally:
+                os.close(fd)
+
+            if position != last + 1:
+                raise DownloadError('Segment {}-{} of {} incomplete: {} bytes'.format(first, last, f.uri, position - first))
         except Exception as e:
-            logger.error('Download of {} failed: {}'.format(f.uri, str(e)))
             logger.debug(traceback.format_exc())
+            errors.append(e)
+            abort.set()
 
-            expire_thread = terminable_thread.Thread(target=self._expire_failed_download, args=(f,))
-            expire_thread.setDaemon(True)
-            expire_thread.start()
-            with self._lock:
-                self._failed_downloads[f] = expire_thread
-        finally:
-            with self._action_required:
-                logger.debug('Notifying run loop')
-                self._action_required.notify()
-
-    def _expire_failed_download(self, f, timeout=None):
-        if timeout is None:
-            timeout = self._retry_timeout
-        logger.debug('Waiting {timeout} to retry {uri}'.format(timeout=timeout, uri=f.uri))
-        time.sleep(timeout)
-        logger.info('Failure timeout for {uri} complete'.format(uri=f.uri))
-        with self._action_required:
-            logger.debug('Notifying run loop')
-            self._action_required.notify()
+    def _run_callbacks(self, f, error):
+        for callback in self._callbacks:
+            try:
+                callback(f, error)
+            except Exception as e:
+                logger.error('Download callback {} failed: {}'.format(callback, str(e)))
+                logger.debug(traceback.format_exc())
 
     def __contains__(self, filename):
         with self._lock:
-            return filename in self._pending_downloads or filename in self._active_downloads or filename in self._failed_downloads
+            return (filename in self._pending_downloads or filename in self._active_downloads or
+                    filename in self._validating or filename in self._failed_downloads)
 
     def enqueue(self, f):
         logger.info('Enqueuing {}'.format(os.path.basename(f.name)))
 
         with self._lock:
-            self._pending_downloads.add(f)
+            self._pending_downloads.push(f)
 
-        with self._action_required:
-            logger.debug('Notifying run loop')
-            self._action_required.notify()
+        self._notify()
 
+    def cancel(self, f):
+        """
+        Drop f from the pending downloads.  Returns False if f was not
+        pending; active downloads are not interrupted.
+        """
+        with self._lock:
+            if not self._pending_downloads.remove(f):
+                return False
+        logger.info('Cancelled download of {}'.format(os.path.basename(f.name)))
+        return True
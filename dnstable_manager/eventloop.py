@@ -0,0 +1,523 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from cStringIO import StringIO
+import errno
+import httplib
+import logging
+import math
+import os
+import select
+import socket
+import threading
+import time
+import traceback
+import urllib
+import urllib2
+import urlparse
+
+from . import https
+from .download import DownloadError, DownloadManager, WorkerPool
+from .https import ssl
+import terminable_thread
+
+logger = logging.getLogger(__name__)
+
+# Threads opening the partial files of the transfers on the loop.
+DISK_WORKERS = 2
+
+class Handoff(Exception):
+    """
+    Raised when a response needs more of urllib2 than the event loop
+    implements (redirects, authentication), before anything is written.
+    """
+    pass
+
+class Transfer(object):
+    """
+    A download of one file over a non-blocking HTTP/1.0 connection, advanced
+    by EventLoopDownloadManager whenever its socket is ready.  While its
+    partial file is OPENING on a disk worker, the socket is left alone.
+    """
+
+    CONNECTING, HANDSHAKE, SENDING, HEADERS, OPENING, BODY = range(6)
+
+    def __init__(self, f, partial):
+        self.f = f
+        self.partial = partial
+
+        self.state = self.CONNECTING
+        self.sock = None
+        self.host = None
+        self.tls = False
+        self.handshake_start = None
+        self.want_write = True
+        self.outbuf = ''
+        self.inbuf = ''
+        self.pending = ''
+        self.headers = None
+        self.out = None
+        self.deadline = None
+        self.paused_until = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        if self.out is not None:
+            self.out.abort()
+
+class EventLoopDownloadManager(DownloadManager):
+    """
+    DownloadManager that runs all plain HTTP and HTTPS downloads on the
+    thread of its run loop, multiplexing their sockets with poll().
+
+    Downloads it cannot handle itself are each given a thread running the
+    regular urllib2 code: other URI schemes, segmented downloads, proxied
+    requests, responses that redirect or ask for authentication, and
+    resumed downloads, whose digest is first computed over what was
+    already downloaded.  So are the final steps of every download
+    (validation, digest file, rename), which may take a while.
+
+    Opening and preallocating partial files is done on a few disk workers,
+    and writes from the loop only start write-behind without waiting for
+    the disk, so that a slow disk does not stall every transfer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        DownloadManager.__init__(self, *args, **kwargs)
+        self._transfers = dict()
+        self._threads = set()
+        self._disk_pool = WorkerPool(DISK_WORKERS)
+        # (transfer, PartialDownload, error) opened by the disk workers.
+        self._opened = collections.deque()
+
+    def start(self):
+        DownloadManager.start(self)
+        self._disk_pool.start()
+
+    def stop(self, blocking=False, timeout=None):
+        self._disk_pool.stop()
+        return DownloadManager.stop(self, blocking=blocking, timeout=timeout)
+
+    def _run(self):
+        logger.debug('Running EventLoopDownloadManager {}'.format(self))
+
+        next_control = time.time() + self._control_interval
+        last_totals = (0, 0, 0)
+        while not self._terminate.is_set():
+            try:
+                next_control, last_totals = self._iterate(next_control, last_totals)
+            except Exception as e:
+                # The transfers may have been left in any state; fail them
+                # rather than the loop, which every queued download needs.
+                logger.error('Event loop of {} failed: {}'.format(self, str(e)))
+                logger.debug(traceback.format_exc())
+                for transfer in self._transfers.values():
+                    try:
+                        self._fail(transfer, e)
+                    except Exception:
+                        logger.debug(traceback.format_exc())
+                        self._transfers.pop(transfer.f, None)
+
+        logger.debug('Completing EventLoopDownloadManager run {}'.format(self))
+        # Partial files of interrupted transfers are kept to be resumed.
+        for transfer in self._transfers.values():
+            transfer.close()
+        self._transfers.clear()
+        # Disk workers finishing from now on close what they opened.
+        with self._lock:
+            opened = list(self._opened)
+            self._opened.clear()
+        for transfer, out, error in opened:
+            if out is not None:
+                out.abort()
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            if thread.isAlive():
+                thread.terminate()
+        for thread in threads:
+            thread.join()
+        with self._lock:
+            self._threads.clear()
+            self._active_downloads.clear()
+            self._active_hosts.clear()
+            self._failed_downloads.clear()
+            del self._retry_heap[:]
+
+    def _iterate(self, next_control, last_totals):
+        """
+        Start what can be started, wait for any socket to be ready and
+        advance its transfer.  Returns the updated next_control and
+        last_totals of the control loop.
+        """
+        now = time.time()
+        timeout = self._expire_failed_downloads(now)
+        if self._controller:
+            if now >= next_control:
+                last_totals = self._control(now - next_control + self._control_interval, last_totals)
+                next_control = now + self._control_interval
+            timeout = min(timeout, next_control - now) if timeout is not None else next_control - now
+
+        while True:
+            f = self._take_download(threading.current_thread())
+            if f is None:
+                break
+            self._begin(f, now)
+
+        while self._opened:
+            self._opened_transfer(*self._opened.popleft())
+
+        # poll() rather than select(), which cannot take descriptors
+        # above FD_SETSIZE.
+        poller = select.poll()
+        poller.register(self._wake, select.POLLIN)
+        polled = dict()
+        for transfer in self._transfers.values():
+            if transfer.state == Transfer.OPENING:
+                continue
+            if transfer.paused_until is not None:
+                if transfer.paused_until > now:
+                    timeout = min(timeout, transfer.paused_until - now) if timeout is not None else transfer.paused_until - now
+                    continue
+                transfer.paused_until = None
+                self._touch(transfer, now)
+            fd = transfer.fileno()
+            poller.register(fd, select.POLLOUT if transfer.want_write else select.POLLIN)
+            polled[fd] = transfer
+            if transfer.deadline is not None:
+                timeout = max(0, min(timeout, transfer.deadline - now) if timeout is not None else transfer.deadline - now)
+
+        try:
+            events = poller.poll(None if timeout is None else int(math.ceil(timeout * 1000)))
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return next_control, last_totals
+            raise
+
+        # Errors and hangups are reported whatever was asked for; advancing
+        # the transfer runs into them.
+        ready = set()
+        for fd, _ in events:
+            if fd == self._wake.fileno():
+                self._wake.drain()
+            elif fd in polled:
+                ready.add(polled[fd])
+
+        now = time.time()
+        for transfer in self._transfers.values():
+            if transfer in ready:
+                self._advance(transfer, now)
+            elif transfer.deadline is not None and transfer.deadline <= now and transfer.paused_until is None:
+                self._fail(transfer, socket.timeout('timed out'))
+        return next_control, last_totals
+
+    def _spawn(self, f, target, *args):
+        """
+        Run target(*args) in a thread that holds the download slot of f.
+        """
+        def run():
+            try:
+                target(*args)
+            finally:
+                with self._lock:
+                    self._threads.discard(thread)
+        thread = terminable_thread.Thread(target=run)
+        thread.setDaemon(True)
+        with self._lock:
+            self._threads.add(thread)
+            self._active_downloads[f] = thread
+        thread.start()
+
+    def _handles(self, f):
+        scheme = urlparse.urlsplit(f.uri).scheme
+        if scheme not in ('http', 'https'):
+            return False
+        if f.context.segments > 1 or scheme in urllib.getproxies():
+            return False
+        # Writes to a validator's stdin could block the loop.
+        if f.validator and f.validator_stdin:
+            return False
+        return scheme == 'http' or https.get_context() is not None
+
+    def _begin(self, f, now):
+        # Hashing the part of a resumed download that is already there
+        # would stall every other transfer.
+        if not self._handles(f) or self._resume_point(f, f.partial())[1]:
+            self._spawn(f, self._download, f)
+            return
+
+        logger.debug('Downloading {}'.format(f))
+        partial = None
+        try:
+            logger.info('Downloading {} to {}'.format(f.uri, f.target()))
+            partial = f.partial()
+            transfer = Transfer(f, partial)
+            self._transfers[f] = transfer
+            self._connect(transfer, now)
+        except Exception as e:
+            self._transfers.pop(f, None)
+            self._download_failed(f, partial, e)
+            self._download_done(f, e)
+
+    def _connect(self, transfer, now):
+        f = transfer.f
+        parts = urlparse.urlsplit(f.uri)
+        transfer.tls = parts.scheme == 'https'
+        transfer.host = parts.hostname
+        port = parts.port or (httplib.HTTPS_PORT if transfer.tls else httplib.HTTP_PORT)
+
+        selector = parts.path or '/'
+        if parts.query:
+            selector = '{}?{}'.format(selector, parts.query)
+        headers = [
+            ('Host', parts.netloc),
+            ('User-Agent', 'Python-urllib/{}'.format(urllib2.__version__)),
+            ('Connection', 'close'),
+        ]
+        if f.apikey:
+            headers.append(('X-API-Key', f.apikey))
+        transfer.outbuf = 'GET {} HTTP/1.0\r\n{}\r\n\r\n'.format(selector,
+                '\r\n'.join('{}: {}'.format(k, v) for k, v in headers))
+
+        # Name resolution still blocks; it is normally answered from a
+        # local cache.
+        family, socktype, proto, _, address = socket.getaddrinfo(transfer.host, port, 0, socket.SOCK_STREAM)[0]
+        transfer.sock = socket.socket(family, socktype, proto)
+        transfer.sock.setblocking(0)
+        self._touch(transfer, now)
+        err = transfer.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            raise socket.error(err, os.strerror(err))
+
+    def _touch(self, transfer, now):
+        if self._download_timeout:
+            transfer.deadline = now + self._download_timeout
+
+    def _advance(self, transfer, now):
+        try:
+            self._touch(transfer, now)
+            if transfer.state == Transfer.CONNECTING:
+                err = transfer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, os.strerror(err))
+                if transfer.tls:
+                    transfer.sock = https.get_context().wrap_socket(transfer.sock,
+                            server_hostname=transfer.host, do_handshake_on_connect=False)
+                    transfer.handshake_start = now
+                    transfer.state = Transfer.HANDSHAKE
+                else:
+                    transfer.state = Transfer.SENDING
+            if transfer.state == Transfer.HANDSHAKE:
+                self._handshake(transfer)
+            if transfer.state == Transfer.SENDING:
+                self._send(transfer)
+            if transfer.state in (Transfer.HEADERS, Transfer.BODY):
+                self._receive(transfer)
+        except ssl.SSLWantReadError:
+            transfer.want_write = False
+        except ssl.SSLWantWriteError:
+            transfer.want_write = True
+        except Handoff as e:
+            logger.debug('Handing {} over to urllib2: {}'.format(transfer.f.uri, str(e)))
+            transfer.close()
+            del self._transfers[transfer.f]
+            self._spawn(transfer.f, self._download, transfer.f)
+        except Exception as e:
+            self._fail(transfer, e)
+
+    def _handshake(self, transfer):
+        transfer.sock.do_handshake()
+        elapsed = time.time() - transfer.handshake_start
+        https.handshake_stats.record(elapsed)
+        logger.debug('TLS handshake with {} took {:.3f}s'.format(transfer.host, elapsed))
+        transfer.state = Transfer.SENDING
+
+    def _send(self, transfer):
+        transfer.want_write = True
+        while transfer.outbuf:
+            try:
+                sent = transfer.sock.send(transfer.outbuf)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            transfer.outbuf = transfer.outbuf[sent:]
+        transfer.want_write = False
+        transfer.state = Transfer.HEADERS
+
+    def _receive(self, transfer):
+        transfer.want_write = False
+        buf = self._buffer()
+        view = memoryview(buf)
+        while True:
+            try:
+                n = transfer.sock.recv_into(buf)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not n:
+                self._finish(transfer)
+                return
+
+            # The body goes from the buffer to the digest and the file
+            # without being copied.
+            data = view[:n]
+            if transfer.state == Transfer.HEADERS:
+                transfer.inbuf += data.tobytes()
+                head, sep, data = transfer.inbuf.partition('\r\n\r\n')
+                if not sep:
+                    continue
+                transfer.inbuf = ''
+                self._headers(transfer, head)
+                # The body is not read any further until the partial file
+                # is open.
+                transfer.pending = data
+                return
+
+            if data:
+                self._write(transfer, data)
+            if transfer.out.complete:
+                self._finish(transfer)
+                return
+            # TLS records may be buffered in the SSL object, where select()
+            # does not see them.
+            if transfer.paused_until is not None or not (transfer.tls and transfer.sock.pending()):
+                return
+
+    def _headers(self, transfer, head):
+        f = transfer.f
+        status, _, header_lines = head.partition('\r\n')
+        version, _, rest = status.partition(' ')
+        code, _, reason = rest.partition(' ')
+        if not version.startswith('HTTP/'):
+            raise httplib.BadStatusLine(status)
+        try:
+            code = int(code)
+        except ValueError:
+            raise httplib.BadStatusLine(status)
+        headers = httplib.HTTPMessage(StringIO(header_lines + '\r\n\r\n'))
+        transfer.headers = headers
+
+        if code in (301, 302, 303, 307, 308, 401, 407):
+            raise Handoff('HTTP {} {}'.format(code, reason))
+        if not 200 <= code < 300:
+            raise urllib2.HTTPError(f.uri, code, reason, headers, None)
+
+        transfer.state = Transfer.OPENING
+        transfer.deadline = None
+        self._disk_pool.submit(self._open_transfer, transfer, code, headers)
+
+    def _open_transfer(self, transfer, code, headers):
+        """
+        Open the partial file of transfer on a disk worker: discarding an
+        old partial, preallocating and starting the validator may block.
+        """
+        out = None
+        error = None
+        try:
+            out = self._open_partial(transfer.f, transfer.partial, None, 0, code, headers, write_behind_wait=False)
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            error = e
+        with self._lock:
+            if not self._terminate.is_set():
+                self._opened.append((transfer, out, error))
+                out = None
+        if out is not None:
+            out.abort()
+        self._notify()
+
+    def _opened_transfer(self, transfer, out, error):
+        """
+        Go on with the body of transfer once its partial file is open.
+        """
+        if self._transfers.get(transfer.f) is not transfer:
+            # Failed while it was being opened.
+            if out is not None:
+                out.abort()
+            return
+        if error is not None:
+            self._fail(transfer, error)
+            return
+
+        transfer.out = out
+        transfer.state = Transfer.BODY
+        self._touch(transfer, time.time())
+        data, transfer.pending = transfer.pending, ''
+        try:
+            if data:
+                self._write(transfer, data)
+            if transfer.out.complete:
+                self._finish(transfer)
+                return
+        except Exception as e:
+            self._fail(transfer, e)
+            return
+        # TLS records buffered in the SSL object in the meantime are not
+        # seen by poll().
+        if transfer.paused_until is None:
+            self._advance(transfer, time.time())
+
+    def _write(self, transfer, data):
+        transfer.out.write(data)
+        self._account(transfer.f, len(data))
+        delay = self._rate_limiter.reserve(len(data))
+        if delay > 0:
+            transfer.paused_until = time.time() + delay
+
+    def _finish(self, transfer):
+        """
+        Hand the downloaded body of transfer over to a thread for the
+        final steps.
+        """
+        if transfer.out is None:
+            self._fail(transfer, DownloadError('Connection closed before the end of the response headers'))
+            return
+        # Closing the file waits for it to be written to disk, which is
+        # left to the thread.
+        transfer.sock.close()
+        del self._transfers[transfer.f]
+        self._spawn(transfer.f, self._complete_transfer, transfer)
+
+    def _complete_transfer(self, transfer):
+        error = None
+        handed_off = False
+        try:
+            transfer.out.close()
+            transfer.out.check()
+            handed_off = self._complete_download(transfer.f, transfer.partial, transfer.headers,
+                    transfer.out.algorithm, transfer.out.digest)
+        except (KeyboardInterrupt, SystemExit) as e:
+            logger.debug('Re-Raising {}'.format(str(e)))
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            self._download_failed(transfer.f, transfer.partial, e)
+        finally:
+            if not handed_off:
+                self._download_done(transfer.f, error)
+
+    def _fail(self, transfer, error):
+        transfer.close()
+        del self._transfers[transfer.f]
+        self._download_failed(transfer.f, transfer.partial, error)
+        self._download_done(transfer.f, error)
+
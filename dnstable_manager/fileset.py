@@ -14,22 +14,49 @@
 
 from __future__ import print_function
 import calendar
+import collections
 import datetime
 import errno
 import glob
+import heapq
 import logging
 import os
 import subprocess
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
 
 from .digest import DigestError, check_digest, DIGEST_EXTENSIONS
+from .inotify import DirectoryWatcher
+from .util import memoize
 
 logger = logging.getLogger(__name__)
 disable_unlink = False
 
+# Upper bound on the number of memoized parse_filename() results.
+FILENAME_CACHE_SIZE = 1 << 18
+
+# How often, in seconds, the destination directory is rescanned when it
+# cannot be watched with inotify.
+LOCAL_POLL_INTERVAL = 1
+
+# Incomplete downloads are kept as .<name>.partial next to their target,
+# together with .<name>.partial.meta describing how to resume them.
+PARTIAL_SUFFIX = '.partial'
+META_SUFFIX = '.meta'
+
+# Local files that failed an audit are kept as .<name>.quarantine, and
+# their digest files as .<name>.<extension>.quarantine.
+QUARANTINE_SUFFIX = '.quarantine'
+
+# Lines at the end of a failed validator's stderr given in the error.
+VALIDATOR_STDERR_LINES = 100
+
+# Default minimum size of each byte range of a segmented download.
+SEGMENT_SIZE = 64 << 20
+
 class FilesetError(Exception): pass
 
 class ParseError(FilesetError): pass
@@ -53,15 +80,70 @@ def parse_datetime(s):
     datetime.datetime(2006, 1, 1, 0, 0)
     >>>
     """
-    fmt_times = ((13, '%Y%m%d.%H%M'), (8, '%Y%m%d'), (6, '%Y%m'), (4, '%Y'))
-    for len_fmt, fmt in fmt_times:
-        try:
-            if len(s) == len_fmt:
-                return datetime.datetime.utcfromtimestamp(calendar.timegm(time.strptime(s, fmt)))
-        except ValueError:
-            pass
+    n = len(s)
+    try:
+        if n == 13:
+            if s[8] == '.' and s[:8].isdigit() and s[9:].isdigit():
+                return datetime.datetime(int(s[0:4]), int(s[4:6]), int(s[6:8]), int(s[9:11]), int(s[11:13]))
+        elif n in (4, 6, 8) and s.isdigit():
+            return datetime.datetime(int(s[0:4]), int(s[4:6] or 1), int(s[6:8] or 1))
+    except ValueError:
+        pass
     raise ParseError("Time data '{}' does not match any of the time formats".format(s))
 
+@memoize(FILENAME_CACHE_SIZE)
+def parse_filename(name):
+    """
+    Parse a fileset filename of the form 'base.YYYYMMDD[.HHMM].T.ext' and
+    return a (time letter, datetime, sort key) tuple.  The sort key is an
+    integer that orders files by time letter, coarsest first, then by time.
+    Results are memoized so that rescanning an unchanged directory does not
+    parse any name twice.
+
+    >>> parse_filename('dns.20060102.1500.H.mtbl')
+    ('H', datetime.datetime(2006, 1, 2, 15, 0), 5498694352880)
+    >>>
+    """
+    parts = os.path.basename(name).split('.')
+    if len(parts) < 2:
+        raise ParseError('Unable to parse time letter from file name {}'.format(name))
+
+    tl = parts[-2]
+    if not tl in File._tl_rank:
+        raise ParseError('Time letter {} not in valid set {}'.format(tl, File._valid_tl))
+
+    # Strip off the leading filename component and the two trailing filename components.
+    # E.g., 'dns.20060102.1500.H.mtbl' -> '20060102.1500'
+    # E.g., 'dns.2006.Y.mtbl' -> '2006'
+    try:
+        dt = parse_datetime('.'.join(parts[1:-2]))
+    except ParseError as e:
+        raise ParseError('Unable to extract datetime from filename {}: {}'.format(os.path.basename(name), e))
+
+    return tl, dt, (File._tl_rank[tl] << 40) + calendar.timegm(dt.utctimetuple())
+
+def discard_partial(partial):
+    """
+    Remove a partial download and its metadata, if they exist.
+    """
+    discard_partial_meta(partial)
+    try:
+        os.unlink(partial)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def discard_partial_meta(partial):
+    """
+    Remove the metadata of a partial download, so that it is no longer
+    resumed.
+    """
+    try:
+        os.unlink(partial + META_SUFFIX)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
 def relative_uri(uri, fn):
     path,query = urllib.splitquery(uri)
     path,attrs = urllib.splitattr(path)
@@ -76,160 +158,169 @@ def relative_uri(uri, fn):
         new_uri = '{};{}'.format(new_uri, ';'.join(attrs))
     return new_uri
 
+# Bucket key functions for each time letter.  _OVERLAP_KEYS[tl][0] returns
+# the key a file of granularity tl is indexed under; _OVERLAP_KEYS[tl][1]
+# returns the key of the tl-granularity bucket that would contain an
+# arbitrary (finer) datetime.
+_OVERLAP_KEYS = {
+    'Y': (lambda dt: dt.year,
+          lambda dt: dt.year),
+    'Q': (lambda dt: (dt.year, dt.month),
+          lambda dt: (dt.year, int((dt.month-1) / 3) * 3 + 1)),
+    'M': (lambda dt: (dt.year, dt.month),
+          lambda dt: (dt.year, dt.month)),
+    'W': (lambda dt: (dt.year, dt.month, dt.day),
+          lambda dt: (dt.year, dt.month, int((dt.day-1) / 7) * 7 + 1)),
+    'D': (lambda dt: (dt.year, dt.month, dt.day),
+          lambda dt: (dt.year, dt.month, dt.day)),
+    'H': (lambda dt: (dt.year, dt.month, dt.day, dt.hour),
+          lambda dt: (dt.year, dt.month, dt.day, dt.hour)),
+    'X': (lambda dt: (dt.year, dt.month, dt.day, dt.hour, dt.minute),
+          lambda dt: (dt.year, dt.month, dt.day, dt.hour, int(dt.minute / 10) * 10)),
+}
+
 def compute_overlap(files):
-    years = set()
-    quarters = set()
-    months = set()
-    weeks = set()
-    days = set()
-    hours = set()
-    decaminutes = set()
-
-    # Helper functions year_overlap(), month_overlap(), and day_overlap()
-    # that check if their timestamp parameter is overlapped by a year,
-    # month, or day timestamp.
-    def year_overlap(dt):
-        for y in years:
-            if dt.year == y.year:
-                return True
-        return False
-
-    def quarter_overlap(dt):
-        if year_overlap(dt):
-            return True
-        dt_q = int((dt.month-1) / 3) * 3 + 1
-        for q in quarters:
-            if dt.year == q.year and dt_q == q.month:
-                return True
-        return False
-
-    def month_overlap(dt):
-        if quarter_overlap(dt):
-            return True
-        for m in months:
-            if dt.year == m.year and dt.month == m.month:
-                return True
-        return False
-
-    def week_overlap(dt):
-        if month_overlap(dt):
-            return True
-        dt_wd = int((dt.day-1) / 7) * 7 + 1
-        for w in weeks:
-            if dt.year == w.year and dt.month == w.month and dt_wd == w.day:
-                return True
-        return False
-
-    def day_overlap(dt):
-        if week_overlap(dt):
-            return True
-        for d in days:
-            if dt.year == d.year and dt.month == d.month and dt.day == d.day:
-                return True
-        return False
-
-    def hour_overlap(dt):
-        if day_overlap(dt):
-            return True
-        for h in hours:
-            if dt.year == h.year and dt.month == h.month and dt.day == h.day and dt.hour == h.hour:
-                return True
-        return False
-
-    def decaminute_overlap(dt):
-        if hour_overlap(dt):
-            return True
-        dt_dm = int(dt.minute / 10) * 10
-        for d in decaminutes:
-            if dt.year == d.year and dt.month == d.month and dt.day == d.day and dt.hour == d.hour and dt_dm == d.minute:
-                return True
-        return False
-
-    for f in sorted(files):
-        if f.tl == 'Y':
-            years.add(f.datetime)
-        elif f.tl == 'M':
-            if year_overlap(f.datetime):
-                yield f
-            else:
-                months.add(f.datetime)
-        elif f.tl == 'M':
-            if quarter_overlap(f.datetime):
-                yield f
-            else:
-                months.add(f.datetime)
-        elif f.tl == 'W':
-            if month_overlap(f.datetime):
-                yield f
-            else:
-                weeks.add(f.datetime)
-        elif f.tl == 'D':
-            if week_overlap(f.datetime):
-                yield f
-            else:
-                days.add(f.datetime)
-        elif f.tl == 'H':
-            if day_overlap(f.datetime):
-                yield f
-            else:
-                hours.add(f.datetime)
-        elif f.tl == 'X':
-            if hour_overlap(f.datetime):
-                yield f
+    """
+    Yield every file in 'files' whose time span is covered by a coarser
+    file that is itself not covered.
+
+    Files are indexed into one hashed bucket set per time letter, coarsest
+    first, so each membership test is O(1) and the whole pass is linear in
+    the number of files.
+    """
+    by_tl = dict((tl, []) for tl in File._valid_tl)
+    for f in files:
+        by_tl[f.tl].append(f)
+
+    # (lookup function, bucket set) for each coarser time letter seen so far.
+    coarser = []
+    for tl in File._valid_tl:
+        if not by_tl[tl]:
+            continue
+
+        bucket = set()
+        for f in by_tl[tl]:
+            dt = f.datetime
+            for lookup, keys in coarser:
+                if lookup(dt) in keys:
+                    yield f
+                    break
             else:
-                decaminutes.add(f.datetime)
-        elif f.tl == 'm':
-            if decaminute_overlap(f.datetime):
-                yield f
+                if tl in _OVERLAP_KEYS:
+                    bucket.add(_OVERLAP_KEYS[tl][0](dt))
 
-class File(object):
+        if tl in _OVERLAP_KEYS:
+            coarser.append((_OVERLAP_KEYS[tl][1], bucket))
+
+class FilesetContext(object):
     """
-    Helper class for Fileset which wraps the parsing of Y/M/D/H filenames.
+    Settings shared by every File belonging to one Fileset.
     """
 
-    _valid_tl = ('Y', 'Q', 'M', 'W', 'D', 'H', 'X', 'm')
+    __slots__ = ('uri', 'dname', 'apikey', 'validator', 'validator_stdin', 'digest_required', 'segments', 'segment_size')
 
-    def __init__(self, name, dname=None, uri=None, apikey=None, validator=None, digest_required=True):
-        self.name = name
-        self.dname = dname
+    def __init__(self, uri=None, dname=None, apikey=None, validator=None, digest_required=True, segments=1, segment_size=SEGMENT_SIZE,
+            validator_stdin=False):
         self.uri = uri
+        self.dname = dname
         self.apikey = apikey
         self.validator = validator
-        self._init_tl()
-        self._init_datetime()
+        self.validator_stdin = validator_stdin
         self.digest_required = digest_required
+        self.segments = segments
+        self.segment_size = segment_size
+
+class File(object):
+    """
+    Helper class for Fileset which wraps the parsing of Y/M/D/H filenames.
+
+    Files are hashed by name and ordered by a precomputed (time letter,
+    time, name) key, so name, tl and datetime are read-only.  Settings
+    common to a fileset (destination directory, API key, validator, digest
+    policy) live in a shared FilesetContext.  The download uri is derived
+    from the context's fileset uri unless one is given explicitly.
+    """
+
+    __slots__ = ('_name', '_tl', '_datetime', '_key', '_hash', 'context', '_uri')
+
+    _valid_tl = ('Y', 'Q', 'M', 'W', 'D', 'H', 'X', 'm')
+    _tl_rank = dict((tl, rank) for rank,tl in enumerate(_valid_tl))
+
+    def __init__(self, name, dname=None, uri=None, apikey=None, validator=None, digest_required=True, context=None):
+        if context is None:
+            context = FilesetContext(dname=dname, apikey=apikey, validator=validator, digest_required=digest_required)
+
+        self._tl, self._datetime, sort_key = parse_filename(name)
+        self._name = name
+        self._key = (sort_key, name)
+        self._hash = hash(name)
+        self.context = context
+        self._uri = uri
 
     def __repr__(self):
         return '<File %r, tl %r, %r, dir %r, uri %r>' % (self.name, self.tl, self.datetime, self.dname, self.uri)
 
-    def _init_tl(self):
-        try:
-            tl = self.name.split('.')[-2]
-        except IndexError:
-            raise ParseError('Unable to parse time letter from file name {}'.format(self.name))
+    name = property(lambda self: self._name)
+    tl = property(lambda self: self._tl)
+    datetime = property(lambda self: self._datetime)
 
-        if not tl in File._valid_tl:
-            raise ParseError('Time letter {} not in valid set {}'.format(tl, File._valid_tl))
-        self.tl = tl
+    @property
+    def uri(self):
+        if self._uri is None and self.context.uri is not None:
+            return relative_uri(self.context.uri, self._name)
+        return self._uri
 
-    def _init_datetime(self):
-        base_name = os.path.basename(self.name)
+    @uri.setter
+    def uri(self, uri):
+        self._uri = uri
 
-        # Strip off the leading filename component and the two trailing filename components.
-        # E.g., 'dns.20060102.1500.H.mtbl' -> '20060102.1500'
-        # E.g., 'dns.2006.Y.mtbl' -> '2006'
-        datetime_string = '.'.join(base_name.split('.')[1:-2])
+    @property
+    def dname(self):
+        return self.context.dname
 
-        try:
-            self.datetime = parse_datetime(datetime_string)
-        except ParseError as e:
-            raise ParseError('Unable to extract datetime from filename {}: {}'.format(base_name, e))
+    @property
+    def apikey(self):
+        return self.context.apikey
+
+    @property
+    def validator(self):
+        return self.context.validator
+
+    @property
+    def validator_stdin(self):
+        return self.context.validator_stdin
+
+    @property
+    def digest_required(self):
+        return self.context.digest_required
 
     def __cmp__(self, other):
-        return cmp(File._valid_tl.index(self.tl), File._valid_tl.index(other.tl)) or cmp(self.datetime, other.datetime) or cmp(self.name, other.name)
+        return cmp(self._key, other._key)
+
+    def __eq__(self, other):
+        if not isinstance(other, File):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        if not isinstance(other, File):
+            return NotImplemented
+        return self._key != other._key
+
+    def __lt__(self, other):
+        return self._key < other._key
+
+    def __le__(self, other):
+        return self._key <= other._key
+
+    def __gt__(self, other):
+        return self._key > other._key
+
+    def __ge__(self, other):
+        return self._key >= other._key
 
     def __hash__(self):
-        return hash(self.tl) ^ hash(self.datetime) ^ hash(self.name)
+        return self._hash
 
     def target(self):
         if self.dname:
@@ -237,35 +328,135 @@ class File(object):
         else:
             return self.name
 
+    def partial(self):
+        """
+        Return the name under which an incomplete download of this file is
+        kept until it is resumed.
+        """
+        name = '.{}{}'.format(self.name, PARTIAL_SUFFIX)
+        if self.dname:
+            return os.path.join(self.dname, name)
+        else:
+            return name
+
     def validate(self, filename=None):
         if filename is None:
             filename = self.target()
 
         if self.validator:
-            stdout = tempfile.TemporaryFile()
-            stderr = tempfile.TemporaryFile()
-            try:
-                logger.info('Validating {}'.format(filename))
-                subprocess.check_call([self.validator, filename], stdout=stdout, stderr=stderr)
-                stdout.seek(0)
-                logger.debug('stdout: {}'.format(stdout.read()))
-                stderr.seek(0)
-                logger.debug('stderr: {}'.format(stderr.read()))
-            except subprocess.CalledProcessError:
-                stderr.seek(0)
-                raise ValidationFailed('Validation of {} failed: {}'.format(filename, stderr.read()))
+            ValidatorProcess(self.validator, filename).wait()
+
+    def start_validator(self, filename):
+        """
+        Start validating filename from what is passed to write() of the
+        returned ValidatorProcess as it is downloaded, or return None if
+        the validator does not read its standard input.
+        """
+        if self.validator and self.validator_stdin:
+            return ValidatorProcess(self.validator, filename, stdin=True)
+        return None
+
+def _log_lines(fp, name, lines=None):
+    # readline() rather than iteration, which reads ahead.
+    for line in iter(fp.readline, b''):
+        logger.debug('{}: {}'.format(name, line.rstrip('\n')))
+        if lines is not None:
+            lines.append(line)
+    fp.close()
+
+class ValidatorProcess(object):
+    """
+    A validator run on filename, or with stdin on the data written to it
+    and '-' in place of the filename.  Its stdout and stderr are logged as
+    it writes them; the end of stderr is kept for the error.
+    """
+
+    def __init__(self, validator, filename, stdin=False):
+        self.filename = filename
+        logger.info('Validating {}'.format(filename))
+        self._proc = subprocess.Popen([validator, '-' if stdin else filename],
+                stdin=subprocess.PIPE if stdin else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True)
+        self._writing = stdin
+        self._stderr = collections.deque(maxlen=VALIDATOR_STDERR_LINES)
+        self._threads = []
+        for fp, name, lines in ((self._proc.stdout, 'stdout', None), (self._proc.stderr, 'stderr', self._stderr)):
+            thread = threading.Thread(target=_log_lines, args=(fp, name, lines))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def write(self, chunk):
+        if not self._writing:
+            return
+        try:
+            self._proc.stdin.write(chunk)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # The validator stopped reading; its exit status decides.
+            logger.debug('Validator of {} closed its input'.format(self.filename))
+            self.close()
+
+    def close(self):
+        """
+        Signal the end of the input.
+        """
+        if not self._writing:
+            return
+        self._writing = False
+        try:
+            self._proc.stdin.close()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+
+    def _reap(self):
+        for thread in self._threads:
+            thread.join()
+        return self._proc.wait()
+
+    def wait(self):
+        """
+        Wait for the validator to finish and raise ValidationFailed if it
+        failed.
+        """
+        self.close()
+        if self._reap() != 0:
+            raise ValidationFailed('Validation of {} failed: {}'.format(self.filename, ''.join(self._stderr)))
+
+    def kill(self):
+        self.close()
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self._reap()
 
 class Fileset(object):
-    def __init__(self, uri, dname, base='dns', extension='mtbl', apikey=None, validator=None, digest_required=True, timeout=None):
+    def __init__(self, uri, dname, base='dns', extension='mtbl', apikey=None, validator=None, digest_required=True, timeout=None, rescan_interval=300, segments=1, segment_size=SEGMENT_SIZE,
+            state=None, validator_stdin=False):
         """
         Create a new Fileset object.
 
         'dname' is the destination directory containing files.
         'base' is the filename prefix (e.g., "dns", "dnssec").
         'extension' is the filename suffix (e.g., "mtbl").
+        'rescan_interval' is how often, in seconds, the directory is fully
+        rescanned while inotify is tracking it.  Without inotify every
+        load_local_fileset() call rescans.
+        'segments' is the maximum number of byte ranges a file is split into
+        and fetched in parallel, each at least 'segment_size' bytes long.
+        With 'validator_stdin', the validator is passed '-' instead of a
+        filename and fed the download as it arrives.
 
         The Fileset will be initialized with all files named like
         '{dname}/{base}.*.[YMWDHXm].{extension}'.
+
+        If a StateStore is passed as 'state', the remote fileset and the
+        local index are restored from it and kept up to date by
+        save_state().  The saved local index is only used if the
+        destination directory has not changed since it was taken.
         """
 
         if not os.path.isdir(dname):
@@ -279,24 +470,246 @@ class Fileset(object):
         self.validator = validator
         self.digest_required = digest_required
         self.timeout = timeout
+        self.rescan_interval = rescan_interval
+        self.context = FilesetContext(uri=uri, dname=dname, apikey=apikey, validator=validator, digest_required=digest_required,
+                segments=segments, segment_size=segment_size, validator_stdin=validator_stdin)
+
+        # The watcher is set up before the first scan so that no change
+        # between the scan and the first poll is missed.
+        self._local_index = dict()
+        self._next_rescan = 0
+        self._watcher = DirectoryWatcher(dname, pattern='{}.*.[YQMWDHXm].{}'.format(base, extension))
+
+        # Derived state is only recomputed by reconcile() when one of these
+        # versions moves.  Completed downloads are queued by other threads
+        # and folded into the local index by load_local_fileset().
+        self._local_version = 0
+        self._remote_version = 0
+        self._reconciled = None
+        self._downloaded = collections.deque()
+        self.missing = set()
+
+        # fileset filename -> (stat signature, files, sorted files) as last
+        # written or verified by _write_fileset().
+        self._published = dict()
 
         self.all_local_files = None
         self.minimal_local_files = None
+        self.remote_etag = None
+        self.remote_last_modified = None
+        self.remote_loaded = False
+        self.remote_load_time = None
+        self.pending_deletions = set()
+
+        # What was last saved to, or restored from, the state store, and
+        # the versions it was compared at.
+        self.state = state
+        self.state_key = '{}/{}.*.{}'.format(dname, base, extension)
+        self._local_mtime = None
+        self._local_scanned_at = None
+        self._saved_local = set()
+        self._saved_local_mtime = None
+        self._saved_local_racy = True
+        self._saved_local_version = None
+        self._saved_remote = set()
+        self._saved_remote_meta = None
+        self._saved_remote_version = None
+        saved = None
+        if state is not None:
+            saved = state.load(self.state_key)
+            self._saved_local = set(saved.local or ())
+            self._saved_remote = set(saved.remote or ())
+            self._restore_local_index(saved)
+
         self.load_local_fileset()
         self.remote_files = set(self.all_local_files)
-        self.pending_deletions = set()
+        if saved is not None and saved.remote is not None and saved.uri == uri:
+            self._restore_remote_fileset(saved)
+
+    def _dir_mtime(self):
+        return os.stat(self.dname).st_mtime
+
+    @staticmethod
+    def _racy(mtime, scanned_at):
+        # A change made within a second after the index was taken may not
+        # have moved the mtime of the directory.
+        return mtime >= scanned_at - 1
+
+    def _restore_local_index(self, saved):
+        if saved.local is None:
+            return
+        mtime = self._dir_mtime()
+        if mtime != saved.local_mtime or self._racy(mtime, saved.local_scanned_at):
+            logger.debug('Not restoring the local index of {}: {} changed since'.format(self.state_key, self.dname))
+            return
+
+        for name in saved.local:
+            try:
+                self._local_index[name] = File(name, context=self.context)
+            except ParseError as e:
+                logger.debug('Error parsing filename \'{}\': {}'.format(os.path.join(self.dname, name), str(e)))
+        self._saved_local_mtime = saved.local_mtime
+        self._saved_local_racy = False
+        self._local_mtime = saved.local_mtime
+        self._local_scanned_at = saved.local_scanned_at
+        self._next_rescan = time.time() + self.rescan_interval
+        logger.debug('Restored {} local files of {}'.format(len(self._local_index), self.state_key))
+
+    def _restore_remote_fileset(self, saved):
+        # Sharing the File objects of local files makes the set operations
+        # of reconcile() cheaper, as equal objects are found by identity.
+        remote_files = set()
+        for name in saved.remote:
+            try:
+                remote_files.add(self._local_index.get(name) or File(name, context=self.context))
+            except ParseError as e:
+                logger.debug('Error parsing filename \'{}\': {}'.format(name, str(e)))
+        self.remote_files = remote_files
+        self.remote_etag = saved.etag
+        self.remote_last_modified = saved.last_modified
+        self.remote_load_time = saved.loaded_at
+        self.remote_loaded = True
+        self._remote_version += 1
+        self._saved_remote_meta = (saved.etag, saved.last_modified, saved.loaded_at)
+        logger.debug('Restored {} remote files of {}'.format(len(remote_files), self.state_key))
+
+    def save_state(self):
+        """
+        Write what changed in the remote fileset and the local index since
+        the last call to the state store, if there is one.  The file names
+        are only compared when their version moved.
+        """
+        if self.state is None:
+            return
+
+        meta = (self.remote_etag, self.remote_last_modified, self.remote_load_time)
+        if self.remote_loaded and (self._remote_version != self._saved_remote_version or meta != self._saved_remote_meta):
+            remote = set(f.name for f in self.remote_files)
+            if remote != self._saved_remote or meta != self._saved_remote_meta:
+                self.state.save_remote(self.state_key, self.uri, remote.difference(self._saved_remote),
+                        self._saved_remote.difference(remote), *meta)
+                self._saved_remote = remote
+                self._saved_remote_meta = meta
+            self._saved_remote_version = self._remote_version
+
+        if self._local_mtime is None:
+            return
+        racy = self._racy(self._local_mtime, self._local_scanned_at)
+        # A racy index is saved again once it no longer is.
+        settled = self._saved_local_racy and not racy
+        if self._local_version == self._saved_local_version and self._local_mtime == self._saved_local_mtime and not settled:
+            return
+        local = set(self._local_index)
+        if local != self._saved_local or self._local_mtime != self._saved_local_mtime or settled:
+            self.state.save_local(self.state_key, local.difference(self._saved_local),
+                    self._saved_local.difference(local), self._local_mtime, self._local_scanned_at)
+            self._saved_local = local
+            self._saved_local_mtime = self._local_mtime
+            self._saved_local_racy = racy
+        self._saved_local_version = self._local_version
+
+    def list_local_files(self):
+        """
+        List the paths of all local files of the fileset, as found on disk.
+        """
+        return glob.glob('{}/{}.*.[YQMWDHXm].{}'.format(self.dname, self.base, self.extension))
+
+    def _scan_local_fileset(self):
+        names = set(os.path.basename(fname) for fname in self.list_local_files())
+        added = names.difference(self._local_index)
+        removed = set(self._local_index).difference(names)
+        return added, removed
 
     def load_local_fileset(self):
-        g_expr = '{}/{}.*.[YQMWDHXm].{}'.format(self.dname, self.base, self.extension)
-        new_local_files = set()
-        for fname in glob.glob(g_expr):
+        """
+        Fold local changes into the index of local files.  The local file
+        sets are reset and the local version advanced only if something
+        changed.
+        """
+        now = time.time()
+        if self.state is not None:
+            # Taken before looking, so that any change not picked up
+            # below moves the mtime past the one saved with the index.
+            mtime = self._dir_mtime()
+        changes = self._watcher.poll()
+        if changes is None or now >= self._next_rescan:
+            changes = self._scan_local_fileset()
+            self._next_rescan = now + self.rescan_interval
+
+        added, removed = changes
+        changed = False
+        for name in removed:
+            if self._local_index.pop(name, None) is not None:
+                changed = True
+        for name in added:
+            if name in self._local_index:
+                continue
             try:
-                new_local_files.add(File(os.path.basename(fname), validator=self.validator, apikey=self.apikey, digest_required=self.digest_required))
+                self._local_index[name] = File(name, context=self.context)
+                changed = True
             except ParseError as e:
-                logger.debug('Error parsing filename \'{}\': {}'.format(fname, str(e)))
+                logger.debug('Error parsing filename \'{}\': {}'.format(os.path.join(self.dname, name), str(e)))
+
+        while self._downloaded:
+            f = self._downloaded.popleft()
+            if f.name not in self._local_index:
+                self._local_index[f.name] = f
+                changed = True
+
+        if changed or self.all_local_files is None:
+            self._local_version += 1
+            self._reset_local_files()
+
+        if self.state is not None:
+            self._local_mtime = mtime
+            self._local_scanned_at = now
+
+    def fileno(self):
+        """
+        Return a descriptor that becomes readable when the destination
+        directory changes, or None if it is not being watched.
+        """
+        return self._watcher.fileno()
+
+    def next_local_load(self):
+        """
+        Return the time by which load_local_fileset() has to be called again
+        to notice local changes that fileno() does not signal.
+        """
+        if self._watcher.available:
+            return self._next_rescan
+        return time.time() + LOCAL_POLL_INTERVAL
+
+    def _reset_local_files(self):
+        new_local_files = self._local_index.values()
         self.all_local_files = set(new_local_files)
         self.minimal_local_files = set(new_local_files)
 
+    def add_local_file(self, f):
+        """
+        Record that f has been placed in the destination directory.  Safe
+        to call from any thread; the change is applied by the next
+        load_local_fileset().
+        """
+        self._downloaded.append(f)
+
+    def reconcile(self, minimal=True):
+        """
+        Recompute the missing files and prune obsolete and redundant files,
+        but only if the local or remote fileset changed since the last
+        call.  Returns True if anything was recomputed.
+        """
+        state = (self._local_version, self._remote_version, minimal)
+        if state == self._reconciled:
+            return False
+
+        self._reset_local_files()
+        self.missing = self.missing_files()
+        self.prune_obsolete_files(minimal=minimal)
+        self.prune_redundant_files(minimal=minimal)
+        self._reconciled = state
+        return True
+
     def prune_obsolete_files(self, minimal=True):
         obsolete_files = self.minimal_local_files.difference(self.remote_files).difference(compute_overlap(self.minimal_local_files.union(self.remote_files)))
 
@@ -319,26 +732,58 @@ class Fileset(object):
             return os.path.join(self.dname, self.base + '-full.fileset')
         return os.path.join(self.dname, self.base + '.fileset')
 
-    def _write_fileset(self, fileset, fileset_fname):
-        # Read the old fileset, if it exists.
+    @staticmethod
+    def _stat_signature(fname):
         try:
-            old_fileset = set(line.rstrip() for line in open(fileset_fname))
-        except IOError as e:
+            st = os.stat(fname)
+        except OSError as e:
             if e.errno == errno.ENOENT:
-                logger.debug('Fileset {} does not exist.  Starting with a blank one.'.format(fileset_fname))
-                old_fileset = set()
-            else:
-                raise
+                return None
+            raise
+        return (st.st_ino, st.st_mtime, st.st_size)
 
-        if old_fileset.symmetric_difference(f.name for f in fileset) or not os.path.exists(fileset_fname):
+    def _write_fileset(self, fileset, fileset_fname):
+        # The last published contents are trusted as long as the file on
+        # disk is still the one we wrote.
+        published = self._published.get(fileset_fname)
+        signature = self._stat_signature(fileset_fname)
+        if published is not None and signature is not None and published[0] == signature:
+            if fileset == published[1]:
+                return
+            old_fileset = set(f.name for f in published[1])
+            order = published[2]
+        else:
+            # Read the old fileset, if it exists.
+            try:
+                old_fileset = set(line.rstrip() for line in open(fileset_fname))
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    logger.debug('Fileset {} does not exist.  Starting with a blank one.'.format(fileset_fname))
+                    old_fileset = set()
+                else:
+                    raise
+            order = None
+
+        if order is not None:
+            # Merge the previous ordering with the sorted additions rather
+            # than sorting the whole fileset again.
+            kept = [f for f in order if f in fileset]
+            order = list(heapq.merge(kept, sorted(fileset.difference(kept))))
+        else:
+            order = sorted(fileset)
+
+        if old_fileset.symmetric_difference(f.name for f in fileset) or signature is None:
             logger.debug('Fileset {} has changed'.format(fileset_fname))
             with tempfile.NamedTemporaryFile(prefix='.{}.'.format(os.path.basename(fileset_fname)), dir=os.path.dirname(fileset_fname), delete=True) as out:
-                for f in sorted(fileset):
+                for f in order:
                     print (f.name, file=out)
                 out.file.close()
                 os.chmod(out.name, 0o644)
                 os.rename(out.name, fileset_fname)
                 out.delete = False
+            signature = self._stat_signature(fileset_fname)
+
+        self._published[fileset_fname] = (signature, frozenset(fileset), order)
 
     def write_local_fileset(self, minimal=True):
         if not minimal:
@@ -371,11 +816,40 @@ class Fileset(object):
             self.pending_deletions.remove(f)
 
     def load_remote_fileset(self):
+        """
+        Retrieve the remote fileset descriptor and replace remote_files
+        with its contents.
+
+        The request is conditional on the validators of the last complete
+        response.  Returns False if the remote fileset was not modified, in
+        which case remote_files is left as it is, and True otherwise.
+        """
+        return self.apply_remote_fileset(self.fetch_remote_fileset())
+
+    def fetch_remote_fileset(self):
+        """
+        Retrieve and parse the remote fileset descriptor without changing
+        the fileset, so that it can be run on another thread while nothing
+        else loads the remote fileset.
+
+        Returns None if the remote fileset was not modified, and otherwise
+        the tuple to pass to apply_remote_fileset().
+        """
         logger.info('Retrieving {}'.format(self.uri))
         req = urllib2.Request(self.uri)
         if self.apikey:
             req.add_header('X-API-Key', self.apikey)
-        fp = urllib2.urlopen(req, timeout=self.timeout)
+        if self.remote_etag:
+            req.add_header('If-None-Match', self.remote_etag)
+        if self.remote_last_modified:
+            req.add_header('If-Modified-Since', self.remote_last_modified)
+        try:
+            fp = urllib2.urlopen(req, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                logger.info('Fileset {} not modified'.format(self.uri))
+                return None
+            raise
         new_remote_files = set()
         read_len = 0
         algorithm = None
@@ -399,7 +873,7 @@ class Fileset(object):
                     logger.warning('Skipping {}.  Extensions is not {}.'.format(fname, self.extension))
                     continue
 
-                new_remote_files.add(File(fname, dname=self.dname, uri=relative_uri(self.uri, fname), validator=self.validator, apikey=self.apikey, digest_required=self.digest_required))
+                new_remote_files.add(File(fname, context=self.context))
         except DigestError as e:
             raise FilesetError(e)
 
@@ -412,10 +886,51 @@ class Fileset(object):
         else:
             logger.debug('Skipping Content-Length check')
 
-        self.remote_files = new_remote_files
+        return new_remote_files, fp.headers.get('ETag'), fp.headers.get('Last-Modified')
+
+    def apply_remote_fileset(self, fetched):
+        """
+        Take over the result of fetch_remote_fileset().  Returns False if
+        the remote fileset was not modified, and True otherwise.
+        """
+        self.remote_load_time = time.time()
+        if fetched is None:
+            return False
+
+        new_remote_files, self.remote_etag, self.remote_last_modified = fetched
+        if new_remote_files != self.remote_files:
+            self.remote_files = new_remote_files
+            self._remote_version += 1
+
+        self.remote_loaded = True
+        return True
 
     def missing_files(self):
         return self.remote_files.difference(self.all_local_files)
 
     def list_temporary_files(self):
-        return glob.glob(os.path.join(self.dname, '.{}.*.{}.*'.format(self.base, self.extension)))
+        """
+        List leftover temporary files, not including partial downloads that
+        may still be resumed or quarantined files kept for inspection.
+        """
+        return [fname for fname in glob.glob(os.path.join(self.dname, '.{}.*.{}.*'.format(self.base, self.extension)))
+                if not fname.endswith(PARTIAL_SUFFIX) and not fname.endswith(PARTIAL_SUFFIX + META_SUFFIX)
+                and not fname.endswith(QUARANTINE_SUFFIX)]
+
+    def list_partial_files(self):
+        return glob.glob(os.path.join(self.dname, '.{}.*.{}{}'.format(self.base, self.extension, PARTIAL_SUFFIX)))
+
+    def prune_partial_files(self):
+        """
+        Remove partial downloads of files that are no longer missing, e.g.
+        because they were dropped from the remote fileset.  Does nothing
+        until the remote fileset has been loaded.
+        """
+        if not self.remote_loaded:
+            return
+        missing = set(f.name for f in self.missing)
+        for partial in self.list_partial_files():
+            name = os.path.basename(partial)[1:-len(PARTIAL_SUFFIX)]
+            if name not in missing:
+                logger.info('Removing partial download {}'.format(partial))
+                discard_partial(partial)
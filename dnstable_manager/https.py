@@ -16,6 +16,8 @@ import urllib2
 import httplib
 import logging
 import socket
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,73 @@ keyfile = None
 certfile = None
 ciphers = 'EECDH+ECDSA+AESGCM:EECDH+aRSA+AESGCM:EECDH+ECDSA+SHA384:EECDH+ECDSA+SHA256:EECDH+aRSA+SHA384:EECDH+aRSA+SHA256:!EECDH+aRSA+RC4:EECDH:EDH+aRSA:!RC4:!aNULL:!eNULL:!LOW:!3DES:!MD5:!EXP:!PSK:!SRP:!DSS:@STRENGTH'
 
+class HandshakeStats(object):
+    """
+    Running count and duration of TLS handshakes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+
+    def record(self, elapsed):
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def mean_time(self):
+        with self._lock:
+            return self.total_time / self.count if self.count else 0.0
+
+    def as_dict(self):
+        with self._lock:
+            return dict(count=self.count, max_time=self.max_time,
+                    mean_time=self.total_time / self.count if self.count else 0.0)
+
+handshake_stats = HandshakeStats()
+
+_context_lock = threading.Lock()
+_context = None
+_context_config = None
+
+def get_context():
+    """
+    Return the SSLContext for the current module configuration, creating
+    it on first use and whenever ca_file, keyfile, certfile or ciphers
+    change.  Returns None if the ssl module has no SSLContext.
+    """
+    global _context, _context_config
+
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+
+    config = (ca_file, keyfile, certfile, ciphers)
+    with _context_lock:
+        if _context is None or _context_config != config:
+            logger.debug('Creating SSLContext for ca_file={} certfile={}'.format(ca_file, certfile))
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            # TLS 1.2 or later only.
+            for option in ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1', 'OP_NO_COMPRESSION'):
+                context.options |= getattr(ssl, option, 0)
+            context.verify_mode = ssl.CERT_REQUIRED
+            if ca_file:
+                context.load_verify_locations(cafile=ca_file)
+            if certfile:
+                context.load_cert_chain(certfile, keyfile)
+            if ciphers:
+                context.set_ciphers(ciphers)
+            _context = context
+            _context_config = config
+        return _context
+
 class HTTPSConnection(httplib.HTTPConnection):
     default_port = httplib.HTTPS_PORT
 
@@ -45,13 +114,23 @@ class HTTPSConnection(httplib.HTTPConnection):
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
+
+        start = time.time()
         try:
-            self.sock = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_TLSv1,
-                    ca_certs=ca_file, cert_reqs=ssl.CERT_REQUIRED,
-                    keyfile=keyfile, certfile=certfile, ciphers=ciphers)
+            context = get_context()
+            if context is None:
+                self.sock = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_TLSv1,
+                        ca_certs=ca_file, cert_reqs=ssl.CERT_REQUIRED,
+                        keyfile=keyfile, certfile=certfile, ciphers=ciphers)
+            else:
+                self.sock = context.wrap_socket(sock, server_hostname=self._tunnel_host or self.host)
         except (ssl.SSLError, ssl.CertificateError, socket.error) as e:
             raise urllib2.URLError(e)
 
+        elapsed = time.time() - start
+        handshake_stats.record(elapsed)
+        logger.debug('TLS handshake with {}:{} took {:.3f}s'.format(self.host, self.port, elapsed))
+
 class HTTPSHandler(urllib2.HTTPSHandler):
     def https_open(self, req):
         return self.do_open(HTTPSConnection, req)
@@ -0,0 +1,208 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            logger.debug('inotify unavailable: {}'.format(e))
+            libc = False
+        _libc = libc
+    return _libc
+
+def _raise_errno(what):
+    err = ctypes.get_errno()
+    raise OSError(err, '{}: {}'.format(what, os.strerror(err)))
+
+class Inotify(object):
+    """
+    Minimal non-blocking wrapper around the Linux inotify(7) interface.
+
+    Raises OSError if inotify is not supported on this system.
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        if not libc:
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            _raise_errno('inotify_init1')
+
+        self._libc = libc
+        self.fd = fd
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        fd, self.fd = getattr(self, 'fd', None), None
+        if fd is not None:
+            os.close(fd)
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            _raise_errno('inotify_add_watch {}'.format(path))
+        return wd
+
+    def read_events(self):
+        """
+        Return a list of pending (wd, mask, cookie, name) events without
+        blocking.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = _event.unpack_from(buf, offset)
+                offset += _event.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+class DirectoryWatcher(object):
+    """
+    Track additions and removals of files matching a glob pattern in a
+    single directory.
+
+    poll() returns an (added, removed) tuple of basename sets accumulated
+    since the previous call, or None if the caller has to fall back to a
+    full directory scan: inotify is unavailable, the kernel event queue
+    overflowed, or the watch on the directory was lost.
+    """
+
+    ADDED = IN_MOVED_TO | IN_CLOSE_WRITE | IN_CREATE
+    REMOVED = IN_MOVED_FROM | IN_DELETE
+    LOST = IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, dname, pattern='*'):
+        self.dname = dname
+        self.pattern = pattern
+        self._inotify = None
+        self._wd = None
+
+        try:
+            self._inotify = Inotify()
+        except OSError as e:
+            logger.info('Falling back to periodic scans of {}: {}'.format(dname, e))
+            return
+
+        self._add_watch()
+
+    def _add_watch(self):
+        try:
+            self._wd = self._inotify.add_watch(self.dname, self.ADDED | self.REMOVED | self.LOST | IN_ONLYDIR)
+        except OSError as e:
+            logger.warning('Unable to watch {}: {}'.format(self.dname, e))
+            self._wd = None
+
+    @property
+    def available(self):
+        return self._wd is not None
+
+    def fileno(self):
+        if self._inotify is None:
+            return None
+        return self._inotify.fileno()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._wd = None
+
+    def poll(self):
+        if self._inotify is None:
+            return None
+
+        if self._wd is None:
+            # The previous watch was lost; try to re-establish it and have the
+            # caller rescan to catch up.
+            self._add_watch()
+            self._inotify.read_events()
+            return None
+
+        added = set()
+        removed = set()
+        rescan = False
+
+        for wd, mask, cookie, name in self._inotify.read_events():
+            if mask & self.LOST:
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning('inotify queue overflow on {}'.format(self.dname))
+                if wd == self._wd and mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    logger.warning('Lost inotify watch on {}'.format(self.dname))
+                    self._wd = None
+                rescan = True
+                continue
+
+            if wd != self._wd or not fnmatch.fnmatchcase(name, self.pattern):
+                continue
+
+            if mask & self.ADDED:
+                added.add(name)
+                removed.discard(name)
+            elif mask & self.REMOVED:
+                removed.add(name)
+                added.discard(name)
+
+        if rescan:
+            return None
+        return added, removed
@@ -0,0 +1,260 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from cStringIO import StringIO
+import errno
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from . import https
+
+logger = logging.getLogger(__name__)
+
+class ConnectionPool(object):
+    """
+    Idle persistent HTTP connections, kept per (connection class, host,
+    timeout) for at most idle_timeout seconds and at most max_idle per key.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return an idle connection for key, or None if there is none.
+        """
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                expiry, candidate = idle.pop()
+                if expiry > now:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        return conn
+
+    def put(self, key, conn):
+        """
+        Keep conn for reuse, closing it instead if the pool for key is full.
+        """
+        now = time.time()
+        closing = []
+        with self._lock:
+            for k, idle in self._idle.items():
+                while idle and idle[0][0] <= now:
+                    closing.append(idle.popleft()[1])
+                if not idle and k != key:
+                    del self._idle[k]
+
+            idle = self._idle[key]
+            if self.max_idle > 0:
+                idle.append((now + self.idle_timeout, conn))
+                while len(idle) > self.max_idle:
+                    closing.append(idle.popleft()[1])
+            else:
+                closing.append(conn)
+        for conn in closing:
+            conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(collections.deque)
+        for connections in idle.values():
+            for expiry, conn in connections:
+                conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+default_pool = ConnectionPool()
+
+def _readinto_fileobject(fp, view):
+    """
+    readinto() for a socket._fileobject: what it has buffered, if anything,
+    else straight from its socket.
+    """
+    buffered = fp._rbuf.getvalue()
+    if buffered:
+        n = min(len(buffered), len(view))
+        view[:n] = buffered[:n]
+        fp._rbuf = StringIO()
+        fp._rbuf.write(buffered[n:])
+        return n
+    while True:
+        try:
+            return fp._sock.recv_into(view)
+        except socket.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+class _PooledFile(socket._fileobject):
+    """
+    The file object of a pooled response, which can read into a buffer.
+    """
+
+    def readinto(self, buf):
+        return _readinto_fileobject(self, memoryview(buf))
+
+class _PooledReader(object):
+    """
+    Read the body of an HTTPResponse and give its connection back to the
+    pool once the body has been read completely.
+    """
+
+    def __init__(self, response, conn, pool, key):
+        self._response = response
+        self._conn = conn
+        self._pool = pool
+        self._key = key
+        if response.isclosed():
+            self._release()
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._key, conn)
+        else:
+            conn.close()
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    recv = read
+
+    def readinto(self, buf):
+        """
+        Read the body into buf, directly from the socket up to the end of
+        the Content-Length, as HTTPResponse.read(len(buf)) would.
+        """
+        r = self._response
+        if r.fp is None:
+            return 0
+        if r.chunked or r._method == 'HEAD':
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+
+        amt = len(buf) if r.length is None else min(len(buf), r.length)
+        n = _readinto_fileobject(r.fp, memoryview(buf)[:amt]) if amt else 0
+        if not n and amt:
+            r.close()
+        if r.length is not None:
+            r.length -= n
+            if not r.length:
+                r.close()
+        if r.isclosed():
+            self._release()
+        return n
+
+    recv_into = readinto
+
+    def close(self):
+        self._release()
+        self._response.close()
+
+class KeepAliveMixin(object):
+    """
+    Replacement for AbstractHTTPHandler.do_open() that takes connections
+    from a ConnectionPool and leaves them open for the next request.
+    """
+
+    pool = None
+
+    def do_open(self, http_class, req):
+        if req._tunnel_host:
+            # Tunnelled connections are not worth the trouble of pooling.
+            return urllib2.AbstractHTTPHandler.do_open(self, http_class, req)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        pool = self.pool if self.pool is not None else default_pool
+        key = (http_class, host, req.timeout)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+
+        conn = pool.get(key)
+        if conn is not None:
+            logger.debug('Reusing connection to {}'.format(host))
+            try:
+                r = self._send(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                # The server may have closed the idle connection in the
+                # meantime; requests made here are safe to repeat.
+                logger.debug('Reused connection to {} failed: {}'.format(host, e))
+                conn.close()
+                conn = None
+
+        if conn is None:
+            conn = http_class(host, timeout=req.timeout)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                r = self._send(conn, req, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+
+        fp = _PooledFile(_PooledReader(r, conn, pool, key), close=True)
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    @staticmethod
+    def _send(conn, req, headers):
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
+
+class HTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel=debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+class HTTPSHandler(KeepAliveMixin, https.HTTPSHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        https.HTTPSHandler.__init__(self, debuglevel=debuglevel)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.do_open(https.HTTPSConnection, req)
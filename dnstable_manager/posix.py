@@ -0,0 +1,273 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Space preallocation, page cache control and in-kernel copies for files
+being downloaded.
+
+Python 2 has neither os.posix_fallocate(), os.posix_fadvise() nor
+os.sendfile(), so the C library is called through ctypes.  Every function quietly does nothing,
+returning False or None, where the platform or the file system does not
+support it.
+"""
+
+import array
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+POSIX_FADV_DONTNEED = 4
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x01
+_FIEMAP = '=QQIIII'
+
+FICLONE = 0x40049409
+
+# Bytes copied per copy_file_range() or sendfile() call, so that a
+# terminated thread does not have to wait for a whole file.
+COPY_CHUNK = 64 << 20
+
+# Pages written back and dropped at a time by WriteBehind.
+WRITE_BEHIND_WINDOW = 8 << 20
+
+_UNSUPPORTED = (errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+# Also returned for copies between file systems that cannot do them.
+_UNSUPPORTED_COPY = _UNSUPPORTED + (errno.EXDEV, errno.ENOTTY)
+
+def _load(names, restype, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    for name in names:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.restype = restype
+            func.argtypes = argtypes
+            return func
+    return None
+
+_fallocate = _load(('fallocate64', 'fallocate'), ctypes.c_int,
+        [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+_posix_fadvise = _load(('posix_fadvise64', 'posix_fadvise'), ctypes.c_int,
+        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+_sync_file_range = _load(('sync_file_range',), ctypes.c_int,
+        [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint])
+_mmap = _load(('mmap64', 'mmap'), ctypes.c_void_p,
+        [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int64])
+_munmap = _load(('munmap',), ctypes.c_int, [ctypes.c_void_p, ctypes.c_size_t])
+_mincore = _load(('mincore',), ctypes.c_int,
+        [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)])
+_copy_file_range = _load(('copy_file_range',), ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _load(('sendfile64', 'sendfile'), ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+
+def _check(result, what):
+    if result == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in _UNSUPPORTED:
+        logger.debug('{} not supported: {}'.format(what, os.strerror(err)))
+        return False
+    raise OSError(err, os.strerror(err))
+
+def fallocate(fd, offset, length):
+    """
+    Reserve disk space for length bytes of fd from offset, without
+    changing its size, so that a sequentially written file is laid out
+    contiguously.  Returns False if this is not supported.
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    return _check(_fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length), 'fallocate')
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise(), where length 0 means up to the end of the file.
+    Returns False if this is not supported.
+    """
+    if _posix_fadvise is None:
+        return False
+    # posix_fadvise() returns the error rather than setting errno.
+    err = _posix_fadvise(fd, offset, length, advice)
+    if err in _UNSUPPORTED:
+        logger.debug('posix_fadvise not supported: {}'.format(os.strerror(err)))
+        return False
+    if err:
+        raise OSError(err, os.strerror(err))
+    return True
+
+def sync_file_range(fd, offset, length, flags):
+    """
+    Linux sync_file_range(), falling back to fdatasync() when waiting for
+    the write-out is asked for.  Returns False if nothing was done.
+    """
+    if _sync_file_range is not None and _check(_sync_file_range(fd, offset, length, flags), 'sync_file_range'):
+        return True
+    if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+        return True
+    return False
+
+def drop_cache(fd, offset=0, length=0, wait=True):
+    """
+    Write the given range of fd to disk and drop it from the page cache.
+    Without wait, writing is only started and pages that are still dirty
+    stay in the cache.
+    """
+    flags = SYNC_FILE_RANGE_WRITE
+    if wait:
+        flags |= SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WAIT_AFTER
+    sync_file_range(fd, offset, length, flags)
+    return fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def extent_count(fd):
+    """
+    Return the number of extents fd is stored in, or None if the file
+    system cannot tell (FIEMAP).
+    """
+    buf = array.array('B', struct.pack(_FIEMAP, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 0, 0))
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+    except (IOError, OverflowError) as e:
+        logger.debug('FIEMAP not supported: {}'.format(str(e)))
+        return None
+    return struct.unpack(_FIEMAP, buf.tostring())[3]
+
+def resident_pages(fd):
+    """
+    Return the number of pages of fd in the page cache and the number of
+    pages of fd, or None if this cannot be determined (mincore).
+    """
+    if None in (_mmap, _munmap, _mincore):
+        return None
+    length = os.fstat(fd).st_size
+    pages = (length + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    if not pages:
+        return 0, 0
+
+    # The mapping is never touched, so it does not read anything in.
+    addr = _mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr is None or addr == ctypes.c_void_p(-1).value:
+        logger.debug('mmap failed: {}'.format(os.strerror(ctypes.get_errno())))
+        return None
+    try:
+        vec = (ctypes.c_ubyte * pages)()
+        if _mincore(addr, length, vec) != 0:
+            logger.debug('mincore failed: {}'.format(os.strerror(ctypes.get_errno())))
+            return None
+        return sum(page & 1 for page in vec), pages
+    finally:
+        _munmap(addr, length)
+
+def reflink(src_fd, dst_fd):
+    """
+    Make dst_fd share the extents of all of src_fd on a copy-on-write file
+    system (FICLONE).  Returns False if this is not supported.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError as e:
+        if e.errno in _UNSUPPORTED_COPY:
+            logger.debug('FICLONE not supported: {}'.format(os.strerror(e.errno)))
+            return False
+        raise
+    return True
+
+def _copy_chunks(copy, what, src_fd, dst_fd, length):
+    copied = 0
+    while copied < length:
+        n = copy(src_fd, dst_fd, min(length - copied, COPY_CHUNK))
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if not copied and err in _UNSUPPORTED_COPY:
+                logger.debug('{} not supported: {}'.format(what, os.strerror(err)))
+                return None
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+def copy_range(src_fd, dst_fd, length):
+    """
+    Copy up to length bytes from the current offset of src_fd to that of
+    dst_fd in the kernel, with copy_file_range() or else sendfile().
+    Returns the number of bytes copied, which is less than length only at
+    the end of src_fd, or None if neither is supported.
+    """
+    for func, what, copy in (
+            (_copy_file_range, 'copy_file_range', lambda src, dst, n: _copy_file_range(src, None, dst, None, n, 0)),
+            (_sendfile, 'sendfile', lambda src, dst, n: _sendfile(dst, src, None, n))):
+        if func is not None:
+            copied = _copy_chunks(copy, what, src_fd, dst_fd, length)
+            if copied is not None:
+                return copied
+    return None
+
+class WriteBehind(object):
+    """
+    Keep a sequentially written file from filling the page cache: every
+    window bytes, start writing the new data to disk and drop the window
+    before it, which has been written by then, from the cache.
+
+    Without wait, update() never waits for the disk, for callers that
+    must not block, and leaves what is not written yet to finish().
+    """
+
+    def __init__(self, fp, offset=0, window=WRITE_BEHIND_WINDOW, wait=True):
+        self.fp = fp
+        self.window = window
+        self.wait = wait
+        self._started = offset
+        self._dropped = offset
+
+    def update(self, position):
+        """
+        Called with the position the file has been written up to.
+        """
+        if position - self._started < self.window:
+            return
+        self.fp.flush()
+        fd = self.fp.fileno()
+        while position - self._started >= self.window:
+            sync_file_range(fd, self._started, self.window, SYNC_FILE_RANGE_WRITE)
+            self._started += self.window
+        while self._started - self._dropped > self.window:
+            drop_cache(fd, self._dropped, self.window, self.wait)
+            self._dropped += self.window
+
+    def finish(self):
+        """
+        Write the remaining data to disk and drop all of it from the cache.
+        """
+        self.fp.flush()
+        drop_cache(self.fp.fileno(), self._dropped, 0)
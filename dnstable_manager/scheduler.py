@@ -0,0 +1,175 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import heapq
+import itertools
+import logging
+import math
+import select
+import threading
+import time
+import traceback
+
+from .download import WorkerPool
+from .util import WakePipe
+
+logger = logging.getLogger(__name__)
+
+class Scheduler(object):
+    """
+    Drive the step() of any number of DNSTableManagers from one thread.
+
+    Each manager is kept in a timer heap keyed by the time its next step is
+    due, as returned by the previous step.  A manager is also stepped early
+    when wake() is called for it (e.g. from a download callback) or when
+    the inotify descriptor of its fileset becomes readable.
+
+    Blocking work such as retrieving a remote fileset is handed to submit()
+    and runs on one of 'workers' threads instead of the scheduler thread.
+    """
+
+    def __init__(self, workers=2):
+        self._managers = set()
+        self._heap = []
+        self._due = dict()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._watches = dict()
+        self._failed = set()
+
+        self._wake = WakePipe()
+
+        self._pool = WorkerPool(workers)
+        self._thread = None
+        self._terminate = threading.Event()
+
+    def add(self, manager):
+        manager.scheduler = self
+        with self._lock:
+            self._managers.add(manager)
+            fd = manager.fileset.fileno()
+            if fd is not None:
+                self._watches[fd] = manager
+        self.wake(manager)
+
+    def remove(self, manager):
+        with self._lock:
+            self._managers.discard(manager)
+            self._due.pop(manager, None)
+            self._failed.discard(manager)
+            for fd,m in self._watches.items():
+                if m is manager:
+                    del self._watches[fd]
+        manager.scheduler = None
+
+    def schedule(self, manager, delay):
+        """
+        Make sure manager is stepped within delay seconds.  Safe to call
+        from any thread.
+        """
+        due = time.time() + max(0, delay)
+        with self._lock:
+            if manager not in self._managers:
+                return
+            if manager in self._due and self._due[manager] <= due:
+                return
+            self._due[manager] = due
+            heapq.heappush(self._heap, (due, next(self._seq), manager))
+        self._wake.notify()
+
+    def wake(self, manager):
+        self.schedule(manager, 0)
+
+    def submit(self, func, *args):
+        self._pool.submit(func, *args)
+
+    def start(self):
+        if self._thread:
+            raise Exception('already running')
+
+        self._terminate.clear()
+        self._pool.start()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, blocking=False, timeout=None):
+        self._terminate.set()
+        self._wake.notify()
+        self._pool.stop()
+        if blocking or timeout:
+            self.join(timeout=timeout)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout=timeout)
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, _, manager = heapq.heappop(self._heap)
+                # Entries superseded by an earlier schedule() are skipped.
+                if self._due.get(manager) == when:
+                    del self._due[manager]
+                    due.append(manager)
+        return due
+
+    def _timeout(self, now):
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][0] - now)
+
+    def run(self):
+        logger.debug('Running Scheduler {}'.format(self))
+        while not self._terminate.is_set():
+            for manager in self._pop_due(time.time()):
+                try:
+                    delay = manager.step()
+                    self._failed.discard(manager)
+                except Exception as e:
+                    logger.error('Step of {} failed: {}'.format(manager.fileset_uri, str(e)))
+                    logger.debug(traceback.format_exc())
+                    # Ignore its directory events until the retry, otherwise
+                    # an unread inotify queue would keep waking it.
+                    self._failed.add(manager)
+                    delay = manager.retry_timeout
+                self.schedule(manager, delay)
+
+            timeout = self._timeout(time.time())
+            if timeout is not None:
+                timeout = int(math.ceil(timeout * 1000))
+            with self._lock:
+                watches = dict((fd, m) for fd,m in self._watches.items() if m not in self._failed)
+
+            # poll() rather than select(), which cannot take descriptors
+            # above FD_SETSIZE.
+            poller = select.poll()
+            poller.register(self._wake, select.POLLIN)
+            for fd in watches:
+                poller.register(fd, select.POLLIN)
+            try:
+                events = poller.poll(timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd,_ in events:
+                if fd == self._wake.fileno():
+                    self._wake.drain()
+                else:
+                    self.wake(watches[fd])
+        logger.debug('Completing Scheduler run {}'.format(self))
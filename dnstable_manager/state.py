@@ -0,0 +1,162 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+State kept across restarts in an SQLite database.
+
+For every fileset, identified by its '{dname}/{base}.*.{extension}'
+pattern, the store keeps the last remote fileset with the validators it
+was retrieved with, the index of local files together with the mtime of
+the destination directory it was taken at, and the retry timeouts of
+failed downloads.  Only the differences are written as they change.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fileset (
+    key TEXT PRIMARY KEY,
+    uri TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    loaded_at REAL,
+    local_mtime REAL,
+    local_scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS remote_file (
+    fileset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (fileset, name)
+);
+CREATE TABLE IF NOT EXISTS local_file (
+    fileset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (fileset, name)
+);
+CREATE TABLE IF NOT EXISTS failure (
+    fileset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    expiry REAL NOT NULL,
+    PRIMARY KEY (fileset, name)
+);
+'''
+
+class FilesetState(object):
+    """
+    The saved state of one fileset.  'remote' and 'local' are None if
+    they were never saved.
+    """
+
+    def __init__(self):
+        self.uri = None
+        self.remote = None
+        self.etag = None
+        self.last_modified = None
+        self.loaded_at = None
+        self.local = None
+        self.local_mtime = None
+        self.local_scanned_at = None
+
+class StateStore(object):
+    """
+    Thread-safe access to the state database at path, which is created if
+    it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _row(self, key):
+        self._conn.execute('INSERT OR IGNORE INTO fileset (key) VALUES (?)', (key,))
+
+    def load(self, key):
+        """
+        Return the FilesetState saved for key.
+        """
+        state = FilesetState()
+        with self._lock:
+            row = self._conn.execute('SELECT uri, etag, last_modified, loaded_at, local_mtime, local_scanned_at FROM fileset WHERE key = ?',
+                    (key,)).fetchone()
+            if row is None:
+                return state
+            state.uri, state.etag, state.last_modified, state.loaded_at, state.local_mtime, state.local_scanned_at = row
+            if state.loaded_at is not None:
+                state.remote = set(name for name, in self._conn.execute('SELECT name FROM remote_file WHERE fileset = ?', (key,)))
+            if state.local_mtime is not None:
+                state.local = set(name for name, in self._conn.execute('SELECT name FROM local_file WHERE fileset = ?', (key,)))
+        return state
+
+    def failures(self, key):
+        """
+        Return a dict of the names of the failed downloads of key that may
+        not be retried yet -> the time they may be retried at.  Expired
+        failures are dropped.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM failure WHERE fileset = ? AND expiry <= ?', (key, time.time()))
+            return dict(self._conn.execute('SELECT name, expiry FROM failure WHERE fileset = ?', (key,)))
+
+    def save_remote(self, key, uri, added, removed, etag, last_modified, loaded_at):
+        """
+        Record the names added to and removed from the remote fileset of
+        key since it was last saved, and the validators of its response.
+        """
+        with self._lock:
+            with self._conn:
+                self._row(key)
+                self._conn.executemany('DELETE FROM remote_file WHERE fileset = ? AND name = ?', ((key, name) for name in removed))
+                self._conn.executemany('INSERT OR IGNORE INTO remote_file (fileset, name) VALUES (?, ?)', ((key, name) for name in added))
+                self._conn.execute('UPDATE fileset SET uri = ?, etag = ?, last_modified = ?, loaded_at = ? WHERE key = ?',
+                        (uri, etag, last_modified, loaded_at, key))
+
+    def save_local(self, key, added, removed, mtime, scanned_at):
+        """
+        Record the names added to and removed from the local index of key
+        since it was last saved.  'mtime' is the mtime of the destination
+        directory at 'scanned_at', before the changes were picked up.
+        """
+        with self._lock:
+            with self._conn:
+                self._row(key)
+                self._conn.executemany('DELETE FROM local_file WHERE fileset = ? AND name = ?', ((key, name) for name in removed))
+                self._conn.executemany('INSERT OR IGNORE INTO local_file (fileset, name) VALUES (?, ?)', ((key, name) for name in added))
+                self._conn.execute('UPDATE fileset SET local_mtime = ?, local_scanned_at = ? WHERE key = ?',
+                        (mtime, scanned_at, key))
+
+    def set_failure(self, key, name, expiry):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO failure (fileset, name, expiry) VALUES (?, ?, ?)', (key, name, expiry))
+
+    def clear_failure(self, key, name):
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM failure WHERE fileset = ? AND name = ?', (key, name))
@@ -12,6 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import fcntl
+import functools
+import os
+import threading
+import time
+import urllib
+
 def iterfileobj(fp, length=16*1024):
     '''iterate data from file-like object fp'''
     while 1:
@@ -19,3 +27,262 @@ def iterfileobj(fp, length=16*1024):
         if not buf:
             break
         yield buf
+
+def get_readinto(fp):
+    '''
+    Return the readinto() method of file-like object fp, or None.
+    '''
+    readinto = getattr(fp, 'readinto', None)
+    if readinto is None and isinstance(fp, urllib.addbase):
+        # urllib's addinfourl delegates to the file it wraps, without
+        # buffering of its own.
+        readinto = getattr(fp.fp, 'readinto', None)
+    return readinto
+
+def readinto_chunks(fp, buf):
+    '''
+    Iterate the data of file-like object fp as memoryviews of bytearray buf,
+    which is reused for every chunk: a chunk is only valid until the next
+    one is requested.  Falls back to read() if fp has no readinto().
+    '''
+    readinto = get_readinto(fp)
+    if readinto is None:
+        for chunk in iterfileobj(fp, len(buf)):
+            yield chunk
+        return
+
+    view = memoryview(buf)
+    while True:
+        n = readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+class WakePipe(object):
+    '''
+    Non-blocking pipe that wakes a thread sleeping in select() or poll()
+    on fileno(): notify() may be called from any thread, and the sleeper
+    calls drain() once it is awake.
+    '''
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._r
+
+    def notify(self):
+        try:
+            os.write(self._w, b'\0')
+        except OSError as e:
+            # A full pipe will wake the sleeper all the same.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drain(self):
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+def memoize(maxsize):
+    '''
+    Memoize a single-argument function, holding at most maxsize results.
+
+    Results are kept in two generations: lookups hit the current generation
+    first and promote hits from the previous one, and when the current
+    generation fills up it replaces the previous one.  This approximates
+    LRU eviction at the cost of a plain dict lookup.
+    '''
+    def decorator(func):
+        generations = [dict(), dict()]
+        limit = max(1, maxsize // 2)
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            current, previous = generations
+            try:
+                return current[arg]
+            except KeyError:
+                pass
+            try:
+                result = previous[arg]
+            except KeyError:
+                result = func(arg)
+            if len(current) >= limit:
+                current = dict()
+                generations[:] = [current, generations[0]]
+            current[arg] = result
+            return result
+
+        def cache_clear():
+            generations[:] = [dict(), dict()]
+
+        wrapper.cache_clear = cache_clear
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+class IndexedHeap(object):
+    '''
+    Priority queue of distinct, hashable items that pops the largest item
+    first.  The position of every item is indexed so that push(), pop()
+    and remove() are all O(log n).
+    '''
+    def __init__(self, iterable=()):
+        self._heap = []
+        self._index = dict()
+        for item in iterable:
+            self.push(item)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __nonzero__(self):
+        return bool(self._heap)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        return iter(list(self._heap))
+
+    def push(self, item):
+        '''Add item, returning False if it was already present.'''
+        if item in self._index:
+            return False
+        self._heap.append(item)
+        self._index[item] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+        return True
+
+    def peek(self):
+        if not self._heap:
+            raise IndexError('peek from empty heap')
+        return self._heap[0]
+
+    def pop(self):
+        if not self._heap:
+            raise IndexError('pop from empty heap')
+        item = self._heap[0]
+        self._remove_at(0)
+        return item
+
+    def remove(self, item):
+        '''Remove item, returning False if it was not present.'''
+        pos = self._index.get(item)
+        if pos is None:
+            return False
+        self._remove_at(pos)
+        return True
+
+    def clear(self):
+        del self._heap[:]
+        self._index.clear()
+
+    def _remove_at(self, pos):
+        heap = self._heap
+        del self._index[heap[pos]]
+        last = heap.pop()
+        if pos < len(heap):
+            heap[pos] = last
+            self._index[last] = pos
+            self._sift_down(pos)
+            self._sift_up(pos)
+
+    def _sift_up(self, pos):
+        heap, index = self._heap, self._index
+        item = heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not item > heap[parent]:
+                break
+            heap[pos] = heap[parent]
+            index[heap[pos]] = pos
+            pos = parent
+        heap[pos] = item
+        index[item] = pos
+
+    def _sift_down(self, pos):
+        heap, index = self._heap, self._index
+        size = len(heap)
+        item = heap[pos]
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] > heap[child]:
+                child += 1
+            if not heap[child] > item:
+                break
+            heap[pos] = heap[child]
+            index[heap[pos]] = pos
+            pos = child
+        heap[pos] = item
+        index[item] = pos
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket limiting a rate in units (e.g. bytes) per
+    second, allowing bursts of up to burst units.  A rate of None or 0
+    disables the limit.
+    '''
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._burst = None
+        self._tokens = 0.0
+        self._last = time.time()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate, burst=None):
+        '''
+        Change the rate, which takes effect for subsequent consume() calls.
+        burst defaults to one second worth of tokens.
+        '''
+        with self._lock:
+            self._refill(time.time())
+            self._rate = rate or None
+            self._burst = burst or rate or None
+            if self._burst is not None:
+                self._tokens = min(self._tokens, self._burst)
+
+    def _refill(self, now):
+        if self._rate:
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def reserve(self, amount):
+        '''
+        Take amount tokens without waiting for them.  Returns the number of
+        seconds until they are earned, which the caller should wait before
+        going on.
+        '''
+        with self._lock:
+            if not self._rate:
+                return 0
+            now = time.time()
+            self._refill(now)
+            # Taking tokens ahead of time reserves them, so that concurrent
+            # callers queue up behind each other instead of all waking at
+            # once.
+            self._tokens -= amount
+            return -self._tokens / self._rate if self._tokens < 0 else 0
+
+    def consume(self, amount):
+        '''
+        Take amount tokens, sleeping for as long as it takes to earn them.
+        Returns the number of seconds slept.
+        '''
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
@@ -19,13 +19,15 @@ import httplib
 import os
 import shutil
 import tempfile
+import threading
 import time
 import unittest
 import urllib
 import urllib2
 
-from dnstable_manager import get_config, DNSTableManager
+from dnstable_manager import get_config, ConfigException, DNSTableManager
 from dnstable_manager.download import DownloadManager
+from dnstable_manager.scheduler import Scheduler
 import jsonschema
 
 def get_uri(obj):
@@ -34,10 +36,47 @@ def get_uri(obj):
     return obj
 
 class TestGetConfig(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+
+    def tearDown(self):
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def get_config(self, downloader):
+        ca_file = os.path.join(self.td, 'ca.crt')
+        open(ca_file, 'w').close()
+        downloader = ''.join('        {}: {}\n'.format(k, v) for k, v in sorted(downloader.items()))
+        return get_config(stream=StringIO(
+            'downloader:\n'
+            '        ssl_ca_file: {}\n'
+            '{}'
+            'filesets:\n'
+            '        dns:\n'
+            '                uri: http://example.com/dns.fileset\n'
+            '                destination: {}\n'
+            '                base: dns\n'
+            '                extension: mtbl\n'
+            '                frequency: 1800\n'.format(ca_file, downloader, self.td)))
+
     def test_get_config_default(self):
         with self.assertRaises(jsonschema.ValidationError):
             get_config()
 
+    def test_get_config(self):
+        config = self.get_config({})
+        self.assertEqual(config['filesets']['dns']['destination'], self.td)
+
+    def test_pipeline_depth(self):
+        self.get_config(dict(pipeline_depth=0))
+        self.get_config(dict(pipeline_depth=2))
+        with self.assertRaises(jsonschema.ValidationError):
+            self.get_config(dict(pipeline_depth=1))
+
+    def test_min_downloads(self):
+        self.get_config(dict(min_downloads=2, max_downloads=2))
+        with self.assertRaises(ConfigException):
+            self.get_config(dict(min_downloads=3, max_downloads=2))
+
 class TestDNSTableManager(unittest.TestCase):
     @staticmethod
     def noop(self, *args, **kwargs): pass
@@ -97,6 +136,89 @@ class TestDNSTableManager(unittest.TestCase):
             self.assertEqual(open(os.path.join(self.td, fn)).read(), fn)
         d.stop(blocking=True)
 
+    def test_remote_fetch_on_worker(self):
+        slow_uri = 'http://slow.example.com/dns.fileset'
+        fast_uri = 'http://fast.example.com/dns.fileset'
+        release = threading.Event()
+
+        def my_urlopen(obj, timeout=None):
+            uri = get_uri(obj)
+            if uri == slow_uri:
+                release.wait(5)
+            return urllib.addinfourl(StringIO('dns.2014.Y.mtbl\n'),
+                    httplib.HTTPMessage(StringIO()), uri)
+        urllib2.urlopen = my_urlopen
+
+        slow_dir = os.path.join(self.td, 'slow')
+        fast_dir = os.path.join(self.td, 'fast')
+        os.mkdir(slow_dir)
+        os.mkdir(fast_dir)
+
+        d = DownloadManager()
+        slow = DNSTableManager(slow_uri, slow_dir, download_manager=d, digest_required=False)
+        fast = DNSTableManager(fast_uri, fast_dir, download_manager=d, digest_required=False)
+        scheduler = Scheduler()
+        scheduler.add(slow)
+        scheduler.add(fast)
+        scheduler.start()
+        try:
+            for i in range(50):
+                if fast.fileset.remote_loaded:
+                    break
+                self.orig_sleep(0.1)
+            # The hung remote of the other fileset holds up neither the
+            # scheduler nor the other manager.
+            self.assertTrue(fast.fileset.remote_loaded)
+            self.assertFalse(slow.fileset.remote_loaded)
+
+            release.set()
+            for i in range(50):
+                if slow.fileset.remote_loaded:
+                    break
+                self.orig_sleep(0.1)
+            self.assertTrue(slow.fileset.remote_loaded)
+            self.assertGreater(slow.next_remote_load, time.time())
+        finally:
+            release.set()
+            scheduler.stop(blocking=True, timeout=5)
+
+    def test_remote_fetch_retry(self):
+        fetches = []
+
+        def my_urlopen(obj, timeout=None):
+            fetches.append(time.time())
+            self.orig_sleep(0.6)
+            raise urllib2.URLError('unreachable')
+        urllib2.urlopen = my_urlopen
+
+        d = DownloadManager()
+        m = DNSTableManager('http://example.com/dns.fileset', self.td, download_manager=d,
+                retry_timeout=1, digest_required=False)
+        # The step that takes over the failure fails itself, so that the
+        # scheduler does not get its delay.
+        load_local_fileset = m.fileset.load_local_fileset
+        local_failures = []
+        def my_load_local_fileset():
+            if fetches and not local_failures:
+                local_failures.append(time.time())
+                raise OSError('unavailable')
+            load_local_fileset()
+        m.fileset.load_local_fileset = my_load_local_fileset
+
+        scheduler = Scheduler()
+        scheduler.add(m)
+        scheduler.start()
+        try:
+            for i in range(50):
+                if len(fetches) >= 2:
+                    break
+                self.orig_sleep(0.1)
+            self.assertEqual(len(fetches), 2)
+            # Retried retry_timeout after the failed attempt started.
+            self.assertLess(fetches[1] - fetches[0], 1.3)
+        finally:
+            scheduler.stop(blocking=True, timeout=5)
+
     def test_clean_tempfiles(self):
         m = DNSTableManager(os.path.join('file://', self.td), self.td, base='dns', download_manager=None)
         closed_file = os.path.join(self.td, '.dns.2000.Y.mtbl.XXXXXX')
@@ -109,3 +231,15 @@ class TestDNSTableManager(unittest.TestCase):
 
         self.assertTrue(os.path.exists(opened_file))
         self.assertFalse(os.path.exists(closed_file))
+
+    def test_clean_tempfiles_keeps_partial(self):
+        m = DNSTableManager(os.path.join('file://', self.td), self.td, base='dns', download_manager=None)
+        partial_file = os.path.join(self.td, '.dns.2000.Y.mtbl.partial')
+        meta_file = partial_file + '.meta'
+        open(partial_file, 'w')
+        open(meta_file, 'w')
+
+        m.clean_tempfiles()
+
+        self.assertTrue(os.path.exists(partial_file))
+        self.assertTrue(os.path.exists(meta_file))
@@ -0,0 +1,80 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnstable_manager.audit import Auditor, hash_file, read_digest_file
+from dnstable_manager.fileset import Fileset
+
+class StubManager(object):
+    def __init__(self, fileset):
+        self.fileset = fileset
+        self.scheduler = None
+
+class TestAuditor(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        self.manager = StubManager(Fileset(None, self.td))
+        self.auditor = Auditor(processes=1)
+
+    def tearDown(self):
+        self.auditor.close()
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def write(self, name, data, digest_data=None):
+        fname = os.path.join(self.td, name)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+        if digest_data is not None:
+            with open(fname + '.sha256', 'w') as fp:
+                fp.write('{}  {}\n'.format(hashlib.sha256(digest_data).hexdigest(), name))
+        return fname
+
+    def test_read_digest_file(self):
+        fname = self.write('dns.2015.Y.mtbl', 'abc', 'abc')
+        self.assertEqual(read_digest_file(fname), ('sha256', hashlib.sha256('abc').hexdigest()))
+        self.assertIsNone(read_digest_file(fname + '.missing'))
+
+    def test_hash_file(self):
+        fname = self.write('dns.2015.Y.mtbl', 'abc' * 100000)
+        self.assertEqual(hash_file(fname, 'sha256', buffer_size=1024), hashlib.sha256('abc' * 100000).hexdigest())
+
+    def test_audit(self):
+        self.write('dns.2015.Y.mtbl', 'good', 'good')
+        self.write('dns.2016.Y.mtbl', 'no digest')
+        self.assertEqual(self.auditor.audit(self.manager), dict(checked=1, skipped=0, failed=0))
+        # Unchanged files are not hashed again.
+        self.assertEqual(self.auditor.audit(self.manager), dict(checked=0, skipped=1, failed=0))
+
+        self.write('dns.2015.Y.mtbl', 'changed')
+        self.assertEqual(self.auditor.audit(self.manager), dict(checked=1, skipped=0, failed=1))
+
+    def test_quarantine(self):
+        self.write('dns.2015.Y.mtbl', 'bad', 'good')
+        self.write('dns.2016.Y.mtbl', 'good', 'good')
+        self.assertEqual(self.auditor.audit(self.manager), dict(checked=2, skipped=0, failed=1))
+        self.assertItemsEqual(os.listdir(self.td), [
+            '.dns.audit',
+            '.dns.2015.Y.mtbl.quarantine',
+            '.dns.2015.Y.mtbl.sha256.quarantine',
+            'dns.2016.Y.mtbl',
+            'dns.2016.Y.mtbl.sha256',
+            ])
+        self.assertEqual(self.manager.fileset.list_temporary_files(), [])
@@ -0,0 +1,63 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import unittest
+
+from dnstable_manager.concurrency import ConcurrencyController
+from dnstable_manager.download import DownloadManager
+
+class TestConcurrencyController(unittest.TestCase):
+    def test_invalid(self):
+        self.assertRaises(ValueError, ConcurrencyController, 0, 4)
+        self.assertRaises(ValueError, ConcurrencyController, 4, 2)
+
+    def test_increase_while_goodput_grows(self):
+        c = ConcurrencyController(1, 4)
+        self.assertEqual(c.slots, 1)
+        self.assertEqual(c.update(100, 1, 0, True), 2)
+        self.assertEqual(c.update(200, 1, 0, True), 3)
+        self.assertEqual(c.update(300, 1, 0, True), 4)
+        # Capped at max_slots.
+        self.assertEqual(c.update(400, 1, 0, True), 4)
+
+    def test_not_saturated(self):
+        c = ConcurrencyController(1, 4)
+        self.assertEqual(c.update(100, 1, 0, False), 1)
+
+    def test_step_back_and_hold(self):
+        c = ConcurrencyController(1, 8, hold=2)
+        c.update(100, 1, 0, True)
+        c.update(200, 1, 0, True)
+        self.assertEqual(c.slots, 3)
+        # The third slot did not add goodput.
+        self.assertEqual(c.update(200, 1, 0, True), 2)
+        self.assertEqual(c.update(200, 1, 0, True), 2)
+        self.assertEqual(c.update(200, 1, 0, True), 2)
+        self.assertEqual(c.update(200, 1, 0, True), 3)
+
+    def test_decrease_on_errors(self):
+        c = ConcurrencyController(1, 16)
+        c.slots = 8
+        self.assertEqual(c.update(100, 1, 3, True), 4)
+        c.slots = 1
+        self.assertEqual(c.update(100, 0, 3, True), 1)
+
+class TestAdaptiveDownloadManager(unittest.TestCase):
+    def test_slots(self):
+        m = DownloadManager(max_downloads=8)
+        self.assertEqual(m.slots, 8)
+        m = DownloadManager(max_downloads=8, min_downloads=2)
+        self.assertEqual(m.slots, 2)
@@ -16,17 +16,23 @@ from __future__ import print_function
 
 from cStringIO import StringIO
 import base64
+import collections
+import errno
 import hashlib
 import httplib
 import os
+import shutil
+import stat
 import tempfile
+import threading
+import time
 import unittest
 import urllib
 import urllib2
 
 from . import get_uri
-from dnstable_manager.download import DownloadManager
-from dnstable_manager.fileset import File
+from dnstable_manager.download import DownloadManager, PartialDownload, PendingDownloads, PipelinedWriter, parse_content_range, split_ranges
+from dnstable_manager.fileset import File, FilesetContext, ValidationFailed
 
 class TestDownloadManager(unittest.TestCase):
     @staticmethod
@@ -112,6 +118,44 @@ class TestDownloadManager(unittest.TestCase):
             except OSError:
                 pass
 
+    def test_download_callback(self):
+        tf = tempfile.NamedTemporaryFile(prefix='dns-test-dnstable-manager_download-', suffix='.2015.Y.mtbl', delete=True)
+        test_data = 'abc\n123\n'
+        f = File(os.path.basename(tf.name), dname=os.path.dirname(tf.name), digest_required=False)
+        f.uri = 'http://example.com/{}'.format(f.name)
+        def my_urlopen(obj, timeout=None):
+            return urllib.addinfourl(StringIO(test_data), httplib.HTTPMessage(StringIO('Content-Length: {}'.format(len(test_data)))), f.uri)
+        urllib2.urlopen = my_urlopen
+
+        results = []
+        m = DownloadManager()
+        m.add_callback(lambda f, error: results.append((f, error)))
+        try:
+            m._download(f)
+            self.assertEqual(results, [(f, None)])
+        finally:
+            m.stop()
+
+    def test_download_callback_failed(self):
+        tf = tempfile.NamedTemporaryFile(prefix='dns-test-dnstable-manager_download-', suffix='.2015.Y.mtbl', delete=True)
+        test_data = 'abc\n123\n'
+        f = File(os.path.basename(tf.name), dname=os.path.dirname(tf.name))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        def my_urlopen(obj, timeout=None):
+            return urllib.addinfourl(StringIO(test_data), httplib.HTTPMessage(StringIO('Content-Length: {}'.format(len(test_data)))), f.uri)
+        urllib2.urlopen = my_urlopen
+
+        results = []
+        m = DownloadManager()
+        m.add_callback(lambda f, error: results.append((f, error)))
+        try:
+            m._download(f)
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0][0], f)
+            self.assertIsNotNone(results[0][1])
+        finally:
+            m.stop()
+
     def test_download_bad_content_length(self):
         tf = tempfile.NamedTemporaryFile(prefix='dns-test-dnstable-manager_download-', suffix='.2015.Y.mtbl', delete=True)
         test_data = 'abc\n123\n'
@@ -153,3 +197,753 @@ class TestDownloadManager(unittest.TestCase):
                 os.unlink(digest_file)
             except OSError:
                 pass
+
+    def test_failed_download_expires(self):
+        f = File('dns.2015.Y.mtbl', dname=tempfile.gettempdir())
+        f.uri = 'http://example.com/{}'.format(f.name)
+        def my_urlopen(obj, timeout=None):
+            raise urllib2.URLError('unreachable')
+        urllib2.urlopen = my_urlopen
+
+        m = DownloadManager(retry_timeout=0.1)
+        try:
+            m._download(f)
+            self.assertIn(f, m)
+            self.assertIsNotNone(m._expire_failed_downloads(time.time()))
+            self.assertIn(f, m)
+            self.assertIsNone(m._expire_failed_downloads(time.time() + 1))
+            self.assertNotIn(f, m)
+        finally:
+            m.stop()
+
+    def test_run_loop_sleeps(self):
+        f = File('dns.2015.Y.mtbl', dname=tempfile.gettempdir())
+        f.uri = 'http://example.com/{}'.format(f.name)
+
+        # Timed Condition waits poll through threading._sleep.
+        sleeps = []
+        orig_sleep = threading._sleep
+        def my_sleep(seconds):
+            sleeps.append(seconds)
+            orig_sleep(seconds)
+        threading._sleep = my_sleep
+        m = DownloadManager()
+        try:
+            m.start()
+            m.add_failed(f, time.time() + 0.3)
+            time.sleep(0.2)
+            self.assertIn(f, m)
+            time.sleep(0.3)
+            self.assertNotIn(f, m)
+            self.assertEqual(sleeps, [])
+        finally:
+            threading._sleep = orig_sleep
+            m.stop(blocking=True)
+
+    def test_worker_pool(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        files = [File('dns.2015010{}.D.mtbl'.format(i), dname=td, digest_required=False) for i in range(1, 8)]
+        for f in files:
+            f.uri = 'http://example.com/{}'.format(f.name)
+
+        lock = threading.Lock()
+        active = set()
+        max_active = [0]
+        threads = set()
+        release = threading.Event()
+        def my_urlopen(obj, timeout=None):
+            with lock:
+                active.add(obj)
+                threads.add(threading.current_thread())
+                max_active[0] = max(max_active[0], len(active))
+            release.wait(5)
+            with lock:
+                active.discard(obj)
+            return urllib.addinfourl(StringIO('abc'), httplib.HTTPMessage(StringIO('')), get_uri(obj))
+        urllib2.urlopen = my_urlopen
+
+        done = threading.Semaphore(0)
+        m = DownloadManager(max_downloads=2)
+        m.add_callback(lambda f, error: done.release())
+        m.start()
+        try:
+            for f in files:
+                m.enqueue(f)
+                self.assertIn(f, m)
+            for i in range(50):
+                if max_active[0] >= 2:
+                    break
+                time.sleep(0.1)
+            release.set()
+            for f in files:
+                done.acquire()
+            self.assertEqual(max_active[0], 2)
+            self.assertEqual(len(threads), 2)
+            self.assertItemsEqual(os.listdir(td), [f.name for f in files])
+        finally:
+            release.set()
+            m.stop(blocking=True)
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_cancel(self):
+        files = [File('dns.2015010{}.D.mtbl'.format(i), dname=tempfile.gettempdir()) for i in range(1, 4)]
+
+        m = DownloadManager()
+        for f in files:
+            m.enqueue(f)
+        self.assertTrue(m.cancel(files[1]))
+        self.assertNotIn(files[1], m)
+        self.assertFalse(m.cancel(files[1]))
+        self.assertEqual([m._pending_downloads.pop() for i in range(2)], [files[2], files[0]])
+
+    def _partial_download(self, td, test_data, headers, responses):
+        f = File('dns.2015.Y.mtbl', dname=td)
+        f.uri = 'http://example.com/{}'.format(f.name)
+        requests = []
+        def my_urlopen(obj, timeout=None):
+            requests.append(obj)
+            code, data, extra = responses.pop(0)
+            if isinstance(data, Exception):
+                raise data
+            fp = urllib.addinfourl(StringIO(data), httplib.HTTPMessage(StringIO('\r\n'.join(headers + extra))), f.uri, code=code)
+            return fp
+        urllib2.urlopen = my_urlopen
+        return f, requests
+
+    def test_download_resume(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        headers = ['ETag: "v1"', 'Digest: SHA-256={}'.format(digest)]
+        responses = [
+                (200, test_data[:40], ['Content-Length: {}'.format(len(test_data))]),
+                (206, test_data[40:], ['Content-Length: {}'.format(len(test_data) - 40),
+                    'Content-Range: bytes 40-{}/{}'.format(len(test_data) - 1, len(test_data))]),
+                ]
+        f, requests = self._partial_download(td, test_data, headers, responses)
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            self.assertEqual(open(f.partial()).read(), test_data[:40])
+            self.assertTrue(os.path.exists(f.partial() + '.meta'))
+
+            m._download(f)
+            self.assertEqual(requests[1].get_header('Range'), 'bytes=40-')
+            self.assertEqual(requests[1].get_header('If-range'), '"v1"')
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertItemsEqual(os.listdir(td), [f.name, f.name + '.sha256'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_resume_small_buffer(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = ''.join(chr(i % 251) for i in range(1000))
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        headers = ['ETag: "v1"', 'Digest: SHA-256={}'.format(digest)]
+        responses = [
+                (200, test_data[:500], ['Content-Length: {}'.format(len(test_data))]),
+                (206, test_data[500:], ['Content-Length: {}'.format(len(test_data) - 500),
+                    'Content-Range: bytes 500-{}/{}'.format(len(test_data) - 1, len(test_data))]),
+                ]
+        f, requests = self._partial_download(td, test_data, headers, responses)
+
+        m = DownloadManager(buffer_size=7)
+        try:
+            m._download(f)
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_pipelined(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = ''.join(chr(i % 251) for i in range(10000))
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        responses = [(200, test_data, ['Content-Length: {}'.format(len(test_data)), 'Digest: SHA-256={}'.format(digest)])]
+        f, requests = self._partial_download(td, test_data, [], responses)
+
+        m = DownloadManager(buffer_size=1000, pipeline_depth=3)
+        try:
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertEqual(m.host_stats()['example.com']['bytes'], len(test_data))
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_resume_changed(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        responses = [
+                (200, 'old', ['ETag: "v1"', 'Content-Length: 10']),
+                (200, test_data, ['ETag: "v2"', 'Digest: SHA-256={}'.format(digest)]),
+                ]
+        f, requests = self._partial_download(td, test_data, [], responses)
+        f.context.digest_required = False
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertEqual(open(f.partial()).read(), 'old')
+            m._download(f)
+            self.assertIsNotNone(requests[1].get_header('Range'))
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertFalse(os.path.exists(f.partial()))
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_resume_bad_digest(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        headers = ['Last-Modified: Thu, 01 Jan 2015 00:00:00 GMT', 'Digest: SHA-256={}'.format(digest)]
+        responses = [
+                (200, 'XXXX', ['Content-Length: {}'.format(len(test_data))]),
+                (206, test_data[4:], ['Content-Range: bytes 4-{}/{}'.format(len(test_data) - 1, len(test_data))]),
+                ]
+        f, requests = self._partial_download(td, test_data, headers, responses)
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            m._download(f)
+            self.assertEqual(requests[1].get_header('If-range'), 'Thu, 01 Jan 2015 00:00:00 GMT')
+            self.assertIn(f, m._failed_downloads)
+            self.assertEqual(os.listdir(td), [])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_not_resumable(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        responses = [(200, 'abc', ['Content-Length: 10'])]
+        f, requests = self._partial_download(td, 'abc', [], responses)
+        f.context.digest_required = False
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            self.assertEqual(os.listdir(td), [])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def _segmented_urlopen(self, f, test_data, headers, requests):
+        def my_urlopen(obj, timeout=None):
+            requests.append(obj)
+            if obj.get_method() == 'HEAD':
+                return urllib.addinfourl(StringIO(''), httplib.HTTPMessage(StringIO('\r\n'.join(headers + [
+                    'Content-Length: {}'.format(len(test_data))]))), f.uri, code=200)
+            unit, _, spec = obj.get_header('Range').partition('=')
+            first, last = (int(x) for x in spec.split('-'))
+            data = test_data[first:last + 1]
+            return urllib.addinfourl(StringIO(data), httplib.HTTPMessage(StringIO('\r\n'.join(headers + [
+                'Content-Length: {}'.format(len(data)),
+                'Content-Range: bytes {}-{}/{}'.format(first, last, len(test_data))]))), f.uri, code=206)
+        return my_urlopen
+
+    def test_download_segmented(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = ''.join(chr(i % 251) for i in range(1000))
+        digest = base64.b64encode(hashlib.sha256(test_data).digest())
+        headers = ['ETag: "v1"', 'Accept-Ranges: bytes', 'Digest: SHA-256={}'.format(digest)]
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, segments=4, segment_size=300))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        requests = []
+        urllib2.urlopen = self._segmented_urlopen(f, test_data, headers, requests)
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertNotIn(f, m._failed_downloads)
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertItemsEqual([r.get_header('Range') for r in requests[1:]], ['bytes=0-333', 'bytes=334-667', 'bytes=668-999'])
+            self.assertItemsEqual(os.listdir(td), [f.name, f.name + '.sha256'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_segmented_host_limit(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'x' * 1000
+        headers = ['ETag: "v1"', 'Accept-Ranges: bytes']
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, segments=4, segment_size=100, digest_required=False))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        requests = []
+        urllib2.urlopen = self._segmented_urlopen(f, test_data, headers, requests)
+
+        m = DownloadManager(max_downloads_per_host=2)
+        try:
+            m.enqueue(f)
+            self.assertIs(m._take_download(threading.current_thread()), f)
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+            # The download slot of f and one more connection to the host.
+            self.assertItemsEqual([r.get_header('Range') for r in requests[1:]], ['bytes=0-499', 'bytes=500-999'])
+            self.assertEqual(m._active_hosts, {})
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_segmented_bad_digest(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'x' * 1000
+        headers = ['ETag: "v1"', 'Accept-Ranges: bytes', 'Digest: SHA-256={}'.format(base64.b64encode(hashlib.sha256('y').digest()))]
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, segments=4, segment_size=300))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        urllib2.urlopen = self._segmented_urlopen(f, test_data, headers, [])
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            self.assertEqual(os.listdir(td), [])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_segmented_no_ranges(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'x' * 1000
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, segments=4, segment_size=300, digest_required=False))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        requests = []
+        def my_urlopen(obj, timeout=None):
+            requests.append(obj.get_method())
+            return urllib.addinfourl(StringIO(test_data), httplib.HTTPMessage(StringIO('Content-Length: {}'.format(len(test_data)))), f.uri, code=200)
+        urllib2.urlopen = my_urlopen
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertEqual(requests, ['HEAD', 'GET'])
+            self.assertEqual(open(f.target()).read(), test_data)
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_max_downloads_per_host(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        files = []
+        for i, host in enumerate(('a', 'a', 'a', 'b', 'b')):
+            f = File('dns.2015010{}.D.mtbl'.format(i + 1), dname=td, digest_required=False)
+            f.uri = 'http://{}.example.com/{}'.format(host, f.name)
+            files.append(f)
+
+        lock = threading.Lock()
+        active = collections.Counter()
+        max_active = collections.Counter()
+        release = threading.Event()
+        def my_urlopen(obj, timeout=None):
+            host = obj.get_host()
+            with lock:
+                active[host] += 1
+                max_active[host] = max(max_active[host], active[host])
+            release.wait(5)
+            with lock:
+                active[host] -= 1
+            return urllib.addinfourl(StringIO('abc'), httplib.HTTPMessage(StringIO('')), get_uri(obj))
+        urllib2.urlopen = my_urlopen
+
+        done = threading.Semaphore(0)
+        m = DownloadManager(max_downloads=4, max_downloads_per_host=1)
+        m.add_callback(lambda f, error: done.release())
+        m.start()
+        try:
+            for f in files:
+                m.enqueue(f)
+            for i in range(50):
+                if len(max_active) >= 2:
+                    break
+                time.sleep(0.1)
+            release.set()
+            for f in files:
+                done.acquire()
+            self.assertEqual(max_active, {'a.example.com': 1, 'b.example.com': 1})
+
+            stats = m.host_stats()
+            self.assertEqual(stats['a.example.com']['downloads'], 3)
+            self.assertEqual(stats['a.example.com']['bytes'], 9)
+            self.assertEqual(stats['b.example.com']['downloads'], 2)
+        finally:
+            release.set()
+            m.stop(blocking=True)
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_host_stats_parallel(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        files = []
+        for i in range(4):
+            f = File('dns.2015010{}.D.mtbl'.format(i + 1), dname=td, digest_required=False)
+            f.uri = 'http://example.com/{}'.format(f.name)
+            files.append(f)
+
+        def my_urlopen(obj, timeout=None):
+            time.sleep(0.3)
+            return urllib.addinfourl(StringIO('abc'), httplib.HTTPMessage(StringIO('')), get_uri(obj))
+        urllib2.urlopen = my_urlopen
+
+        done = threading.Semaphore(0)
+        m = DownloadManager(max_downloads=4)
+        m.add_callback(lambda f, error: done.release())
+        try:
+            for f in files:
+                m.enqueue(f)
+            m.start()
+            for f in files:
+                done.acquire()
+
+            # The four downloads ran side by side, for the wall-clock time
+            # of about one of them.
+            stats = m.host_stats()['example.com']
+            self.assertGreaterEqual(stats['seconds'], 0.3)
+            self.assertLess(stats['seconds'], 0.9)
+            self.assertAlmostEqual(stats['throughput'], 12 / stats['seconds'])
+        finally:
+            m.stop(blocking=True)
+            shutil.rmtree(td, ignore_errors=True)
+
+    def _validator(self, td, script):
+        validator = os.path.join(td, 'validator')
+        with open(validator, 'w') as fp:
+            fp.write('#!/bin/sh\n{}\n'.format(script))
+        os.chmod(validator, 0o755)
+        return validator
+
+    def test_validator_pool(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        gate = os.path.join(td, 'gate')
+        validator = self._validator(td, 'while [ ! -e {} ]; do sleep 0.01; done\necho "$1" is valid'.format(gate))
+        files = [File('dns.2015010{}.D.mtbl'.format(i), dname=td, digest_required=False, validator=validator) for i in range(1, 3)]
+        for f in files:
+            f.uri = 'http://example.com/{}'.format(f.name)
+
+        requested = threading.Semaphore(0)
+        def my_urlopen(obj, timeout=None):
+            requested.release()
+            return urllib.addinfourl(StringIO('abc'), httplib.HTTPMessage(StringIO('')), get_uri(obj))
+        urllib2.urlopen = my_urlopen
+
+        results = dict()
+        done = threading.Semaphore(0)
+        def callback(f, error):
+            results[f] = error
+            done.release()
+        m = DownloadManager(max_downloads=1, max_validations=2)
+        m.add_callback(callback)
+        m.start()
+        try:
+            for f in files:
+                m.enqueue(f)
+            # The single download slot is free again while the first file
+            # is still being validated.
+            for f in files:
+                requested.acquire()
+            for f in files:
+                self.assertIn(f, m)
+                self.assertFalse(os.path.exists(f.target()))
+
+            open(gate, 'w').close()
+            for f in files:
+                done.acquire()
+            self.assertEqual(results, dict((f, None) for f in files))
+            for f in files:
+                self.assertNotIn(f, m)
+                self.assertEqual(open(f.target()).read(), 'abc')
+        finally:
+            open(gate, 'w').close()
+            m.stop(blocking=True)
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_validation_failed(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        validator = self._validator(td, 'echo checking; echo "$1" is corrupt >&2; exit 1')
+        f = File('dns.2015.Y.mtbl', dname=td, digest_required=False, validator=validator)
+        f.uri = 'http://example.com/{}'.format(f.name)
+        urllib2.urlopen = lambda obj, timeout=None: urllib.addinfourl(StringIO('abc'), httplib.HTTPMessage(StringIO('')), get_uri(obj))
+
+        results = []
+        m = DownloadManager()
+        m.add_callback(lambda f, error: results.append(error))
+        try:
+            m._download(f)
+            self.assertIsInstance(results[0], ValidationFailed)
+            self.assertIn('{} is corrupt'.format(f.partial()), str(results[0]))
+            self.assertEqual(os.listdir(td), ['validator'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_validator_stdin(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        seen = os.path.join(td, 'seen')
+        validator = self._validator(td, '[ "$1" = - ] && cat > {}'.format(seen))
+        responses = [
+                (200, test_data[:40], ['Content-Length: {}'.format(len(test_data))]),
+                (206, test_data[40:], ['Content-Length: {}'.format(len(test_data) - 40),
+                    'Content-Range: bytes 40-{}/{}'.format(len(test_data) - 1, len(test_data))]),
+                ]
+        f, requests = self._partial_download(td, test_data, ['ETag: "v1"'], responses)
+        f.context.digest_required = False
+        f.context.validator = validator
+        f.context.validator_stdin = True
+
+        m = DownloadManager(max_validations=1)
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            self.assertTrue(os.path.exists(f.partial()))
+
+            # The resumed download is validated as a whole, and not again
+            # in the validator pool.
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertEqual(open(seen).read(), test_data)
+            self.assertNotIn(f, m._validating)
+            self.assertItemsEqual(os.listdir(td), [f.name, 'seen', 'validator'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_validator_stdin_failed(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        validator = self._validator(td, 'head -c 1 > /dev/null; echo corrupt >&2; exit 1')
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, digest_required=False, validator=validator, validator_stdin=True))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        urllib2.urlopen = lambda obj, timeout=None: urllib.addinfourl(StringIO('abc' * 100000),
+                httplib.HTTPMessage(StringIO('ETag: "v1"')), get_uri(obj))
+
+        results = []
+        m = DownloadManager(buffer_size=1000)
+        m.add_callback(lambda f, error: results.append(error))
+        try:
+            m._download(f)
+            self.assertIsInstance(results[0], ValidationFailed)
+            self.assertIn('corrupt', str(results[0]))
+            # The partial is not kept for resuming.
+            self.assertEqual(os.listdir(td), ['validator'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_validator_stdin_interrupted(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        pid_file = os.path.join(td, 'pid')
+        validator = self._validator(td, 'echo $$ > {}; cat > /dev/null; exec sleep 10'.format(pid_file))
+        f = File('dns.2015.Y.mtbl', context=FilesetContext(dname=td, digest_required=False, validator=validator, validator_stdin=True))
+        f.uri = 'http://example.com/{}'.format(f.name)
+        class BrokenBody(object):
+            def __init__(self):
+                self.chunks = ['abc']
+            def read(self, n=-1):
+                if not self.chunks:
+                    # Fail once the validator is surely running.
+                    for i in range(500):
+                        if os.path.exists(pid_file) and open(pid_file).read().endswith('\n'):
+                            break
+                        time.sleep(0.01)
+                    raise IOError('connection reset')
+                return self.chunks.pop()
+            def readline(self):
+                return self.read()
+        # Without a Content-Length, only the read error tells that the body
+        # is incomplete.
+        urllib2.urlopen = lambda obj, timeout=None: urllib.addinfourl(BrokenBody(), httplib.HTTPMessage(StringIO('ETag: "v1"')), get_uri(obj))
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            # The validator was killed and reaped rather than left a zombie.
+            pid = int(open(pid_file).read())
+            with self.assertRaises(OSError) as cm:
+                os.kill(pid, 0)
+            self.assertEqual(cm.exception.errno, errno.ESRCH)
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def _local_source(self, td, data, digest_data=None, mode=0o644):
+        source = os.path.join(td, 'source')
+        os.mkdir(source)
+        f = File('dns.2015.Y.mtbl', dname=os.path.join(td, 'dest'))
+        os.mkdir(f.dname)
+        f.uri = 'file://{}'.format(os.path.join(source, f.name))
+        fname = os.path.join(source, f.name)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+        os.chmod(fname, mode)
+        os.utime(fname, (1420070400.5, 1420070400.5))
+        if digest_data is not None:
+            with open(fname + '.sha256', 'w') as fp:
+                fp.write('{}  {}\n'.format(hashlib.sha256(digest_data).hexdigest(), f.name))
+        return f, fname
+
+    def test_download_local(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        f, source = self._local_source(td, test_data, test_data)
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+            # Hardlinked, leaving the source untouched.
+            st = os.stat(source)
+            self.assertEqual(os.stat(f.target()).st_ino, st.st_ino)
+            self.assertEqual(st.st_mtime, 1420070400.5)
+            self.assertEqual(stat.S_IMODE(st.st_mode), 0o644)
+            self.assertEqual(open(f.target() + '.sha256').read(), open(source + '.sha256').read())
+            self.assertItemsEqual(os.listdir(f.dname), [f.name, f.name + '.sha256'])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_local_mode(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = 'abc\n123\n' * 16
+        f, source = self._local_source(td, test_data, test_data, mode=0o600)
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            # Copied rather than linked, since the mode has to change.
+            st = os.stat(source)
+            self.assertNotEqual(os.stat(f.target()).st_ino, st.st_ino)
+            self.assertEqual(stat.S_IMODE(os.stat(f.target()).st_mode), 0o644)
+            self.assertEqual(stat.S_IMODE(st.st_mode), 0o600)
+            self.assertEqual(st.st_mtime, 1420070400.5)
+            self.assertEqual(st.st_nlink, 1)
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_local_copy(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        test_data = ''.join(chr(i % 251) for i in range(100000))
+        f, source = self._local_source(td, test_data, test_data)
+
+        # As if the source was on another file system.
+        def no_link(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        link = os.link
+        os.link = no_link
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), test_data)
+            self.assertNotEqual(os.stat(f.target()).st_ino, os.stat(source).st_ino)
+            self.assertEqual(os.stat(f.target()).st_mtime, 1420070400)
+            self.assertEqual(m.host_stats()['']['bytes'], len(test_data))
+        finally:
+            os.link = link
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_local_bad_digest(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        f, source = self._local_source(td, 'abc', 'xyz')
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            self.assertEqual(os.listdir(f.dname), [])
+            self.assertEqual(open(source).read(), 'abc')
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_download_local_digest_missing(self):
+        td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        f, source = self._local_source(td, 'abc')
+
+        m = DownloadManager()
+        try:
+            m._download(f)
+            self.assertIn(f, m._failed_downloads)
+            f.context.digest_required = False
+            m._download(f)
+            self.assertEqual(open(f.target()).read(), 'abc')
+            self.assertEqual(os.listdir(f.dname), [f.name])
+        finally:
+            m.stop()
+            shutil.rmtree(td, ignore_errors=True)
+
+    def test_rate_limit(self):
+        m = DownloadManager(rate_limit=1000)
+        self.assertEqual(m.rate_limit, 1000)
+        m.set_rate_limit(None)
+        self.assertIsNone(m.rate_limit)
+
+class TestPipelinedWriter(unittest.TestCase):
+    data = ''.join(chr(i % 251) for i in range(100000))
+
+    def _copy(self, src):
+        with tempfile.TemporaryFile() as fp:
+            out = PartialDownload(fp, 'SHA-256', base64.b64encode(hashlib.sha256(self.data).digest()))
+            transferred = []
+            PipelinedWriter(out, 4096, 3).copy(src, transferred.append)
+            out.check()
+            fp.seek(0)
+            self.assertEqual(fp.read(), self.data)
+        self.assertEqual(sum(transferred), len(self.data))
+        self.assertEqual(max(transferred), 4096)
+
+    def test_read(self):
+        self._copy(StringIO(self.data))
+
+    def test_readinto(self):
+        with tempfile.TemporaryFile() as src:
+            src.write(self.data)
+            src.seek(0)
+            self._copy(src)
+
+    def test_write_error(self):
+        class Failing(object):
+            def write(self, chunk):
+                raise IOError('disk full')
+        with self.assertRaises(IOError):
+            PipelinedWriter(Failing(), 4096, 3).copy(StringIO(self.data))
+
+class TestSplitRanges(unittest.TestCase):
+    def test_split_ranges(self):
+        self.assertEqual(split_ranges(10, 3, 4), [(0, 4), (5, 9)])
+        self.assertEqual(split_ranges(10, 1, 1), [(0, 9)])
+        self.assertEqual(split_ranges(10, 20, 1), [(i, i) for i in range(10)])
+        self.assertEqual(split_ranges(3, 4, 100), [(0, 2)])
+
+    def test_parse_content_range(self):
+        self.assertEqual(parse_content_range('bytes 100-199/200'), (100, 199, 200))
+        self.assertEqual(parse_content_range('bytes 100-199/*'), (100, 199, None))
+        self.assertIsNone(parse_content_range('items 1-2/3'))
+        self.assertIsNone(parse_content_range(None))
+
+class TestPendingDownloads(unittest.TestCase):
+    def test_pop(self):
+        files = []
+        for host, name in (('a', 'dns.2015.Y.mtbl'), ('b', 'dns.2016.Y.mtbl'), ('a', 'dns.2014.Y.mtbl')):
+            f = File(name)
+            f.uri = 'http://{}/{}'.format(host, name)
+            files.append(f)
+
+        pending = PendingDownloads()
+        for f in files:
+            self.assertTrue(pending.push(f))
+        self.assertFalse(pending.push(files[0]))
+        self.assertEqual(len(pending), 3)
+
+        self.assertEqual(pending.pop(lambda host: host != 'b'), files[0])
+        self.assertEqual(pending.pop(), files[1])
+        self.assertIsNone(pending.pop(lambda host: False))
+        self.assertTrue(pending.remove(files[2]))
+        self.assertFalse(pending)
+        self.assertIsNone(pending.pop())
@@ -0,0 +1,208 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import base64
+import hashlib
+import os
+import Queue
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from dnstable_manager.download import write_partial_meta
+import dnstable_manager.posix as dp
+from dnstable_manager.eventloop import EventLoopDownloadManager
+from dnstable_manager.fileset import File, FilesetContext
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    body = ''.join(chr(i % 251) for i in range(200000))
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.request_version, self.headers.get('Range')))
+        if self.path == '/redirect/dns.2015.Y.mtbl':
+            self.send_response(302)
+            self.send_header('Location', '/dns.2015.Y.mtbl')
+            self.end_headers()
+            return
+        if self.path.startswith('/stall/'):
+            time.sleep(1)
+            return
+        if not self.path.startswith('/dns.'):
+            self.send_error(404)
+            return
+
+        first = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == '"v1"':
+            first = int(self.headers['Range'].partition('=')[2].rstrip('-'))
+        data = self.body[first:]
+        self.send_response(206 if first else 200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Digest', 'SHA-256={}'.format(base64.b64encode(hashlib.sha256(self.body).digest())))
+        self.send_header('Content-Length', str(len(data)))
+        if first:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, len(self.body) - 1, len(self.body)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestEventLoopDownloadManager(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), RequestHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.uri = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        self.results = Queue.Queue()
+        self.m = None
+
+    def tearDown(self):
+        if self.m is not None:
+            self.m.stop(blocking=True)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def download(self, files, **kwargs):
+        self.m = EventLoopDownloadManager(**kwargs)
+        self.m.add_callback(lambda f, error: self.results.put((f, error)))
+        self.m.start()
+        for f in files:
+            self.m.enqueue(f)
+        return dict(self.results.get(timeout=5) for f in files)
+
+    def file(self, name, path=''):
+        f = File(name, context=FilesetContext(dname=self.td))
+        f.uri = '{}{}/{}'.format(self.uri, path, name)
+        return f
+
+    def test_download(self):
+        files = [self.file('dns.2015010{}.D.mtbl'.format(i)) for i in range(1, 7)]
+        results = self.download(files, max_downloads=6)
+        self.assertEqual(results, dict((f, None) for f in files))
+        for f in files:
+            self.assertEqual(open(f.target(), 'rb').read(), RequestHandler.body)
+            self.assertTrue(os.path.exists(f.target() + '.sha256'))
+        self.assertEqual(set(version for path, version, _ in self.server.requests), set(['HTTP/1.0']))
+
+    def test_resume(self):
+        f = self.file('dns.2015.Y.mtbl')
+        with open(f.partial(), 'wb') as fp:
+            fp.write(RequestHandler.body[:1000])
+        write_partial_meta(f.partial(), dict(uri=f.uri, etag='"v1"', last_modified=None, digest=None))
+
+        self.assertEqual(self.download([f]), {f: None})
+        # Resumed by urllib2 in a thread of its own.
+        self.assertEqual(self.server.requests[0][1:], ('HTTP/1.1', 'bytes=1000-'))
+        self.assertEqual(open(f.target(), 'rb').read(), RequestHandler.body)
+        self.assertItemsEqual(os.listdir(self.td), [f.name, f.name + '.sha256'])
+
+    def test_not_found(self):
+        f = self.file('missing.2015.Y.mtbl')
+        error = self.download([f], retry_timeout=60)[f]
+        self.assertIsInstance(error, urllib2.HTTPError)
+        self.assertEqual(error.code, 404)
+        self.assertIn(f, self.m)
+        self.assertEqual(os.listdir(self.td), [])
+
+    def test_redirect(self):
+        f = self.file('dns.2015.Y.mtbl', path='/redirect')
+        self.assertEqual(self.download([f]), {f: None})
+        self.assertEqual(open(f.target(), 'rb').read(), RequestHandler.body)
+        # The redirect is followed by urllib2 in a thread of its own.
+        self.assertEqual([version for path, version, _ in self.server.requests], ['HTTP/1.0', 'HTTP/1.1', 'HTTP/1.1'])
+
+    def test_timeout(self):
+        f = self.file('dns.2015.Y.mtbl', path='/stall')
+        error = self.download([f], download_timeout=0.2)[f]
+        self.assertIsInstance(error, socket.timeout)
+
+    def test_unsupported_scheme(self):
+        f = self.file('dns.2015.Y.mtbl')
+        f.uri = 'unknown://example.com/{}'.format(f.name)
+        error = self.download([f])[f]
+        self.assertIsInstance(error, urllib2.URLError)
+
+    def test_many_fds(self):
+        r, w = os.pipe()
+        fds = [os.dup(r) for i in range(1100)]
+        try:
+            f = self.file('dns.2015.Y.mtbl')
+            self.assertEqual(self.download([f]), {f: None})
+            self.assertEqual(open(f.target(), 'rb').read(), RequestHandler.body)
+            self.assertTrue(self.m._main_thread.is_alive())
+        finally:
+            for fd in fds + [r, w]:
+                os.close(fd)
+
+    def test_loop_error(self):
+        f1 = self.file('dns.2015.Y.mtbl', path='/stall')
+        f2 = self.file('dns.2016.Y.mtbl')
+        self.m = EventLoopDownloadManager(retry_timeout=60)
+        self.m.add_callback(lambda f, error: self.results.put((f, error)))
+        class Failure(Exception): pass
+        expire = self.m._expire_failed_downloads
+        def my_expire(now):
+            # Fail once the transfer of f1 is under way.
+            if self.m._transfers:
+                self.m._expire_failed_downloads = expire
+                raise Failure('broken')
+            return expire(now)
+        self.m._expire_failed_downloads = my_expire
+        self.m.start()
+        self.m.enqueue(f1)
+        f, error = self.results.get(timeout=5)
+        self.assertIs(f, f1)
+        self.assertIsInstance(error, Failure)
+        self.assertEqual(self.m._transfers, {})
+
+        # The loop carries on with the next download.
+        self.m.enqueue(f2)
+        self.assertEqual(self.results.get(timeout=5), (f2, None))
+        self.assertTrue(self.m._main_thread.is_alive())
+
+    def test_disk_workers(self):
+        calls = []
+        orig_fallocate, orig_sync_file_range = dp.fallocate, dp.sync_file_range
+        def my_fallocate(fd, offset, length):
+            calls.append(('fallocate', threading.current_thread()))
+            return orig_fallocate(fd, offset, length)
+        def my_sync_file_range(fd, offset, length, flags):
+            if flags & (dp.SYNC_FILE_RANGE_WAIT_BEFORE | dp.SYNC_FILE_RANGE_WAIT_AFTER):
+                calls.append(('wait', threading.current_thread()))
+            return orig_sync_file_range(fd, offset, length, flags)
+        dp.fallocate, dp.sync_file_range = my_fallocate, my_sync_file_range
+        try:
+            files = [self.file('dns.2015010{}.D.mtbl'.format(i)) for i in range(1, 4)]
+            self.assertEqual(self.download(files), dict((f, None) for f in files))
+            for f in files:
+                self.assertEqual(open(f.target(), 'rb').read(), RequestHandler.body)
+        finally:
+            dp.fallocate, dp.sync_file_range = orig_fallocate, orig_sync_file_range
+        self.assertEqual(sum(1 for call, thread in calls if call == 'fallocate'), 3)
+        self.assertNotIn(self.m._main_thread, [thread for call, thread in calls])
@@ -28,7 +28,8 @@ import urllib2
 
 from . import get_uri
 from dnstable_manager.digest import DIGEST_EXTENSIONS
-from dnstable_manager.fileset import File, Fileset, FilesetError, ParseError, compute_overlap, parse_datetime, relative_uri
+import dnstable_manager.fileset as fileset_module
+from dnstable_manager.fileset import File, FilesetContext, Fileset, FilesetError, ParseError, compute_overlap, parse_datetime, parse_filename, relative_uri
 
 class TestParseDatetime(unittest.TestCase):
     def test_parse_datetime_minute(self):
@@ -65,6 +66,27 @@ class TestParseDatetime(unittest.TestCase):
         self.assertRaises(ParseError, parse_datetime, '20060102.0060')
         self.assertRaises(ParseError, parse_datetime, '20060102.1500.')
 
+class TestParseFilename(unittest.TestCase):
+    def test_parse_filename(self):
+        self.assertEqual(parse_filename('dns.2006.Y.mtbl')[:2], ('Y', datetime.datetime(2006, 1, 1, 0, 0)))
+        self.assertEqual(parse_filename('dns.20060102.W.mtbl')[:2], ('W', datetime.datetime(2006, 1, 2, 0, 0)))
+        self.assertEqual(parse_filename('dns.20060102.1501.m.mtbl')[:2], ('m', datetime.datetime(2006, 1, 2, 15, 1)))
+
+    def test_parse_filename_path(self):
+        self.assertEqual(parse_filename('/srv/dnstable/dns.200601.Q.mtbl')[:2], ('Q', datetime.datetime(2006, 1, 1, 0, 0)))
+
+    def test_parse_filename_invalid(self):
+        self.assertRaises(ParseError, parse_filename, 'dns')
+        self.assertRaises(ParseError, parse_filename, 'dns.Y.mtbl')
+        self.assertRaises(ParseError, parse_filename, 'dns.2006.Z.mtbl')
+        self.assertRaises(ParseError, parse_filename, 'dns.200613.M.mtbl')
+        self.assertRaises(ParseError, parse_filename, 'dns.20060102.15a0.H.mtbl')
+
+    def test_parse_filename_memoized(self):
+        parse_filename.cache_clear()
+        first = parse_filename('dns.20060102.1500.H.mtbl')
+        self.assertIs(parse_filename('dns.20060102.1500.H.mtbl'), first)
+
 class TestRelativeUri(unittest.TestCase):
     def test_relative_uri(self):
         self.assertEquals(relative_uri('http://foo/bar', 'baz'), 'http://foo/baz')
@@ -109,6 +131,20 @@ class TestComputeOverlap(unittest.TestCase):
                 ))
         self.assertItemsEqual(compute_overlap(files), [])
 
+    def test_compute_overlap_quarter(self):
+        files = set(File(f) for f in (
+            'dns.2014.Y.mtbl',
+            'dns.201501.Q.mtbl',
+            'dns.201504.M.mtbl',
+                ))
+        overlap = set(File(f) for f in (
+            'dns.201410.Q.mtbl',
+            'dns.201502.M.mtbl',
+            'dns.20150308.W.mtbl',
+            'dns.20150331.2350.X.mtbl',
+            ))
+        self.assertItemsEqual(compute_overlap(files.union(overlap)), overlap)
+
 class TestFile(unittest.TestCase):
     def test_init_year(self):
         f = File('test.2000.Y.txt')
@@ -143,6 +179,41 @@ class TestFile(unittest.TestCase):
         self.assertEqual(hash(f1), hash(f2))
         self.assertNotEqual(hash(f1), hash(f3))
 
+    def test_sorted(self):
+        names = [
+            'test.2000.Y.txt',
+            'test.200004.Q.txt',
+            'test.199901.M.txt',
+            'test.200001.M.txt',
+            'test.20000101.D.txt',
+            'test.20000101.0000.m.txt',
+            ]
+        self.assertEqual([f.name for f in sorted(File(fn) for fn in reversed(names))], names)
+
+    def test_read_only(self):
+        f = File('test.2000.Y.txt')
+        for attr in ('name', 'tl', 'datetime'):
+            with self.assertRaises(AttributeError):
+                setattr(f, attr, None)
+        with self.assertRaises(AttributeError):
+            f.extra = None
+
+    def test_context(self):
+        context = FilesetContext(uri='http://example.com/dns.fileset', dname='/srv', apikey='KEY', validator='true', digest_required=False)
+        f1 = File('dns.2000.Y.mtbl', context=context)
+        f2 = File('dns.200001.M.mtbl', context=context)
+        self.assertIs(f1.context, f2.context)
+        self.assertEqual(f1.dname, '/srv')
+        self.assertEqual(f1.apikey, 'KEY')
+        self.assertEqual(f1.validator, 'true')
+        self.assertFalse(f1.digest_required)
+        self.assertEqual(f1.target(), '/srv/dns.2000.Y.mtbl')
+        self.assertEqual(f1.uri, 'http://example.com/dns.2000.Y.mtbl')
+        self.assertEqual(f2.uri, 'http://example.com/dns.200001.M.mtbl')
+
+        f1.uri = 'http://example.net/dns.2000.Y.mtbl'
+        self.assertEqual(f1.uri, 'http://example.net/dns.2000.Y.mtbl')
+
 class TestFileset(unittest.TestCase):
     @staticmethod
     def noop(self, *args, **kwargs): pass
@@ -177,6 +248,94 @@ class TestFileset(unittest.TestCase):
         self.assertItemsEqual(fs.all_local_files, (File(fn) for fn in fileset))
         self.assertItemsEqual(fs.minimal_local_files, (File(fn) for fn in fileset))
 
+    def test_load_local_fileset_incremental(self):
+        for fn in ('dns.2014.Y.mtbl', 'dns.201501.M.mtbl'):
+            open(os.path.join(self.td, fn), 'w')
+
+        fs = Fileset(None, self.td)
+        self.assertItemsEqual(fs.all_local_files, (File('dns.2014.Y.mtbl'), File('dns.201501.M.mtbl')))
+
+        open(os.path.join(self.td, 'dns.20150201.W.mtbl'), 'w')
+        os.unlink(os.path.join(self.td, 'dns.2014.Y.mtbl'))
+        fs.load_local_fileset()
+
+        self.assertItemsEqual(fs.all_local_files, (File('dns.201501.M.mtbl'), File('dns.20150201.W.mtbl')))
+        self.assertItemsEqual(fs.minimal_local_files, (File('dns.201501.M.mtbl'), File('dns.20150201.W.mtbl')))
+
+    def test_load_local_fileset_no_inotify(self):
+        fs = Fileset(None, self.td)
+        fs._watcher.close()
+
+        open(os.path.join(self.td, 'dns.2014.Y.mtbl'), 'w')
+        fs.load_local_fileset()
+        self.assertItemsEqual(fs.all_local_files, (File('dns.2014.Y.mtbl'),))
+
+        os.unlink(os.path.join(self.td, 'dns.2014.Y.mtbl'))
+        fs.load_local_fileset()
+        self.assertItemsEqual(fs.all_local_files, ())
+
+    def test_reconcile(self):
+        files = (
+            'dns.2014.Y.mtbl',
+            'dns.201401.M.mtbl',
+            'dns.201501.M.mtbl',
+            )
+        for fn in files:
+            open(os.path.join(self.td, fn), 'w')
+
+        fs = Fileset(None, self.td)
+        fs.remote_files = set((File('dns.2014.Y.mtbl'), File('dns.201501.M.mtbl'), File('dns.20150201.W.mtbl')))
+        fs._remote_version += 1
+
+        self.assertTrue(fs.reconcile())
+        self.assertItemsEqual(fs.missing, (File('dns.20150201.W.mtbl'),))
+        self.assertItemsEqual(fs.minimal_local_files, (File('dns.2014.Y.mtbl'), File('dns.201501.M.mtbl')))
+        self.assertItemsEqual(fs.pending_deletions, (File('dns.201401.M.mtbl'),))
+
+        # Nothing changed, so nothing is recomputed.
+        fs.pending_deletions.clear()
+        fs.load_local_fileset()
+        self.assertFalse(fs.reconcile())
+        self.assertItemsEqual(fs.pending_deletions, ())
+
+    def test_prune_partial_files(self):
+        partials = dict((name, os.path.join(self.td, '.{}.partial'.format(name)))
+                for name in ('dns.20150201.W.mtbl', 'dns.20150101.W.mtbl'))
+        for partial in partials.values():
+            open(partial, 'w')
+            open(partial + '.meta', 'w')
+        open(os.path.join(self.td, '.dns.2014.Y.mtbl.XXXXXX'), 'w')
+
+        fs = Fileset(None, self.td)
+        self.assertEqual(fs.list_temporary_files(), [os.path.join(self.td, '.dns.2014.Y.mtbl.XXXXXX')])
+
+        # Nothing is known to be obsolete before the remote fileset is loaded.
+        fs.prune_partial_files()
+        self.assertItemsEqual(fs.list_partial_files(), partials.values())
+
+        fs.remote_files = set((File('dns.20150201.W.mtbl'),))
+        fs._remote_version += 1
+        fs.remote_loaded = True
+        fs.reconcile()
+        fs.prune_partial_files()
+        self.assertEqual(fs.list_partial_files(), [partials['dns.20150201.W.mtbl']])
+        self.assertFalse(os.path.exists(partials['dns.20150101.W.mtbl'] + '.meta'))
+
+    def test_reconcile_add_local_file(self):
+        fs = Fileset(None, self.td)
+        f = File('dns.2014.Y.mtbl', context=fs.context)
+        fs.remote_files = set((f,))
+        fs._remote_version += 1
+
+        fs.reconcile()
+        self.assertItemsEqual(fs.missing, (f,))
+
+        fs.add_local_file(f)
+        fs.load_local_fileset()
+        self.assertTrue(fs.reconcile())
+        self.assertItemsEqual(fs.missing, ())
+        self.assertItemsEqual(fs.all_local_files, (f,))
+
     def test_prune_obsolete_files(self):
         files = set(File(f) for f in (
             'dns.2014.Y.mtbl',
@@ -378,6 +537,74 @@ class TestFileset(unittest.TestCase):
 
         self.assertItemsEqual(files.union(redundant), fileset)
 
+    def test_write_local_fileset_unchanged(self):
+        files = set(File(f) for f in (
+            'dns.2014.Y.mtbl',
+            'dns.201501.M.mtbl',
+            'dns.20150201.W.mtbl',
+            ))
+
+        fs = Fileset(None, self.td)
+        fs.minimal_local_files = set(files)
+        fs.write_local_fileset()
+
+        fileset_path = os.path.join(self.td, 'dns.fileset')
+        st = os.stat(fileset_path)
+
+        def fail_open(*args, **kwargs):
+            self.fail('Fileset was read back from disk')
+        fileset_module.open = fail_open
+        try:
+            fs.write_local_fileset()
+        finally:
+            del fileset_module.open
+
+        self.assertEqual(os.stat(fileset_path).st_ino, st.st_ino)
+
+    def test_write_local_fileset_incremental(self):
+        fs = Fileset(None, self.td)
+        fs.minimal_local_files = set(File(f) for f in (
+            'dns.2014.Y.mtbl',
+            'dns.20150201.W.mtbl',
+            ))
+        fs.write_local_fileset()
+
+        fs.minimal_local_files = set(File(f) for f in (
+            'dns.2014.Y.mtbl',
+            'dns.201501.M.mtbl',
+            'dns.20150202.D.mtbl',
+            ))
+        fs.write_local_fileset()
+
+        fileset_path = os.path.join(self.td, 'dns.fileset')
+        self.assertEqual([line.strip() for line in open(fileset_path)], [
+            'dns.2014.Y.mtbl',
+            'dns.201501.M.mtbl',
+            'dns.20150202.D.mtbl',
+            ])
+
+    def test_write_local_fileset_replaced(self):
+        files = set(File(f) for f in (
+            'dns.2014.Y.mtbl',
+            'dns.201501.M.mtbl',
+            ))
+
+        fs = Fileset(None, self.td)
+        fs.minimal_local_files = set(files)
+        fs.write_local_fileset()
+
+        fileset_path = os.path.join(self.td, 'dns.fileset')
+        with open(fileset_path, 'w') as fp:
+            print('dns.2013.Y.mtbl', file=fp)
+        fs.write_local_fileset()
+
+        self.assertItemsEqual((File(f.strip()) for f in open(fileset_path)), files)
+
+        os.unlink(fileset_path)
+        fs.write_local_fileset()
+
+        self.assertItemsEqual((File(f.strip()) for f in open(fileset_path)), files)
+
     def test_purge_deleted_files(self):
         files = set(File(f) for f in (
             'dns.2014.Y.mtbl',
@@ -472,6 +699,42 @@ class TestFileset(unittest.TestCase):
 
         self.assertItemsEqual(fs.remote_files, (File(f) for f in files))
 
+    def test_load_remote_fileset_not_modified(self):
+        fileset_uri = 'http://example.com/dns.fileset'
+        files = (
+            'dns.2014.Y.mtbl',
+            'dns.201501.M.mtbl',
+            'dns.20150201.W.mtbl',
+            )
+        etag = '"5f3a-1b"'
+        last_modified = 'Mon, 09 Feb 2015 01:10:00 GMT'
+
+        requests = []
+
+        def my_urlopen(obj, timeout=None):
+            uri = get_uri(obj)
+            self.assertEqual(uri, fileset_uri)
+            headers = dict((k.lower(), v) for k,v in obj.header_items())
+            requests.append(headers)
+            if headers.get('if-none-match') == etag:
+                raise urllib2.HTTPError(uri, 304, 'Not Modified', httplib.HTTPMessage(StringIO('')), StringIO(''))
+            fp = StringIO('\n'.join(files + ('',)))
+            msg = httplib.HTTPMessage(fp=StringIO('Content-Length: {}\r\nETag: {}\r\nLast-Modified: {}'.format(len(fp.getvalue()), etag, last_modified)), seekable=True)
+            return urllib.addinfourl(fp, msg, uri)
+        urllib2.urlopen = my_urlopen
+
+        fs = Fileset(fileset_uri, self.td)
+        self.assertTrue(fs.load_remote_fileset())
+        remote_files = fs.remote_files
+        self.assertItemsEqual(remote_files, (File(f) for f in files))
+        self.assertNotIn('if-none-match', requests[0])
+        self.assertNotIn('if-modified-since', requests[0])
+
+        self.assertFalse(fs.load_remote_fileset())
+        self.assertIs(fs.remote_files, remote_files)
+        self.assertEqual(requests[1]['if-none-match'], etag)
+        self.assertEqual(requests[1]['if-modified-since'], last_modified)
+
     def test_load_remote_fileset_bad_content_length(self):
         fileset_uri = 'http://example.com/dns.fileset'
         files = (
@@ -0,0 +1,59 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import unittest
+
+import dnstable_manager.https as dh
+
+@unittest.skipIf(not hasattr(dh.ssl, 'SSLContext'), 'ssl.SSLContext not supported')
+class TestGetContext(unittest.TestCase):
+    def setUp(self):
+        self.orig_config = (dh.ca_file, dh.keyfile, dh.certfile, dh.ciphers)
+        dh.ca_file = None
+
+    def tearDown(self):
+        dh.ca_file, dh.keyfile, dh.certfile, dh.ciphers = self.orig_config
+        dh._context = None
+        dh._context_config = None
+
+    def test_cached(self):
+        context = dh.get_context()
+        self.assertIs(dh.get_context(), context)
+
+    def test_reconfigured(self):
+        context = dh.get_context()
+        dh.ciphers = 'EECDH+AESGCM'
+        self.assertIsNot(dh.get_context(), context)
+
+    def test_tls12(self):
+        context = dh.get_context()
+        self.assertEqual(context.verify_mode, dh.ssl.CERT_REQUIRED)
+        for option in ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1'):
+            if getattr(dh.ssl, option, 0):
+                self.assertTrue(context.options & getattr(dh.ssl, option), option)
+
+class TestHandshakeStats(unittest.TestCase):
+    def test_record(self):
+        stats = dh.HandshakeStats()
+        self.assertEqual(stats.mean_time, 0.0)
+        stats.record(0.2)
+        stats.record(0.1)
+        self.assertEqual(stats.count, 2)
+        self.assertAlmostEqual(stats.mean_time, 0.15)
+        self.assertEqual(stats.max_time, 0.2)
+        self.assertEqual(sorted(stats.as_dict()), ['count', 'max_time', 'mean_time'])
+        stats.reset()
+        self.assertEqual(stats.count, 0)
@@ -0,0 +1,87 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dnstable_manager.inotify as di
+
+try:
+    di.Inotify().close()
+    inotify_supported = True
+except OSError:
+    inotify_supported = False
+
+@unittest.skipUnless(inotify_supported, 'inotify not supported')
+class TestDirectoryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='test-inotify.')
+        self.watcher = di.DirectoryWatcher(self.td, pattern='dns.*.mtbl')
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def test_available(self):
+        self.assertTrue(self.watcher.available)
+        self.assertEqual(self.watcher.poll(), (set(), set()))
+
+    def test_added(self):
+        open(os.path.join(self.td, 'dns.2014.Y.mtbl'), 'w').close()
+        open(os.path.join(self.td, '.dns.2015.Y.mtbl.XXXXXX'), 'w').close()
+        os.rename(os.path.join(self.td, '.dns.2015.Y.mtbl.XXXXXX'), os.path.join(self.td, 'dns.2015.Y.mtbl'))
+        open(os.path.join(self.td, 'dns.fileset'), 'w').close()
+
+        self.assertEqual(self.watcher.poll(), (set(['dns.2014.Y.mtbl', 'dns.2015.Y.mtbl']), set()))
+        self.assertEqual(self.watcher.poll(), (set(), set()))
+
+    def test_removed(self):
+        fn = os.path.join(self.td, 'dns.2014.Y.mtbl')
+        open(fn, 'w').close()
+        self.watcher.poll()
+
+        os.unlink(fn)
+        self.assertEqual(self.watcher.poll(), (set(), set(['dns.2014.Y.mtbl'])))
+
+    def test_added_then_removed(self):
+        fn = os.path.join(self.td, 'dns.2014.Y.mtbl')
+        open(fn, 'w').close()
+        os.unlink(fn)
+        self.assertEqual(self.watcher.poll(), (set(), set(['dns.2014.Y.mtbl'])))
+
+    def test_lost_watch(self):
+        shutil.rmtree(self.td)
+        self.assertIsNone(self.watcher.poll())
+        self.assertFalse(self.watcher.available)
+
+        os.mkdir(self.td)
+        self.assertIsNone(self.watcher.poll())
+        self.assertTrue(self.watcher.available)
+
+class TestDirectoryWatcherUnsupported(unittest.TestCase):
+    def setUp(self):
+        self.orig_libc = di._libc
+        di._libc = False
+        self.td = tempfile.mkdtemp(prefix='test-inotify.')
+
+    def tearDown(self):
+        di._libc = self.orig_libc
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def test_unsupported(self):
+        watcher = di.DirectoryWatcher(self.td)
+        self.assertFalse(watcher.available)
+        self.assertIsNone(watcher.poll())
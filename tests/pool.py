@@ -0,0 +1,166 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import httplib
+import SocketServer
+import threading
+import time
+import unittest
+import urllib2
+
+from dnstable_manager.pool import ConnectionPool, HTTPHandler
+from dnstable_manager.util import get_readinto, readinto_chunks
+
+class StubConnection(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool(unittest.TestCase):
+    def test_get_put(self):
+        pool = ConnectionPool(max_idle=2, idle_timeout=60)
+        conn = StubConnection()
+        self.assertIsNone(pool.get('a'))
+        pool.put('a', conn)
+        self.assertIsNone(pool.get('b'))
+        self.assertIs(pool.get('a'), conn)
+        self.assertIsNone(pool.get('a'))
+        self.assertFalse(conn.closed)
+
+    def test_max_idle(self):
+        pool = ConnectionPool(max_idle=2, idle_timeout=60)
+        conns = [StubConnection() for i in range(3)]
+        for conn in conns:
+            pool.put('a', conn)
+        self.assertEqual(len(pool), 2)
+        self.assertTrue(conns[0].closed)
+        self.assertIs(pool.get('a'), conns[2])
+
+    def test_disabled(self):
+        pool = ConnectionPool(max_idle=0)
+        conn = StubConnection()
+        pool.put('a', conn)
+        self.assertTrue(conn.closed)
+        self.assertIsNone(pool.get('a'))
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(max_idle=2, idle_timeout=0)
+        conn = StubConnection()
+        pool.put('a', conn)
+        time.sleep(0.01)
+        self.assertIsNone(pool.get('a'))
+        self.assertTrue(conn.closed)
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = 'abc\n' * 1024
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), RequestHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.uri = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.pool = ConnectionPool(max_idle=2, idle_timeout=60)
+        self.opener = urllib2.build_opener(HTTPHandler(pool=self.pool))
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(3):
+            fp = self.opener.open('{}/file'.format(self.uri), timeout=5)
+            self.assertEqual(fp.read(), RequestHandler.body)
+            self.assertEqual(fp.getcode(), 200)
+            self.assertEqual(len(self.pool), 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_readline(self):
+        fp = self.opener.open('{}/file'.format(self.uri), timeout=5)
+        self.assertEqual(list(fp), ['abc\n'] * 1024)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_incomplete_read(self):
+        fp = self.opener.open('{}/file'.format(self.uri), timeout=5)
+        fp.read(10)
+        fp.close()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.opener.open('{}/file'.format(self.uri), timeout=5).read(), RequestHandler.body)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_connection_close(self):
+        self.assertEqual(self.opener.open('{}/close'.format(self.uri), timeout=5).read(), RequestHandler.body)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_stale_connection(self):
+        fp = self.opener.open('{}/file'.format(self.uri), timeout=5)
+        fp.read()
+        self.assertEqual(len(self.pool), 1)
+
+        # Close the pooled connection behind the pool's back, as an idle
+        # server would.
+        conn = self.pool.get(self.pool._idle.keys()[0])
+        conn.sock.close()
+        self.pool.put(self.pool._idle.keys()[0], conn)
+
+        self.assertEqual(self.opener.open('{}/file'.format(self.uri), timeout=5).read(), RequestHandler.body)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_readinto(self):
+        reads = []
+        orig_read = httplib.HTTPResponse.read
+        def my_read(self, amt=None):
+            reads.append(amt)
+            return orig_read(self, amt)
+        httplib.HTTPResponse.read = my_read
+        try:
+            for i in range(2):
+                fp = self.opener.open('{}/file'.format(self.uri), timeout=5)
+                self.assertIsNotNone(get_readinto(fp))
+                data = ''.join(chunk.tobytes() for chunk in readinto_chunks(fp, bytearray(1000)))
+                self.assertEqual(data, RequestHandler.body)
+                self.assertEqual(len(self.pool), 1)
+        finally:
+            httplib.HTTPResponse.read = orig_read
+        self.assertEqual(reads, [])
+        self.assertEqual(self.server.connections, 1)
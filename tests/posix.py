@@ -0,0 +1,103 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import mmap
+import os
+import tempfile
+import unittest
+
+import dnstable_manager.posix as dp
+
+class TestPosix(unittest.TestCase):
+    def setUp(self):
+        self.fp = tempfile.NamedTemporaryFile(prefix='test-dnstable-manager.')
+
+    def tearDown(self):
+        self.fp.close()
+
+    def test_fallocate(self):
+        fd = self.fp.fileno()
+        if dp.fallocate(fd, 0, 1 << 20):
+            self.assertGreaterEqual(os.fstat(fd).st_blocks * 512, 1 << 20)
+        self.assertEqual(os.fstat(fd).st_size, 0)
+        self.assertFalse(dp.fallocate(fd, 0, 0))
+
+    def test_write_behind(self):
+        data = ''.join(chr(i % 251) for i in range(4096)) * 100
+        write_behind = dp.WriteBehind(self.fp, window=64 * 1024)
+        for i in range(0, len(data), 10000):
+            self.fp.write(data[i:i + 10000])
+            write_behind.update(min(len(data), i + 10000))
+        write_behind.finish()
+        self.assertEqual(write_behind._dropped, 5 * 64 * 1024)
+        self.fp.seek(0)
+        self.assertEqual(self.fp.read(), data)
+
+    def test_write_behind_no_wait(self):
+        flags = []
+        orig_sync_file_range = dp.sync_file_range
+        def my_sync_file_range(fd, offset, length, f):
+            flags.append(f)
+            return orig_sync_file_range(fd, offset, length, f)
+        dp.sync_file_range = my_sync_file_range
+        try:
+            data = 'x' * (400 * 1024)
+            write_behind = dp.WriteBehind(self.fp, window=64 * 1024, wait=False)
+            for i in range(0, len(data), 10000):
+                self.fp.write(data[i:i + 10000])
+                write_behind.update(min(len(data), i + 10000))
+            self.assertEqual(write_behind._dropped, 5 * 64 * 1024)
+            self.assertEqual(set(flags), set([dp.SYNC_FILE_RANGE_WRITE]))
+        finally:
+            dp.sync_file_range = orig_sync_file_range
+
+    def test_resident_pages(self):
+        fd = self.fp.fileno()
+        self.assertEqual(dp.resident_pages(fd), (0, 0))
+        self.fp.write('x' * (3 * mmap.PAGESIZE + 1))
+        self.fp.flush()
+        resident = dp.resident_pages(fd)
+        if resident is not None:
+            self.assertEqual(resident[1], 4)
+            self.assertLessEqual(resident[0], 4)
+
+    def test_extent_count(self):
+        self.fp.write('x' * 4096)
+        self.fp.flush()
+        extents = dp.extent_count(self.fp.fileno())
+        if extents is not None:
+            self.assertGreaterEqual(extents, 1)
+
+    def test_copy_range(self):
+        data = ''.join(chr(i % 251) for i in range(100000))
+        self.fp.write(data)
+        self.fp.flush()
+        with tempfile.TemporaryFile(prefix='test-dnstable-manager.') as out:
+            with open(self.fp.name, 'rb') as src:
+                src.seek(10)
+                copied = dp.copy_range(src.fileno(), out.fileno(), len(data))
+            if copied is not None:
+                self.assertEqual(copied, len(data) - 10)
+                out.seek(0)
+                self.assertEqual(out.read(), data[10:])
+
+    def test_reflink(self):
+        self.fp.write('x' * 4096)
+        self.fp.flush()
+        with tempfile.TemporaryFile(prefix='test-dnstable-manager.', dir=os.path.dirname(self.fp.name)) as out:
+            if dp.reflink(self.fp.fileno(), out.fileno()):
+                out.seek(0)
+                self.assertEqual(out.read(), 'x' * 4096)
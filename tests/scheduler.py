@@ -0,0 +1,150 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import os
+import threading
+import time
+import unittest
+
+from dnstable_manager.scheduler import Scheduler
+
+class StubFileset(object):
+    def __init__(self, fd=None):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+class StubManager(object):
+    def __init__(self, delays, fd=None):
+        self.fileset_uri = 'stub'
+        self.fileset = StubFileset(fd)
+        self.retry_timeout = 60
+        self.delays = list(delays)
+        self.steps = 0
+        self.stepped = threading.Event()
+
+    def step(self):
+        if self.fileset.fd is not None:
+            os.read(self.fileset.fd, 4096)
+        self.steps += 1
+        self.stepped.set()
+        delay = self.delays.pop(0) if self.delays else 60
+        if isinstance(delay, Exception):
+            raise delay
+        return delay
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def tearDown(self):
+        if self.scheduler._thread:
+            self.scheduler.stop(blocking=True, timeout=5)
+
+    def wait_steps(self, manager, steps):
+        for i in range(50):
+            if manager.steps >= steps:
+                return
+            manager.stepped.wait(0.1)
+            manager.stepped.clear()
+        self.fail('{} steps expected, got {}'.format(steps, manager.steps))
+
+    def test_add(self):
+        m = StubManager([60])
+        self.scheduler.add(m)
+        self.assertIs(m.scheduler, self.scheduler)
+        self.scheduler.start()
+        self.wait_steps(m, 1)
+
+    def test_delay(self):
+        m1 = StubManager([0, 0, 60])
+        m2 = StubManager([60])
+        self.scheduler.add(m1)
+        self.scheduler.add(m2)
+        self.scheduler.start()
+        self.wait_steps(m1, 3)
+        self.wait_steps(m2, 1)
+        self.assertEqual(m2.steps, 1)
+
+    def test_wake(self):
+        m = StubManager([60, 60])
+        self.scheduler.add(m)
+        self.scheduler.start()
+        self.wait_steps(m, 1)
+        self.scheduler.wake(m)
+        self.wait_steps(m, 2)
+
+    def test_schedule_keeps_earliest(self):
+        m = StubManager([])
+        self.scheduler.add(m)
+        self.scheduler.schedule(m, 60)
+        self.assertLessEqual(self.scheduler._due[m], time.time())
+
+    def test_step_failed(self):
+        m = StubManager([Exception('failed')])
+        m.retry_timeout = 0
+        self.scheduler.add(m)
+        self.scheduler.start()
+        self.wait_steps(m, 2)
+
+    def test_fileno(self):
+        r, w = os.pipe()
+        try:
+            os.write(w, b'x')
+            m = StubManager([60, 60], fd=r)
+            self.scheduler.add(m)
+            self.scheduler.start()
+            self.wait_steps(m, 1)
+            os.write(w, b'x')
+            self.wait_steps(m, 2)
+        finally:
+            self.scheduler.stop(blocking=True, timeout=5)
+            os.close(r)
+            os.close(w)
+
+    def test_remove(self):
+        m = StubManager([60])
+        self.scheduler.add(m)
+        self.scheduler.remove(m)
+        self.assertIsNone(m.scheduler)
+        self.scheduler.wake(m)
+        self.assertEqual(self.scheduler._due, {})
+
+    def test_fileno_above_fd_setsize(self):
+        r, w = os.pipe()
+        high = 1500
+        os.dup2(r, high)
+        try:
+            os.write(w, b'x')
+            m = StubManager([60, 60], fd=high)
+            self.scheduler.add(m)
+            self.scheduler.start()
+            self.wait_steps(m, 1)
+            os.write(w, b'x')
+            self.wait_steps(m, 2)
+            self.assertTrue(self.scheduler._thread.is_alive())
+        finally:
+            self.scheduler.stop(blocking=True, timeout=5)
+            os.close(high)
+            os.close(r)
+            os.close(w)
+
+    def test_submit(self):
+        done = threading.Event()
+        self.scheduler.start()
+        self.scheduler.submit(done.set)
+        self.assertTrue(done.wait(5))
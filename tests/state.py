@@ -0,0 +1,185 @@
+# Copyright (c) 2016 by Farsight Security, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dnstable_manager import DNSTableManager
+from dnstable_manager.download import DownloadManager
+from dnstable_manager.fileset import File, Fileset
+from dnstable_manager.state import StateStore
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        self.path = os.path.join(self.td, 'state.db')
+        self.store = StateStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def test_empty(self):
+        state = self.store.load('key')
+        self.assertIsNone(state.remote)
+        self.assertIsNone(state.local)
+        self.assertEqual(self.store.failures('key'), {})
+
+    def test_save(self):
+        self.store.save_remote('key', 'uri', ['a', 'b'], [], '"etag"', None, 100.0)
+        self.store.save_remote('key', 'uri', ['c'], ['a'], '"etag2"', None, 200.0)
+        self.store.save_local('key', ['a'], [], 50.0, 60.0)
+        self.store.save_local('other', ['x'], [], 50.0, 60.0)
+        self.store.close()
+
+        self.store = StateStore(self.path)
+        state = self.store.load('key')
+        self.assertEqual(state.uri, 'uri')
+        self.assertEqual(state.remote, set(['b', 'c']))
+        self.assertEqual(state.etag, '"etag2"')
+        self.assertEqual(state.loaded_at, 200.0)
+        self.assertEqual(state.local, set(['a']))
+        self.assertEqual((state.local_mtime, state.local_scanned_at), (50.0, 60.0))
+
+    def test_failures(self):
+        now = time.time()
+        self.store.set_failure('key', 'a', now + 60)
+        self.store.set_failure('key', 'b', now + 60)
+        self.store.set_failure('key', 'c', now - 1)
+        self.store.clear_failure('key', 'b')
+        self.assertEqual(self.store.failures('key'), {'a': now + 60})
+        self.assertEqual(self.store.failures('other'), {})
+
+class TestRestart(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.mkdtemp(prefix='test-dnstable-manager.')
+        self.dname = os.path.join(self.td, 'fileset')
+        os.mkdir(self.dname)
+        self.store = StateStore(os.path.join(self.td, 'state.db'))
+        self.then = int(time.time()) - 10
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.td, ignore_errors=True)
+
+    def settle(self):
+        # Back-date the directory so that its saved index is not racy.
+        os.utime(self.dname, (self.then, self.then))
+
+    def test_restore_local_index(self):
+        open(os.path.join(self.dname, 'dns.2014.Y.mtbl'), 'w')
+        self.settle()
+        fs = Fileset(None, self.dname, state=self.store)
+        fs.save_state()
+
+        # Changes that do not move the mtime of the directory are not seen,
+        # which shows that the index was not rescanned.
+        open(os.path.join(self.dname, 'dns.2015.Y.mtbl'), 'w')
+        self.settle()
+        fs = Fileset(None, self.dname, state=self.store)
+        self.assertItemsEqual(fs.all_local_files, [File('dns.2014.Y.mtbl')])
+
+    def test_restore_local_index_changed(self):
+        open(os.path.join(self.dname, 'dns.2014.Y.mtbl'), 'w')
+        self.settle()
+        fs = Fileset(None, self.dname, state=self.store)
+        fs.save_state()
+
+        os.unlink(os.path.join(self.dname, 'dns.2014.Y.mtbl'))
+        open(os.path.join(self.dname, 'dns.2015.Y.mtbl'), 'w')
+        fs = Fileset(None, self.dname, state=self.store)
+        self.assertItemsEqual(fs.all_local_files, [File('dns.2015.Y.mtbl')])
+        fs.save_state()
+        self.assertEqual(self.store.load(fs.state_key).local, set(['dns.2015.Y.mtbl']))
+
+    def test_restore_local_index_racy(self):
+        open(os.path.join(self.dname, 'dns.2014.Y.mtbl'), 'w')
+        fs = Fileset(None, self.dname, state=self.store)
+        fs.save_state()
+
+        # Created right after the index was taken, possibly within the
+        # same mtime tick.
+        open(os.path.join(self.dname, 'dns.2015.Y.mtbl'), 'w')
+        fs = Fileset(None, self.dname, state=self.store)
+        self.assertEqual(len(fs.all_local_files), 2)
+
+    def test_restore_remote_fileset(self):
+        uri = 'http://example.com/dns.fileset'
+        fs = Fileset(uri, self.dname, state=self.store)
+        fs.remote_files = set([File('dns.2014.Y.mtbl'), File('dns.2015.Y.mtbl')])
+        fs.remote_etag = '"v1"'
+        fs.remote_load_time = 100.0
+        fs.remote_loaded = True
+        fs.save_state()
+
+        fs = Fileset(uri, self.dname, state=self.store)
+        self.assertTrue(fs.remote_loaded)
+        self.assertEqual(fs.remote_etag, '"v1"')
+        self.assertEqual(fs.remote_load_time, 100.0)
+        self.assertItemsEqual(fs.remote_files, [File('dns.2014.Y.mtbl'), File('dns.2015.Y.mtbl')])
+        fs.reconcile()
+        self.assertItemsEqual(fs.missing, [File('dns.2014.Y.mtbl'), File('dns.2015.Y.mtbl')])
+
+        # A different fileset uri starts over.
+        fs = Fileset('http://example.com/other/dns.fileset', self.dname, state=self.store)
+        self.assertFalse(fs.remote_loaded)
+        self.assertEqual(fs.remote_files, set())
+
+    def test_restore_manager(self):
+        uri = 'http://example.com/dns.fileset'
+        now = time.time()
+        fs = Fileset(uri, self.dname, state=self.store)
+        fs.remote_files = set([File('dns.2014.Y.mtbl')])
+        fs.remote_load_time = now
+        fs.remote_loaded = True
+        fs.save_state()
+        self.store.set_failure(fs.state_key, 'dns.2014.Y.mtbl', now + 60)
+
+        d = DownloadManager()
+        m = DNSTableManager(uri, self.dname, frequency=1800, download_manager=d, state=self.store)
+        self.assertEqual(m.next_remote_load, now + 1800)
+        self.assertIn(File('dns.2014.Y.mtbl'), d)
+
+        # The failed download is not queued again before it expires.
+        m.step()
+        self.assertEqual(len(d._pending_downloads), 0)
+
+    def test_save_state_unchanged(self):
+        uri = 'http://example.com/dns.fileset'
+        open(os.path.join(self.dname, 'dns.2014.Y.mtbl'), 'w')
+        self.settle()
+        fs = Fileset(uri, self.dname, state=self.store)
+        fs.remote_files = set([File('dns.2014.Y.mtbl')])
+        fs.remote_load_time = 100.0
+        fs.remote_loaded = True
+        fs.save_state()
+
+        # Neither file set is gone through again while nothing changed.
+        class Unlisted(dict):
+            def __iter__(self):
+                raise AssertionError('local index listed')
+        local_index, remote_files = fs._local_index, fs.remote_files
+        fs._local_index, fs.remote_files = Unlisted(local_index), None
+        fs.save_state()
+        fs._local_index, fs.remote_files = local_index, remote_files
+
+        fs.add_local_file(File('dns.2015.Y.mtbl'))
+        fs.load_local_fileset()
+        fs.save_state()
+        self.assertEqual(self.store.load(fs.state_key).local, set(['dns.2014.Y.mtbl', 'dns.2015.Y.mtbl']))
@@ -13,8 +13,12 @@
 # limitations under the License.
 
 import base64
+import random
+import select
 from cStringIO import StringIO
+import tempfile
 import unittest
+import urllib
 
 import dnstable_manager.util as du
 
@@ -37,3 +41,162 @@ for length in (2, 32, 1024, 16*1024):
     data = base64.b64decode('qoiMsxenAEPPiamMzviaf13rCA6s2xtJrYjGBMZ=') * (length+1)
     assert(len(data) % length > 0)
     setattr(TestIterFileObj, 'test_iterfileobj(len={})'.format(length), _iterfileobj(data, length))
+
+class TestReadintoChunks(unittest.TestCase):
+    data = ''.join(chr(i % 251) for i in range(1000))
+
+    def test_readinto(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(self.data)
+            fp.seek(0)
+            buf = bytearray(64)
+            chunks = [chunk.tobytes() for chunk in du.readinto_chunks(fp, buf)]
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertEqual(len(chunks), 16)
+
+    def test_addinfourl(self):
+        with tempfile.TemporaryFile() as fp:
+            fp.write(self.data)
+            fp.seek(0)
+            chunks = []
+            for chunk in du.readinto_chunks(urllib.addinfourl(fp, None, 'file:///'), bytearray(64)):
+                self.assertIsInstance(chunk, memoryview)
+                chunks.append(chunk.tobytes())
+        self.assertEqual(''.join(chunks), self.data)
+
+    def test_read_fallback(self):
+        chunks = list(du.readinto_chunks(StringIO(self.data), bytearray(64)))
+        self.assertEqual(''.join(chunks), self.data)
+        self.assertEqual(max(len(chunk) for chunk in chunks), 64)
+
+class TestMemoize(unittest.TestCase):
+    def test_memoize(self):
+        calls = []
+        @du.memoize(4)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual(double(1), 2)
+        self.assertEqual(double(1), 2)
+        self.assertEqual(calls, [1])
+
+    def test_memoize_bounded(self):
+        calls = []
+        @du.memoize(4)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        for x in range(16):
+            self.assertEqual(double(x), x * 2)
+        self.assertEqual(double(0), 0)
+        self.assertEqual(calls, range(16) + [0])
+
+        # The most recent entries survive eviction.
+        self.assertEqual(double(15), 30)
+        self.assertEqual(calls, range(16) + [0])
+
+    def test_memoize_exception(self):
+        calls = []
+        @du.memoize(4)
+        def fail(x):
+            calls.append(x)
+            raise ValueError(x)
+
+        self.assertRaises(ValueError, fail, 1)
+        self.assertRaises(ValueError, fail, 1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_memoize_cache_clear(self):
+        calls = []
+        @du.memoize(4)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        double(1)
+        double.cache_clear()
+        double(1)
+        self.assertEqual(calls, [1, 1])
+
+class TestIndexedHeap(unittest.TestCase):
+    def test_pop_order(self):
+        items = [5, 3, 9, 1, 7, 2, 8]
+        h = du.IndexedHeap(items)
+        self.assertEqual(len(h), len(items))
+        self.assertEqual(h.peek(), 9)
+        self.assertEqual([h.pop() for i in items], sorted(items, reverse=True))
+        self.assertFalse(h)
+        self.assertRaises(IndexError, h.pop)
+
+    def test_push_duplicate(self):
+        h = du.IndexedHeap()
+        self.assertTrue(h.push(1))
+        self.assertFalse(h.push(1))
+        self.assertEqual(len(h), 1)
+
+    def test_remove(self):
+        items = range(100)
+        random.Random(1).shuffle(items)
+        h = du.IndexedHeap(items)
+        for x in items[::3]:
+            self.assertTrue(h.remove(x))
+            self.assertNotIn(x, h)
+        self.assertFalse(h.remove(items[0]))
+
+        expected = sorted(set(items).difference(items[::3]), reverse=True)
+        self.assertItemsEqual(h, expected)
+        self.assertEqual([h.pop() for x in expected], expected)
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.orig_sleep = du.time.sleep
+        self.orig_time = du.time.time
+        self.now = 1000.0
+        self.slept = []
+        du.time.time = lambda: self.now
+        du.time.sleep = self.slept.append
+
+    def tearDown(self):
+        du.time.sleep = self.orig_sleep
+        du.time.time = self.orig_time
+
+    def test_unlimited(self):
+        bucket = du.TokenBucket()
+        self.assertEqual(bucket.consume(1 << 30), 0)
+        self.assertEqual(self.slept, [])
+
+    def test_rate(self):
+        bucket = du.TokenBucket(100)
+        self.assertEqual(bucket.consume(50), 0.5)
+        self.assertEqual(bucket.consume(50), 1.0)
+        self.now += 10
+        # The burst is capped at one second worth of tokens.
+        self.assertEqual(bucket.consume(100), 0)
+        self.assertEqual(bucket.consume(100), 1.0)
+
+    def test_set_rate(self):
+        bucket = du.TokenBucket(100)
+        bucket.set_rate(1000)
+        self.assertEqual(bucket.rate, 1000)
+        self.assertEqual(bucket.consume(500), 0.5)
+        bucket.set_rate(0)
+        self.assertEqual(bucket.consume(1 << 30), 0)
+
+    def test_reserve(self):
+        bucket = du.TokenBucket(100)
+        self.assertEqual(bucket.reserve(50), 0.5)
+        self.assertEqual(bucket.reserve(50), 1.0)
+        self.assertEqual(self.slept, [])
+
+class TestWakePipe(unittest.TestCase):
+    def test_notify(self):
+        wake = du.WakePipe()
+        self.assertEqual(select.select([wake], [], [], 0)[0], [])
+        # Notifying more often than the pipe holds does not block.
+        for i in range(100000):
+            wake.notify()
+        self.assertEqual(select.select([wake], [], [], 0)[0], [wake])
+        wake.drain()
+        self.assertEqual(select.select([wake], [], [], 0)[0], [])